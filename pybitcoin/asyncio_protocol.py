@@ -0,0 +1,135 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+
+Runs the peer protocol on an asyncio event loop instead of the Twisted reactor. On Python 2 this needs trollius.
+"""
+import bitcoin
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from peer import PeerConnection
+from inventory import BoundedStore
+from timers import TimerWheel
+
+
+class AsyncioTimerWheel(TimerWheel):
+    """
+    A `TimerWheel` driven by a single call on an asyncio event loop, which only runs while there are timers pending.
+    """
+
+    def __init__(self, loop=None, granularity=1.0, size=256):
+        TimerWheel.__init__(self, granularity, size)
+        self.loop = loop or asyncio.get_event_loop()
+        self._handle = None
+        self._next_tick = None
+
+    def _start(self):
+        if self._handle is None:
+            self._next_tick = self.loop.time() + self.granularity
+            self._handle = self.loop.call_at(self._next_tick, self._on_tick)
+
+    def _stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _on_tick(self):
+        # If the loop was blocked we may have missed some ticks, catch up on them all.
+        ticks = 1 + max(int((self.loop.time() - self._next_tick) // self.granularity), 0)
+        self._next_tick += ticks * self.granularity
+        self._handle = self.loop.call_at(self._next_tick, self._on_tick)
+        self.advance(ticks)
+
+
+class AsyncioBitcoinProtocol(PeerConnection, asyncio.Protocol):
+    """
+    Runs a `PeerConnection` over an asyncio transport. `ready` is a Future which fires with the protocol once the
+    handshake is complete and `closed` one which fires when the connection goes away.
+    """
+
+    def __init__(self, user_agent, inventory, subscriptions, bloom_filter, blockchain, download_listener, tracker, address_manager,
+                 utxos=None, timers=None, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        PeerConnection.__init__(self, user_agent, inventory, subscriptions, bloom_filter, blockchain, download_listener, tracker,
+                                address_manager, utxos, timers if timers is not None else AsyncioTimerWheel(self.loop))
+        self.transport = None
+        self.ready = asyncio.Future(loop=self.loop)
+        self.closed = asyncio.Future(loop=self.loop)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.start()
+
+    def data_received(self, data):
+        self.receive_data(data)
+
+    def cooperate(self, iterator):
+        # One step per turn of the loop.
+        def step():
+            try:
+                next(iterator)
+            except StopIteration:
+                return
+            self.loop.call_soon(step)
+        self.loop.call_soon(step)
+
+    def connection_lost(self, exc):
+        self.connection_closed()
+        if not self.closed.done():
+            self.closed.set_result(self)
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def lose_connection(self):
+        self.closing = True
+        self.transport.close()
+
+    def get_peer_address(self):
+        peer = self.transport.get_extra_info("peername")
+        return (peer[0], peer[1]) if peer is not None else ("0.0.0.0", 0)
+
+    def on_ready(self):
+        if not self.ready.done():
+            self.ready.set_result(self)
+
+
+_wheels = {}
+
+
+def get_timer_wheel(loop):
+    """
+    Return the wheel shared by all the peers on this event loop.
+    """
+    if loop not in _wheels:
+        _wheels[loop] = AsyncioTimerWheel(loop)
+    return _wheels[loop]
+
+
+def _as_store(table):
+    if isinstance(table, BoundedStore):
+        return table
+    store = BoundedStore()
+    for key, value in table.items():
+        store[key] = value
+    return store
+
+
+def connect_peer(host, port, user_agent, inventory, subscriptions, bloom_filter, blockchain=None, download_listener=None,
+                 tracker=None, address_manager=None, utxos=None, params="mainnet", loop=None):
+    """
+    Open a connection to a peer and return the coroutine from `loop.create_connection`. Wait on the protocol's
+    `ready` Future before using it. `inventory` and `subscriptions` should be `BoundedStore`s, plain dicts are
+    copied into new ones, so use the protocol's `inventory` and `subscriptions` after that.
+    """
+    bitcoin.SelectParams(params)
+    inventory = _as_store(inventory)
+    subscriptions = _as_store(subscriptions)
+    loop = loop or asyncio.get_event_loop()
+    timers = get_timer_wheel(loop)
+    return loop.create_connection(lambda: AsyncioBitcoinProtocol(user_agent, inventory, subscriptions, bloom_filter, blockchain,
+                                                                 download_listener, tracker, address_manager, utxos, timers, loop),
+                                  host, port)
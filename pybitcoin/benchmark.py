@@ -0,0 +1,691 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+
+Offline benchmarks. Run `python benchmark.py` from this directory to run all of them, or name the ones you want.
+`--save-baseline FILE` writes the results out and `--compare FILE` checks them against a saved baseline, exiting
+with an error if anything got worse by more than `--tolerance`.
+
+`addresses` is a conformance check of the `AddressManager` (ranking, backoff and persistence) against a stub
+resolver, so it never touches DNS.
+
+The sync, announce, merkle, relay and broadcast benchmarks run the client against `fakepeer.FakePeer`s on
+localhost, each in its own process so the reactor and the peak RSS start from scratch.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import bitcoin
+from hashlib import sha256
+from twisted.internet import reactor, defer, task
+from bitcoin.core import CBlockHeader, b2lx, b2x
+from bitcoin.core.serialize import uint256_from_compact, uint256_from_str
+from bitcoin.wallet import P2PKHBitcoinAddress
+from blockchain import BlockDatabase, get_next_target
+from listeners import BlockchainListener
+from zope.interface import implementer
+from checkpoints import Checkpoints
+from storage import MemoryStorage, SQLiteStorage, FlatFileStorage
+from discovery import AddressManager, MAINNET_SEEDS
+
+
+class HeaderChainGenerator(object):
+    """
+    Mines a regtest style header chain (minimum difficulty, so every header takes a couple of hashes) which passes
+    the same validation `BlockDatabase` applies to the real chain, including the difficulty retargets. Use `extend`
+    with a different `salt` on an older block to create a competing branch.
+    """
+
+    BITS = 0x207fffff
+
+    def __init__(self, start_time=1400000000, spacing=600):
+        bitcoin.SelectParams("regtest")
+        self.spacing = spacing
+        self.genesis = self._mine(b"\x00" * 32, start_time, self.BITS, 0)
+        self._headers = {self.genesis.GetHash(): (0, self.genesis)}
+
+    def _mine(self, hash_prev, timestamp, bits, salt, merkle_root=None):
+        target = uint256_from_compact(bits)
+        merkle_root = merkle_root or sha256(str(salt)).digest()
+        nonce = 0
+        while True:
+            header = CBlockHeader(nVersion=1, hashPrevBlock=hash_prev, hashMerkleRoot=merkle_root,
+                                  nTime=timestamp, nBits=bits, nNonce=nonce)
+            if uint256_from_str(header.GetHash()) <= target:
+                return header
+            nonce += 1
+
+    def _get_ancestor(self, block_hash, height):
+        h, header = self._headers[block_hash]
+        while h > height:
+            h, header = self._headers[header.hashPrevBlock]
+        return header
+
+    def get_checkpoints(self):
+        """
+        Return a checkpoint table anchored at our genesis block.
+        """
+        return Checkpoints([{
+            "height": 0,
+            "hash": b2lx(self.genesis.GetHash()),
+            "timestamp": self.genesis.nTime,
+            "difficulty_target": self.BITS
+        }])
+
+    def extend(self, count, parent=None, salt=0, merkle_roots=None):
+        """
+        Mine `count` headers on top of `parent` (the genesis block if None) and return them in order. Pass
+        `merkle_roots` to give each header a real merkle root.
+        """
+        parent = parent or self.genesis
+        height = self._headers[parent.GetHash()][0]
+        headers = []
+        for i in range(count):
+            height += 1
+            bits = parent.nBits
+            if height % 2016 == 0:
+                first = self._get_ancestor(parent.GetHash(), height - 2016)
+                bits = get_next_target(parent.nBits, first.nTime, parent.nTime)
+            header = self._mine(parent.GetHash(), parent.nTime + self.spacing, bits, salt, merkle_roots[i] if merkle_roots else None)
+            self._headers[header.GetHash()] = (height, header)
+            headers.append(header)
+            parent = header
+        return headers
+
+
+def _check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_storage(open_storage, path):
+    """
+    Run the storage conformance checks against a backend. `open_storage(path)` must return a storage backend for the
+    given path, re-opening whatever a previous instance wrote there if the backend is persistent. Raises an
+    `AssertionError` on the first failure.
+    """
+    generator = HeaderChainGenerator()
+    checkpoints = generator.get_checkpoints()
+
+    storage = open_storage(path)
+    bd = BlockDatabase(checkpoints=checkpoints, storage=storage)
+    _check(bd.get_height() == 0, "new database should start at the anchor")
+
+    main = generator.extend(100)
+    for header in main:
+        _check(bd.process_block(header) is not None, "valid header was rejected")
+    _check(bd.get_height() == 100, "tip height should be 100")
+    _check(bd.get_tip() == b2lx(main[-1].GetHash()), "tip should be the last header")
+    _check(bd.process_block(main[50]) == 50, "duplicate header should be accepted without being stored again")
+
+    # A shorter branch must not move the tip, a longer one must.
+    fork = generator.extend(15, parent=main[89], salt=1)
+    for header in fork[:10]:
+        bd.process_block(header)
+    _check(bd.get_tip() == b2lx(main[-1].GetHash()), "shorter branch should not become the tip")
+    for header in fork[10:]:
+        bd.process_block(header)
+    _check(bd.get_tip() == b2lx(fork[-1].GetHash()), "longer branch should become the tip")
+    _check(bd.get_height() == 105, "tip height should follow the reorg")
+    _check(bd.get_block_id(91) == b2lx(fork[0].GetHash()), "main chain should follow the new branch")
+    _check(bd.get_block_id(90) == b2lx(main[89].GetHash()), "blocks below the fork should stay in the main chain")
+    _check(bd.get_confirmations(main[95].GetHash()) == 0, "orphaned blocks should have no confirmations")
+    _check(bd.get_confirmations(main[0].GetHash()) == 105, "confirmations should count from the new tip")
+
+    bd.save()
+    bd.close()
+    bd = BlockDatabase(checkpoints=checkpoints, storage=open_storage(path))
+    _check(bd.get_tip() == b2lx(fork[-1].GetHash()), "tip should survive a restart")
+    _check(bd.get_block_id(95) == b2lx(fork[4].GetHash()), "main chain should survive a restart")
+
+    # Push the chain far enough that the bottom gets culled.
+    tip = generator.extend(5000, parent=fork[-1])
+    for header in tip:
+        bd.process_block(header)
+    _check(bd.get_height() == 5105, "tip height should be 5105")
+    _check(bd._get_starting_height() == 105, "everything more than 5000 blocks deep should be culled")
+    _check(bd.get_block_height(b2lx(main[0].GetHash())) is None, "culled blocks should be gone")
+
+    bd.save()
+    bd.close()
+    storage = open_storage(path)
+    bd = BlockDatabase(checkpoints=checkpoints, storage=storage)
+    _check(bd.get_height() == 5105, "tip should survive a restart after culling")
+    _check(bd._get_starting_height() == 105, "culled blocks should stay culled after a restart")
+    bd.close()
+
+    if isinstance(storage, FlatFileStorage):
+        # Crash part way through an append. The torn record should be dropped and the next ones written after the
+        # last good record, not after the garbage.
+        with open(path, "ab") as f:
+            f.write(FlatFileStorage.BLOCK_RECORD + "\x01" * 40)
+        bd = BlockDatabase(checkpoints=checkpoints, storage=open_storage(path))
+        _check(bd.get_height() == 5105, "a torn record should not affect the records before it")
+        for header in generator.extend(10, parent=tip[-1]):
+            bd.process_block(header)
+        bd.save()
+        bd.close()
+        bd = BlockDatabase(checkpoints=checkpoints, storage=open_storage(path))
+        _check(bd.get_height() == 5115, "records written after a torn one should survive a restart")
+        bd.close()
+
+
+def check_address_manager(path):
+    """
+    Run the `AddressManager` checks with a stub resolver in place of DNS, saving the table to `path`. Raises an
+    `AssertionError` on the first failure.
+    """
+    lookups = []
+
+    def resolver(seed):
+        lookups.append(seed)
+        if seed == MAINNET_SEEDS[0]:
+            raise Exception("seed is down")
+        if seed == MAINNET_SEEDS[1]:
+            return defer.succeed(["10.0.0.1", "10.0.0.2"])
+        return ["10.0.0.2", "10.0.0.%s" % MAINNET_SEEDS.index(seed)]
+
+    manager = AddressManager(path, resolver=resolver)
+    first, second = manager.discover(), manager.discover()
+    found = []
+    second.addCallback(found.append)
+    first.addCallback(found.append)
+    _check(found == [len(MAINNET_SEEDS) - 1] * 2, "discovery should count the new addresses")
+    _check(sorted(lookups) == sorted(MAINNET_SEEDS), "concurrent discoveries should share one lookup per seed")
+    _check(all(port == 8333 for ip, port in manager.addresses), "seed addresses should get the network's port")
+
+    # A peer which keeps completing the handshake beats one we haven't tried, which beats one which doesn't.
+    good, new, bad = ("10.0.0.1", 8333), ("10.0.0.2", 8333), ("10.0.0.3", 8333)
+    for i in range(3):
+        manager.mark_attempt(good)
+        manager.mark_good(good)
+        manager.mark_attempt(bad)
+    ranked = manager.get_candidates(len(manager))
+    _check(ranked.index(good) < ranked.index(new) < ranked.index(bad), "candidates should be ranked by reliability")
+    _check(good not in manager.get_candidates(10, exclude=[good]), "excluded addresses should not be candidates")
+
+    # A failure holds the address back for a minute times two to the power of the failures.
+    manager.mark_failed(bad)
+    _check(bad not in manager.get_candidates(10), "an address which just failed should be backing off")
+    manager.addresses[bad]["last_attempt"] -= 121
+    _check(bad in manager.get_candidates(10), "an address should come back once its backoff is over")
+    manager.mark_attempt(bad)
+    manager.mark_failed(bad)
+    manager.addresses[bad]["last_attempt"] -= 121
+    _check(bad not in manager.get_candidates(10), "the backoff should double with each failure")
+    manager.mark_good(bad)
+    _check(bad in manager.get_candidates(10), "a good handshake should clear the failures")
+
+    # With everything backing off we get the addresses due back soonest rather than nothing.
+    for addr in manager.addresses:
+        manager.mark_attempt(addr)
+        manager.mark_failed(addr)
+    manager.mark_attempt(new)
+    manager.mark_failed(new)
+    candidates = manager.get_candidates(2)
+    _check(len(candidates) == 2 and new not in candidates, "with every address backing off, try the ones due back first")
+
+    # Peers which have failed for a week are never handed out and go first when the table is full.
+    manager.addresses[bad]["failures"] = 10
+    manager.addresses[bad]["last_success"] -= 8 * 24 * 60 * 60
+    _check(bad not in manager.get_candidates(10), "terrible addresses should not be candidates")
+    manager.max_addresses = len(manager) - 1
+    manager.add([("10.0.1.1", 8333)])
+    _check(bad not in manager.addresses and len(manager) == manager.max_addresses, "terrible addresses should be evicted first")
+
+    manager.save()
+    restored = AddressManager(path, resolver=resolver)
+    _check(restored.addresses == manager.addresses, "the address table should survive a restart")
+    with open(path, "w") as f:
+        f.write("{not json")
+    _check(len(AddressManager(path, resolver=resolver)) == 0, "a corrupt address table should start empty")
+
+
+def benchmark_storage(open_storage, path, count=10000):
+    """
+    Return the header ingest rate and restart time for a storage backend.
+    """
+    generator = HeaderChainGenerator()
+    checkpoints = generator.get_checkpoints()
+    headers = generator.extend(count)
+
+    bd = BlockDatabase(checkpoints=checkpoints, storage=open_storage(path))
+    start = time.time()
+    for i, header in enumerate(headers):
+        bd.process_block(header)
+        if i % 500 == 499:
+            bd.save()
+    bd.save()
+    elapsed = time.time() - start
+    bd.close()
+
+    start = time.time()
+    bd = BlockDatabase(checkpoints=checkpoints, storage=open_storage(path))
+    restart = time.time() - start
+    bd.close()
+    return {"headers_per_sec": count / elapsed, "restart_sec": restart}
+
+
+def _memory_storage():
+    # The same instance is handed back on "restart" since nothing is persisted.
+    storage = MemoryStorage()
+    return lambda path: storage
+
+
+STORAGE_BACKENDS = [
+    ("memory", _memory_storage),
+    ("sqlite", lambda: SQLiteStorage),
+    ("flatfile", lambda: FlatFileStorage),
+]
+
+
+def run_storage_benchmarks(count=10000, out=sys.stdout):
+    results = {}
+    for name, factory in STORAGE_BACKENDS:
+        directory = tempfile.mkdtemp()
+        try:
+            check_storage(factory(), os.path.join(directory, "conformance"))
+            result = benchmark_storage(factory(), os.path.join(directory, "benchmark"), count)
+        finally:
+            shutil.rmtree(directory)
+        out.write("%-10s conformance ok  %10.0f headers/sec  restart %.3fs\n" %
+                  (name, result["headers_per_sec"], result["restart_sec"]))
+        results[name] = result
+    return results
+
+
+class ReactorLatencyProbe(object):
+    """
+    Measures how late the reactor runs a call scheduled every `interval` seconds, which is how long whatever the
+    reactor was doing kept everything else waiting.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._call = None
+
+    def start(self):
+        self._expected = time.time() + self.interval
+        self._call = reactor.callLater(self.interval, self._sample)
+
+    def _sample(self):
+        now = time.time()
+        self.samples.append(max(now - self._expected, 0))
+        self._expected = now + self.interval
+        self._call = reactor.callLater(self.interval, self._sample)
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+
+    def get_results(self):
+        samples = sorted(self.samples) or [0]
+        return {
+            "reactor_latency_max_ms": samples[-1] * 1000,
+            "reactor_latency_p99_ms": _percentile(samples, 0.99) * 1000
+        }
+
+
+def _percentile(samples, fraction):
+    """
+    Linearly interpolate between the closest ranks of the sorted `samples`, so a short run with a single stall
+    doesn't report it as its p99 as well as its max.
+    """
+    rank = (len(samples) - 1) * fraction
+    low = int(rank)
+    high = min(low + 1, len(samples) - 1)
+    return samples[low] + (samples[high] - samples[low]) * (rank - low)
+
+
+def _connect_client(network, blockchain=None, subscriptions=None, tracker=None, on_ready=None):
+    from fakepeer import FakeNetwork
+    from inventory import BoundedStore
+    from extensions import BloomFilter
+    from protocol import PeerFactory
+    address = network.listen()[0]
+    factory = PeerFactory("regtest", "/benchmark/", BoundedStore(), subscriptions or BoundedStore(),
+                          BloomFilter(10, 0.001, 0, BloomFilter.UPDATE_NONE), lambda f: None, blockchain, None, tracker,
+                          handshake_cb=on_ready)
+    reactor.connectTCP(address[0], address[1], factory)
+    return factory
+
+
+def benchmark_sync(count=10000):
+    """
+    Download a header chain from a fake peer.
+    """
+    from fakepeer import FakeNetwork, SyntheticChain
+    generator = HeaderChainGenerator()
+    chain = SyntheticChain(generator, count)
+    bd = BlockDatabase(checkpoints=generator.get_checkpoints(), storage=MemoryStorage())
+    d = defer.Deferred()
+    start = []
+
+    def on_ready(factory):
+        start.append(time.time())
+        factory.protocol.download_blocks(on_download)
+
+    def on_download():
+        if not d.called:
+            _check(bd.get_height() == count, "header sync stopped at %s of %s" % (bd.get_height(), count))
+            d.callback({"headers_per_sec": count / (time.time() - start[0])})
+
+    _connect_client(FakeNetwork(chain), blockchain=bd, on_ready=on_ready)
+    return d
+
+
+def benchmark_merkle(count=2000, txs_per_block=20, match_density=0.05):
+    """
+    Download filtered blocks from a fake peer with `match_density` of the txs paying our subscription.
+    """
+    from fakepeer import FakeNetwork, SyntheticChain
+    from inventory import BoundedStore
+    from confirmations import ConfirmationTracker
+    address = P2PKHBitcoinAddress.from_bytes(os.urandom(20))
+    generator = HeaderChainGenerator()
+    chain = SyntheticChain(generator, count, txs_per_block, match_density, address.to_scriptPubKey())
+    expected = chain.get_match_count()
+    bd = BlockDatabase(checkpoints=generator.get_checkpoints(), storage=MemoryStorage())
+    subscriptions = BoundedStore()
+    tracker = ConfirmationTracker(bd, subscriptions)
+    bd.add_listener(tracker)
+    matches = []
+    d = defer.Deferred()
+    start = []
+
+    def on_ready(factory):
+        start.append(time.time())
+        factory.protocol.download_blocks(check_done)
+
+    def on_match(txid):
+        if subscriptions[txid].confirmations > 0 and txid not in matches:
+            matches.append(txid)
+            check_done()
+
+    def check_done():
+        if not d.called and bd.get_height() == count and len(matches) == expected:
+            elapsed = time.time() - start[0]
+            d.callback({
+                "merkleblocks_per_sec": count / elapsed,
+                "tx_matches_per_sec": expected / elapsed
+            })
+
+    subscriptions.pin(str(address), (0, on_match))
+    _connect_client(FakeNetwork(chain), blockchain=bd, subscriptions=subscriptions, tracker=tracker, on_ready=on_ready)
+    return d
+
+
+def benchmark_compact(count=2000, txs_per_block=20, match_density=0.005):
+    """
+    Check the compact filters of a chain of full blocks from a fake peer and download the blocks which match.
+    """
+    from fakepeer import FakeNetwork, SyntheticChain
+    from inventory import BoundedStore
+    from confirmations import ConfirmationTracker
+    from compactfilters import FilterMatcher
+    address = P2PKHBitcoinAddress.from_bytes(os.urandom(20))
+    generator = HeaderChainGenerator()
+    chain = SyntheticChain(generator, count, txs_per_block, match_density, address.to_scriptPubKey(), full_blocks=True)
+    expected = chain.get_match_count()
+    bd = BlockDatabase(checkpoints=generator.get_checkpoints(), storage=MemoryStorage())
+    subscriptions = BoundedStore()
+    tracker = ConfirmationTracker(bd, subscriptions)
+    bd.add_listener(tracker)
+    matcher = FilterMatcher(1)
+    matcher.add_script(address.to_scriptPubKey())
+    matches = []
+    d = defer.Deferred()
+    start = []
+
+    def on_ready(factory):
+        start.append(time.time())
+        factory.protocol.download_blocks(lambda: None)
+        matcher.when_scanned(count).addCallback(on_scanned, factory)
+
+    def on_scanned(height, factory):
+        elapsed = time.time() - start[0]
+        _check(len(matches) == expected, "found %d of %d matching txs" % (len(matches), expected))
+        d.callback({
+            "filters_per_sec": count / elapsed,
+            "bytes_per_block": factory.protocol.bytes_received / float(count)
+        })
+
+    subscriptions.pin(str(address), (0, lambda txid: matches.append(txid) if txid not in matches else None))
+    factory = _connect_client(FakeNetwork(chain), blockchain=bd, subscriptions=subscriptions, tracker=tracker, on_ready=on_ready)
+    factory.compact_filters = matcher
+    return d
+
+
+def benchmark_relay(count=10000, batch_size=500):
+    """
+    Flood the client with inv packets for mempool txs it has to fetch and check against its subscriptions.
+    """
+    from fakepeer import FakeNetwork, make_payment
+    network = FakeNetwork()
+    txs = [make_payment(P2PKHBitcoinAddress.from_bytes(os.urandom(20)).to_scriptPubKey()) for i in range(count)]
+    for tx in txs:
+        network.mempool[tx.GetHash()] = tx
+    d = defer.Deferred()
+    start = []
+
+    def on_ready(factory):
+        start.append(time.time())
+        peer = network.peers[0]
+        for i in range(0, count, batch_size):
+            peer.announce(txs[i:i + batch_size])
+        # The first pong comes back once the client has asked for everything, the second once it has the lot.
+        peer.ping(lambda: peer.ping(on_done))
+
+    def on_done():
+        d.callback({"relay_txs_per_sec": count / (time.time() - start[0])})
+
+    _connect_client(network, on_ready=on_ready)
+    return d
+
+
+def benchmark_broadcast(count=500, peers=4):
+    """
+    Broadcast a batch of txs through a `BitcoinClient` connected to several fake peers and wait for them to be
+    announced back.
+    """
+    from fakepeer import FakeNetwork, make_payment
+    from client import BitcoinClient
+    network = FakeNetwork()
+    addresses = network.listen(peers)
+    client = BitcoinClient(addresses, params="regtest", max_connections=peers, standby_peers=0)
+    txs = [b2x(make_payment(P2PKHBitcoinAddress.from_bytes(os.urandom(20)).to_scriptPubKey()).serialize()) for i in range(count)]
+    d = defer.Deferred()
+
+    def wait_for_peers():
+        if client.get_peer_count() < peers:
+            return task.deferLater(reactor, 0.05, wait_for_peers)
+        start = time.time()
+        deferreds, done = client.broadcast_txs(txs)
+
+        def on_done(results):
+            _check(all(success and result for success, result in results), "not every tx was announced back")
+            d.callback({"broadcast_txs_per_sec": count / (time.time() - start)})
+        done.addCallback(on_done)
+
+    wait_for_peers()
+    return d
+
+
+@implementer(BlockchainListener)
+class _TipWatcher(object):
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def on_tip_changed(self, block_id, height):
+        self.callback(height)
+
+    def on_reorg(self, disconnected, connected):
+        pass
+
+
+def benchmark_announce(count=200, start=1000):
+    """
+    Once synced, have the peer mine `count` blocks one at a time and measure how long each takes to become our
+    tip after it is announced.
+    """
+    from fakepeer import FakeNetwork, SyntheticChain
+    generator = HeaderChainGenerator()
+    chain = SyntheticChain(generator, start)
+    network = FakeNetwork(chain)
+    bd = BlockDatabase(checkpoints=generator.get_checkpoints(), storage=MemoryStorage())
+    latencies = []
+    announced = []
+    d = defer.Deferred()
+
+    def announce():
+        if len(latencies) == count:
+            latencies.sort()
+            d.callback({
+                "announce_latency_ms": sum(latencies) / len(latencies) * 1000,
+                "announce_latency_p99_ms": _percentile(latencies, 0.99) * 1000
+            })
+            return
+        header = chain.extend(1)
+        announced.append(time.time())
+        network.peers[0].announce_blocks(header)
+
+    def on_tip_changed(height):
+        if len(announced) > len(latencies) and height == start + len(announced):
+            latencies.append(time.time() - announced[-1])
+            reactor.callLater(0, announce)
+
+    def on_ready(factory):
+        factory.protocol.download_blocks(announce)
+
+    bd.add_listener(_TipWatcher(on_tip_changed))
+    _connect_client(network, blockchain=bd, on_ready=on_ready)
+    return d
+
+
+NETWORK_BENCHMARKS = [
+    ("sync", benchmark_sync),
+    ("announce", benchmark_announce),
+    ("merkle", benchmark_merkle),
+    ("compact", benchmark_compact),
+    ("relay", benchmark_relay),
+    ("broadcast", benchmark_broadcast),
+]
+
+
+def _run_network_benchmark(name):
+    """
+    Run one of the `NETWORK_BENCHMARKS` in the reactor and return its results, including the peak RSS and the
+    reactor latency.
+    """
+    bitcoin.SelectParams("regtest")
+    results = {}
+    probe = ReactorLatencyProbe()
+
+    def run():
+        # The benchmarks build their chains before they return, which isn't what we want to measure.
+        d = defer.maybeDeferred(dict(NETWORK_BENCHMARKS)[name])
+        probe.start()
+        timeout = reactor.callLater(300, d.cancel)
+
+        def finish(result):
+            if timeout.active():
+                timeout.cancel()
+            probe.stop()
+            results.update(result)
+            reactor.stop()
+
+        def fail(failure):
+            results["error"] = failure.getTraceback()
+            finish({})
+        d.addCallbacks(finish, fail)
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    if "error" in results:
+        raise AssertionError("%s benchmark failed: %s" % (name, results["error"]))
+    results.update(probe.get_results())
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def run_benchmarks(names, out=sys.stdout):
+    """
+    Run the named benchmarks and return {"name.metric": value}. Each network benchmark runs in a child process.
+    """
+    results = {}
+    for name in names:
+        if name == "addresses":
+            directory = tempfile.mkdtemp()
+            try:
+                check_address_manager(os.path.join(directory, "peers.json"))
+            finally:
+                shutil.rmtree(directory)
+            out.write("addresses  conformance ok\n")
+            continue
+        if name == "storage":
+            for backend, result in run_storage_benchmarks(out=out).items():
+                for metric, value in result.items():
+                    results["storage.%s.%s" % (backend, metric)] = value
+            continue
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", name])
+        result = json.loads(output.strip().splitlines()[-1])
+        out.write("%-10s %s\n" % (name, "  ".join("%s %.1f" % (k, result[k]) for k in sorted(result))))
+        for metric, value in result.items():
+            results["%s.%s" % (name, metric)] = value
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2, out=sys.stdout):
+    """
+    Print how each metric moved against the baseline and return the names of those which got worse by more than
+    `tolerance`. Rates should go up, everything else should go down.
+    """
+    regressions = []
+    for metric in sorted(results):
+        if metric not in baseline or baseline[metric] == 0:
+            continue
+        change = (results[metric] - baseline[metric]) / float(baseline[metric])
+        worse = -change if metric.endswith("_per_sec") else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(metric)
+            flag = "  REGRESSION"
+        out.write("%-45s %12.1f %12.1f %+7.1f%%%s\n" % (metric, baseline[metric], results[metric], change * 100, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    names = ["storage", "addresses"] + [name for name, benchmark in NETWORK_BENCHMARKS]
+    parser = argparse.ArgumentParser(description="Offline pybitcoin benchmarks")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help="which benchmarks to run: %s (default: all)" % ", ".join(names))
+    parser.add_argument("--save-baseline", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fractional regression (default: 0.2)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error("unknown benchmark %s" % name)
+
+    if args.child:
+        print json.dumps(_run_network_benchmark(args.child))
+        sys.exit(0)
+
+    results = run_benchmarks(args.benchmarks or names)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        if len(regressions) > 0:
+            sys.exit("Regressed: %s" % ", ".join(regressions))
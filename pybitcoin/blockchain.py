@@ -2,107 +2,158 @@ __author__ = 'chris'
 """
 Copyright (c) 2015 Chris Pacia
 """
-import os
-import sqlite3 as lite
+import time
+import traceback
 from bitcoin.core import CBlockHeader, CheckBlockHeader, CheckBlockHeaderError, b2lx, lx
 from bitcoin.net import CBlockLocator
 from bitcoin.core.serialize import uint256_from_compact, compact_from_uint256
+from checkpoints import TESTNET_CHECKPOINTS, MAINNET_CHECKPOINTS, get_checkpoints
+from storage import StoredBlock, MemoryStorage, SQLiteStorage
+from listeners import BlockchainListener
+from log import Logger
+from metrics import get_registry, timed_call
+from zope.interface.verify import verifyObject
 
-TESTNET_CHECKPOINT = {
-    "height": 606816,
-    "hash": "00000000000004e40b0b4ae327ecb4532d986542a3d609a3378e7fe576d2f010",
-    "timestamp": 1448160074,
-    "difficulty_target": 436542988
-}
+TESTNET_CHECKPOINT = TESTNET_CHECKPOINTS[-1]
 
-MAINNET_CHECKPOINT = {
-    "height": 376992,
-    "hash": "0000000000000000021a4323000720f49619762e302aa921f214cd8a4adbfdb4",
-    "timestamp": 1443700390,
-    "difficulty_target": 403838066
-}
+MAINNET_CHECKPOINT = MAINNET_CHECKPOINTS[-1]
+
+DB_WRITE_SECONDS = get_registry().histogram("pybitcoin_db_write_seconds", "Time taken to flush the header database",
+                                            ("storage",))
+
+
+def get_block_work(bits):
+    """
+    Return the expected number of hashes needed to find a block with the given compact target.
+    """
+    return (1 << 256) // (uint256_from_compact(bits) + 1)
+
+
+def get_next_target(target, first_timestamp, last_timestamp):
+    """
+    Return the compact target for the first block of a new difficulty period.
+    """
+    min, max = (302400, 4838400)
+    difference = last_timestamp - first_timestamp
+    if difference < min:
+        difference = min
+    elif difference > max:
+        difference = max
+    return compact_from_uint256(long(uint256_from_compact(target) * (float(difference) / (60 * 60 * 24 * 14))))
 
 
 class BlockDatabase(object):
 
     """
-    This class maintains a database of block headers needed to prove a transaction exists in the blockchain. Its
-    primary key is total difficulty, hence the last entry in the database should be the tip of the chain. When a new
-    block is passed into `process_block` we validate it, look up it's parent in the chain (reject if no parent exists),
-    add the difficulty of the block to the cumulative difficulty of the parent, and insert into the database at the
-    appropriate height. Since valid blocks and orphans are both stored in the same table, blockchain reorganizations
-    are automatically handled. If an orphan chain overtakes the main chain, it's head will extend past the previous
-    head. It only keeps enough headers (5000) to guard against a reorg, everything before that is deleted.
+    This class maintains a database of block headers needed to prove a transaction exists in the blockchain. When a
+    new block is passed into `process_block` we validate it, look up it's parent in the chain (reject if no parent
+    exists), add the work of the block to the cumulative work of the parent (kept as an exact 256 bit integer), and
+    store it at the appropriate height. Since valid blocks and orphans are both stored together, blockchain
+    reorganizations are handled by comparing the new block's work against the cached tip. If an orphan chain
+    overtakes the main chain we walk back to the fork point and move the main chain over to the new branch. It only
+    keeps enough headers (5000) to guard against a reorg, everything before that is deleted.
+
+    A new database starts from an anchor checkpoint (by default the most recent one, or the highest one at or below
+    `checkpoint` if a height is given). Headers at or below the last checkpoint are accepted on linkage and proof of
+    work alone, full difficulty validation starts after it. Starting from the last anchor there is nothing to skip,
+    so this only saves work when there are checkpoints above the anchor.
+
+    The headers themselves are kept in a `HeaderStorage` backend. If none is given we use an on-disk `SQLiteStorage`
+    at `filepath`, or a `MemoryStorage` if there is no filepath either.
+
+    Changes to the best chain are reported to any `BlockchainListener` registered with `add_listener`.
 
     """
 
-    def __init__(self, filepath, testnet=False):
+    def __init__(self, filepath=None, testnet=False, checkpoint=None, checkpoints=None, storage=None):
         self.testnet = testnet
         self.filepath = filepath
-        self.db = lite.connect(":memory:")
-        self.db.text_factory = str
-        self._create_database(testnet)
-
-    def _create_database(self, testnet):
-        cursor = self.db.cursor()
-        if os.path.exists(self.filepath):
-            f = open(self.filepath, "r")
-            f.seek(0)
-            cursor.executescript(f.read())
-        else:
-            cursor.execute('''CREATE TABLE blocks(totalWork REAL PRIMARY KEY, height INTEGER, blockID TEXT, hashOfPrevious TEXT, timestamp INTEGER, target INTEGER)''')
-
-            cursor.execute('''CREATE INDEX blockIndx ON blocks(blockID);''')
-
-            if testnet:
-                cursor.execute('''INSERT INTO blocks(totalWork, height, blockID, hashOfPrevious, timestamp, target) VALUES (?,?,?,?,?,?)''',
-                               (0, TESTNET_CHECKPOINT["height"], TESTNET_CHECKPOINT["hash"], "", TESTNET_CHECKPOINT["timestamp"], TESTNET_CHECKPOINT["difficulty_target"]))
+        self.checkpoints = checkpoints if checkpoints is not None else get_checkpoints(testnet)
+        self.anchor = self.checkpoints.get_anchor(checkpoint)
+        if storage is None:
+            storage = SQLiteStorage(filepath) if filepath is not None else MemoryStorage()
+        self.storage = storage
+        self.listeners = []
+        self.log = Logger(system=self)
+        self._create_database()
+
+    def _create_database(self):
+        best = self.storage.get_best()
+        if best is None:
+            best = StoredBlock(self.anchor["hash"], self.anchor["height"], "", self.anchor["timestamp"],
+                               self.anchor["difficulty_target"], 0, True)
+            self.storage.put(best)
+            self.storage.flush()
+            if self.checkpoints.get_last_height() > best.height:
+                self.log.info("Skipping difficulty validation up to checkpoint %s" % self.checkpoints.get_last_height())
             else:
-                cursor.execute('''INSERT INTO blocks(totalWork, height, blockID, hashOfPrevious, timestamp, target) VALUES (?,?,?,?,?,?)''',
-                               (0, MAINNET_CHECKPOINT["height"], MAINNET_CHECKPOINT["hash"], "", MAINNET_CHECKPOINT["timestamp"], MAINNET_CHECKPOINT["difficulty_target"]))
-        self.db.commit()
+                self.log.info("No checkpoints above %s, validating the difficulty of every header" % best.height)
+        self._tip = (best.block_id, best.height, best.total_work)
+        self._starting_height = self.storage.get_starting_height()
 
     def _commit_block(self, height, block_id, hash_of_previous, bits, timestamp, target):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT totalWork FROM blocks WHERE height=?''', (height-1,))
-        total_work = cursor.fetchone()[0] + CBlockHeader.calc_difficulty(bits)
-        cursor = self.db.cursor()
-        cursor.execute('''INSERT INTO blocks(totalWork, height, blockID, hashOfPrevious, timestamp, target) VALUES (?,?,?,?,?,?)''',
-                       (total_work, height, block_id, hash_of_previous, timestamp, target))
-        self.db.commit()
+        total_work = self.storage.get(hash_of_previous).total_work + get_block_work(bits)
+        self.storage.put(StoredBlock(block_id, height, hash_of_previous, timestamp, target, total_work))
+        # Ties go to the block we saw first.
+        if total_work > self._tip[2]:
+            self._set_tip(block_id, height, hash_of_previous, total_work)
         self._cull()
 
+    def _set_tip(self, block_id, height, hash_of_previous, total_work):
+        """
+        Make `block_id` the new tip. If it doesn't build on the current tip, walk back along its branch until we
+        hit the main chain and move the main chain over to the new branch from the fork point.
+        """
+        branch = [block_id]
+        parent = self.storage.get(hash_of_previous)
+        while parent is not None and not parent.main_chain:
+            branch.append(parent.block_id)
+            parent = self.storage.get(parent.hash_of_previous)
+        fork_height = height - len(branch)
+        disconnected = []
+        for h in range(fork_height + 1, self._tip[1] + 1):
+            disconnected.append((h, self.get_block_id(h)))
+        self.storage.set_main_chain(fork_height, reversed(branch))
+        self._tip = (block_id, height, total_work)
+        if len(disconnected) > 0:
+            connected = [(fork_height + 1 + i, b) for i, b in enumerate(reversed(branch))]
+            self._notify("on_reorg", disconnected, connected)
+        self._notify("on_tip_changed", block_id, height)
+
+    def _notify(self, event, *args):
+        for listener in self.listeners:
+            try:
+                timed_call("%s.%s" % (listener.__class__.__name__, event), getattr(listener, event), *args)
+            except Exception:
+                self.log.error("%s.%s failed:\n%s" % (listener.__class__.__name__, event, traceback.format_exc()))
+
+    def add_listener(self, listener):
+        verifyObject(BlockchainListener, listener)
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
     def _get_parent_height(self, header):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT height FROM blocks WHERE blockID=?''', (b2lx(header.hashPrevBlock),))
-        height = cursor.fetchone()
-        if height is not None:
-            return height[0]
-        else:
-            return None
+        return self.get_block_height(b2lx(header.hashPrevBlock))
 
     def _get_starting_height(self):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT height FROM blocks ORDER BY ROWID ASC LIMIT 1''')
-        return cursor.fetchone()[0]
+        return self._starting_height
 
     def _cull(self):
-        cursor = self.db.cursor()
         start = self._get_starting_height()
         end = self.get_height()
         if end - start > 5000:
-            for i in range((end-start) - 5000):
-                cursor.execute('''DELETE FROM blocks WHERE height=?''', (start+i,))
+            self.storage.delete_below(end - 5000)
+            self._starting_height = end - 5000
 
     def _get_parent(self, block_id):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT hashOfPrevious FROM blocks WHERE blockID=?;''', (block_id, ))
-        return cursor.fetchone()[0]
+        block = self.storage.get(block_id)
+        return block.hash_of_previous if block is not None else None
 
     def _check_timestamp(self, timestamp):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT blockID FROM blocks WHERE totalWork = (SELECT MAX(totalWork) FROM blocks);''')
-        tip = cursor.fetchone()[0]
+        tip = self._tip[0]
         if self.get_height() - self._get_starting_height() > 10:
             timestamps = []
             timestamps.append(self.get_timestamp(tip))
@@ -112,21 +163,17 @@ class BlockDatabase(object):
             if timestamp <= timestamps[4]:
                 raise CheckBlockHeaderError("Invalid Timestamp")
 
-    def _check_difficulty_target(self, header):
+    def _check_difficulty_target(self, header, parent_height):
         parent = b2lx(header.hashPrevBlock)
         target = self.get_difficulty_target(parent)
-        if (self.get_height() + 1) % 2016 == 0:
+        if (parent_height + 1) % 2016 == 0:
             end = self.get_timestamp(parent)
-            min, max = (302400, 4838400)
-            for i in range(2015):
-                parent = self._get_parent(parent)
-            start = self.get_timestamp(parent)
-            difference = end - start
-            if difference < min:
-                difference = min
-            elif difference > max:
-                difference = max
-            target = compact_from_uint256(long(uint256_from_compact(target) * (float(difference) / (60 * 60 * 24 * 14))))
+            if self.get_block_id(parent_height) == parent:
+                parent = self.get_block_id(parent_height - 2015)
+            else:
+                for i in range(2015):
+                    parent = self._get_parent(parent)
+            target = get_next_target(target, self.get_timestamp(parent), end)
         if self.testnet and header.nTime - self.get_timestamp(parent) >= 1200:
             return target
         if uint256_from_compact(header.nBits) > uint256_from_compact(target):
@@ -134,48 +181,60 @@ class BlockDatabase(object):
         return target
 
     def get_block_id(self, height):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT blockID FROM blocks WHERE height = ?;''', (height,))
-        return cursor.fetchone()[0]
+        block = self.storage.get_main_chain(height)
+        return block.block_id if block is not None else None
 
     def get_difficulty_target(self, block_id):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT target FROM blocks WHERE blockID=?''', (block_id,))
-        return cursor.fetchone()[0]
+        return self.storage.get(block_id).target
 
     def get_timestamp(self, block_id):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT timestamp FROM blocks WHERE blockID = ?;''', (block_id,))
-        return cursor.fetchone()[0]
+        return self.storage.get(block_id).timestamp
 
     def get_height(self):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT height FROM blocks WHERE totalWork = (SELECT MAX(totalWork) FROM blocks);''')
-        return cursor.fetchone()[0]
+        return self._tip[1]
+
+    def get_tip(self):
+        return self._tip[0]
+
+    def get_chain_work(self, block_id=None):
+        """
+        Return the cumulative work up to and including `block_id` (or the tip if no block is given).
+        """
+        if block_id is None:
+            return self._tip[2]
+        block = self.storage.get(block_id)
+        return block.total_work if block is not None else None
 
     def get_block_height(self, block_id):
-        cursor = self.db.cursor()
-        cursor.execute('''SELECT height FROM blocks WHERE blockID=?;''', (block_id,))
-        ret = cursor.fetchone()
-        return ret[0] if ret is not None else None
+        block = self.storage.get(block_id)
+        return block.height if block is not None else None
+
+    def get_height_at_time(self, timestamp):
+        """
+        Return the height of the first main chain block mined at or after `timestamp`, or None if the tip is older.
+        Block timestamps are only roughly in order so this can be off by a few blocks either way. If the blocks
+        around `timestamp` have been culled the lowest height we still have is returned.
+        """
+        low = self._get_starting_height()
+        high = self.get_height()
+        if self.get_timestamp(self.get_tip()) < timestamp:
+            return None
+        while low < high:
+            mid = (low + high) / 2
+            if self.storage.get_main_chain(mid).timestamp < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
 
     def get_confirmations(self, block_id):
         """
         Given a block id, return the number of confirmations
         """
-        block_height = self.get_block_height(b2lx(block_id))
-        if block_height is None:
-            return 0
-        tip_height = self.get_height()
-
-        parent = self.get_block_id(self.get_height())
-        for i in range(tip_height - block_height):
-            parent = self._get_parent(parent)
-
-        if parent == b2lx(block_id):
-            return tip_height - block_height + 1
-        else:
+        block = self.storage.get(b2lx(block_id))
+        if block is None or not block.main_chain:
             return 0
+        return self.get_height() - block.height + 1
 
     def get_locator(self):
         """
@@ -183,26 +242,18 @@ class BlockDatabase(object):
         """
 
         locator = CBlockLocator()
-        parent = self.get_block_id(self.get_height())
-
-        def rollback(parent, n):
-            for i in range(n):
-                parent = self._get_parent(parent)
-            return parent
-
-        step = -1
-        start = 0
+        start = self._get_starting_height()
         height = self.get_height()
-        while(True):
-            if start >= 10:
+        step = 1
+        while True:
+            locator.vHave.append(lx(self.get_block_id(height)))
+            if len(locator.vHave) >= 10:
                 step *= 2
-                start = 0
-            locator.vHave.append(lx(parent))
-            parent = rollback(parent, abs(step))
-            start += 1
-            height += step
-            if height <= self._get_starting_height() + abs(step):
+            if height - step <= start + step:
                 break
+            height -= step
+        if height != start:
+            locator.vHave.append(lx(self.get_block_id(start)))
         return locator
 
     def process_block(self, block):
@@ -214,15 +265,26 @@ class BlockDatabase(object):
             header = block if isinstance(block, CBlockHeader) else block.get_header()
             CheckBlockHeader(header, True)
             # self._check_timestamp(header.nTime) # not working on testnet?
-            target = self._check_difficulty_target(header)
             h = self._get_parent_height(header)
-            if h is not None:
-                self._commit_block(h + 1, b2lx(header.GetHash()), b2lx(header.hashPrevBlock), header.nBits, header.nTime, target)
+            block_id = b2lx(header.GetHash())
+            if h is not None and self.get_block_height(block_id) is None:
+                if not self.checkpoints.verify(h + 1, block_id):
+                    raise CheckBlockHeaderError("Block %s does not match checkpoint" % block_id)
+                # Everything up to the last checkpoint is pinned by the checkpoints so we can skip the
+                # (expensive) retarget validation and take the target from the header.
+                if h + 1 <= self.checkpoints.get_last_height():
+                    target = header.nBits
+                else:
+                    target = self._check_difficulty_target(header, h)
+                self._commit_block(h + 1, block_id, b2lx(header.hashPrevBlock), header.nBits, header.nTime, target)
             return h
         except Exception, e:
             pass
 
     def save(self):
-        with open(self.filepath, 'w') as outfile:
-            for line in self.db.iterdump():
-                outfile.write('%s\n' % line)
+        start = time.time()
+        self.storage.flush()
+        DB_WRITE_SECONDS.observe(time.time() - start, (self.storage.__class__.__name__,))
+
+    def close(self):
+        self.storage.close()
@@ -0,0 +1,280 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+
+Records the traffic of a peer connection to a capture file and replays it, so a stalled sync or a CPU spike seen
+in the wild can be reproduced and profiled offline.
+
+A capture starts with a header naming the network, the peer and the tip of our headers database when the
+connection was made, followed by one record per message:
+
+    <float64 seconds since the capture started> <uint8 direction> <uint32 length> <the framed message>
+
+To replay a capture against a copy of the headers database the client was using:
+
+    python capture.py 1.2.3.4_8333_1450000000.cap --blocks blocks.db [--realtime] [--profile out.prof]
+"""
+import os
+import sys
+import time
+import struct
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import bitcoin
+from peer import PeerConnection
+from timers import TimerWheel
+from inventory import BoundedStore
+from extensions import BloomFilter
+from log import Logger
+
+MAGIC = "PBCAP"
+FORMAT_VERSION = 2
+INCOMING = 0
+OUTGOING = 1
+
+_HEADER = struct.Struct("<5sBd")
+_RECORD = struct.Struct("<dBI")
+
+
+def _write_string(f, s):
+    f.write(struct.pack("<B", len(s)) + s)
+
+
+def _read_string(f):
+    length = struct.unpack("<B", f.read(1))[0]
+    return f.read(length)
+
+
+class CaptureWriter(object):
+    """
+    Appends the framed messages of one peer connection to a capture file. Attach it to a `PeerConnection` as its
+    `recorder` and everything sent and received is written out until the connection closes. `tip` is the
+    (block id, height) of the headers database the connection starts from, if there is one.
+    """
+
+    def __init__(self, filepath, params="mainnet", peer=("0.0.0.0", 0), tip=None):
+        self.filepath = filepath
+        self.start = time.time()
+        self.messages = 0
+        self.file = open(filepath, "wb")
+        self.file.write(_HEADER.pack(MAGIC, FORMAT_VERSION, self.start))
+        _write_string(self.file, params)
+        _write_string(self.file, peer[0])
+        self.file.write(struct.pack("<H", peer[1]))
+        _write_string(self.file, tip[0] if tip is not None else "")
+        self.file.write(struct.pack("<i", tip[1] if tip is not None else -1))
+
+    @classmethod
+    def for_peer(cls, directory, params, peer, tip=None):
+        """
+        Open a new capture in `directory` named after the peer and the time.
+        """
+        filename = "%s_%s_%d.cap" % (peer[0].replace(":", "-"), peer[1], time.time())
+        return cls(os.path.join(directory, filename), params, peer, tip)
+
+    def record(self, data, direction=INCOMING):
+        if self.file is not None:
+            self.file.write(_RECORD.pack(time.time() - self.start, direction, len(data)) + data)
+            self.messages += 1
+
+    def record_incoming(self, data):
+        self.record(data, INCOMING)
+
+    def record_outgoing(self, data):
+        self.record(data, OUTGOING)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CaptureReader(object):
+    """
+    Reads a capture back. Iterating over it yields (time, direction, data) for each message, where time is the
+    number of seconds since the capture started. A record cut short because the process died while writing it
+    ends the capture. `tip` is the (block id, height) the capture started from, or None if it didn't say.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, "rb") as f:
+            magic, version, self.start = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC or version not in (1, FORMAT_VERSION):
+                raise ValueError("%s is not a version %s capture" % (filepath, FORMAT_VERSION))
+            self.params = _read_string(f)
+            host = _read_string(f)
+            self.peer = (host, struct.unpack("<H", f.read(2))[0])
+            self.tip = None
+            if version >= 2:
+                block_id = _read_string(f)
+                height = struct.unpack("<i", f.read(4))[0]
+                if block_id:
+                    self.tip = (block_id, height)
+            self._offset = f.tell()
+
+    def __iter__(self):
+        with open(self.filepath, "rb") as f:
+            f.seek(self._offset)
+            while True:
+                record = f.read(_RECORD.size)
+                if len(record) < _RECORD.size:
+                    return
+                timestamp, direction, length = _RECORD.unpack(record)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield timestamp, direction, data
+
+
+class ReplayConnection(PeerConnection):
+    """
+    A `PeerConnection` which thinks it is talking to the peer in the capture. Once the replayed handshake completes
+    it starts a chain download the way the client would, so the headers and blocks in the capture have somewhere
+    to go. Whatever it sends is thrown away.
+    """
+
+    def __init__(self, peer, *args, **kwargs):
+        PeerConnection.__init__(self, *args, **kwargs)
+        self.peer = peer
+        self.downloaded = False
+
+    def write(self, data):
+        pass
+
+    def get_peer_address(self):
+        return self.peer
+
+    def on_ready(self):
+        if self.blockchain is not None:
+            self.download_blocks(self._on_download)
+
+    def _on_download(self):
+        self.downloaded = True
+
+
+def replay(filepath, blockchain=None, subscriptions=None, realtime=False, speed=1.0, check_tip=True):
+    """
+    Feed the messages the peer sent us in the capture through a `ReplayConnection` and `blockchain`. By default
+    they go in as fast as they can be processed. With `realtime` we wait between them as long as we did when they
+    were captured (divided by `speed`). Either way the protocol timers follow the capture's clock rather than the
+    wall clock, so a timeout which fired while capturing fires at the same point in the replay.
+
+    The headers database has to be at the tip the capture started from, or the headers in it would only be
+    replayed as duplicates (or not connect at all). A ValueError is raised if it isn't, unless `check_tip` is False.
+
+    Returns a dict of statistics including the number of messages and bytes of each command and the time spent
+    processing them.
+    """
+    capture = CaptureReader(filepath)
+    bitcoin.SelectParams(capture.params)
+    log = Logger(system="replay")
+    if blockchain is not None and capture.tip is not None and blockchain.get_tip() != capture.tip[0]:
+        message = "The capture started from %s at height %s but the headers database is at %s at height %s" % (
+            capture.tip[0], capture.tip[1], blockchain.get_tip(), blockchain.get_height())
+        if check_tip:
+            raise ValueError(message)
+        log.warning(message)
+    subscriptions = subscriptions if subscriptions is not None else BoundedStore()
+    tracker = None
+    if blockchain is not None:
+        from confirmations import ConfirmationTracker
+        tracker = ConfirmationTracker(blockchain, subscriptions)
+        blockchain.add_listener(tracker)
+    timers = TimerWheel()
+    connection = ReplayConnection(capture.peer, "/pyBitcoin:replay/", BoundedStore(), subscriptions,
+                                  BloomFilter(10, 0.001, 0, BloomFilter.UPDATE_NONE), blockchain, None, tracker, None,
+                                  timers=timers)
+    connection.start()
+
+    commands = {}
+    processing = 0.0
+    capture_time = 0.0
+    ticks = 0
+    started = time.time()
+    for timestamp, direction, data in capture:
+        if direction != INCOMING:
+            continue
+        capture_time = timestamp
+        due = int(timestamp / timers.granularity)
+        if due > ticks:
+            timers.advance(due - ticks)
+            ticks = due
+        if realtime:
+            delay = started + timestamp / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if connection.closing:
+            log.warning("Replayed connection was closed with messages left in the capture")
+            break
+        command = data[4:16].rstrip("\x00")
+        start = time.time()
+        connection.receive_data(data)
+        elapsed = time.time() - start
+        processing += elapsed
+        count, size, spent = commands.get(command, (0, 0, 0.0))
+        commands[command] = (count + 1, size + len(data), spent + elapsed)
+
+    return {
+        "messages": sum(c[0] for c in commands.values()),
+        "bytes": sum(c[1] for c in commands.values()),
+        "commands": commands,
+        "capture_sec": capture_time,
+        "processing_sec": processing,
+        "elapsed_sec": time.time() - started,
+        "height": blockchain.get_height() if blockchain is not None else None,
+        "download_complete": connection.downloaded
+    }
+
+
+def copy_database(source, destination):
+    """
+    Copy a sqlite headers database which may be in use. Copying the file misses whatever is still in the write
+    ahead log and can catch a write half done, so the copy is read out through sqlite in a single transaction.
+    """
+    src = sqlite3.connect(source, isolation_level=None)
+    dst = sqlite3.connect(destination)
+    try:
+        src.execute("BEGIN")
+        dst.executescript("\n".join(src.iterdump()))
+        src.execute("ROLLBACK")
+    finally:
+        src.close()
+        dst.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a peer capture")
+    parser.add_argument("capture", help="the capture file")
+    parser.add_argument("--blocks", metavar="FILE", help="a sqlite headers database to replay against (it is copied, not modified)")
+    parser.add_argument("--ignore-tip", action="store_true", help="replay even if the database isn't at the capture's starting tip")
+    parser.add_argument("--realtime", action="store_true", help="replay with the captured timing")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed up realtime replay by this factor")
+    parser.add_argument("--profile", metavar="FILE", help="profile the replay and write the stats to FILE")
+    args = parser.parse_args()
+
+    from blockchain import BlockDatabase
+    from storage import SQLiteStorage
+    testnet = CaptureReader(args.capture).params == "testnet"
+    directory = tempfile.mkdtemp()
+    try:
+        if args.blocks is not None:
+            copy_database(args.blocks, os.path.join(directory, "blocks.db"))
+        bd = BlockDatabase(testnet=testnet, storage=SQLiteStorage(os.path.join(directory, "blocks.db")))
+        if args.profile is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+            stats = profiler.runcall(replay, args.capture, bd, realtime=args.realtime, speed=args.speed,
+                                     check_tip=not args.ignore_tip)
+            profiler.dump_stats(args.profile)
+        else:
+            stats = replay(args.capture, bd, realtime=args.realtime, speed=args.speed, check_tip=not args.ignore_tip)
+    finally:
+        shutil.rmtree(directory)
+
+    for command, (count, size, spent) in sorted(stats["commands"].items(), key=lambda c: -c[1][2]):
+        sys.stdout.write("%-12s %8d msgs %12d bytes %10.3fs\n" % (command, count, size, spent))
+    sys.stdout.write("%d messages, %d bytes in %.3fs (captured over %.3fs), height %s\n" %
+                     (stats["messages"], stats["bytes"], stats["processing_sec"], stats["capture_sec"], stats["height"]))
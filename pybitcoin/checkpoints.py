@@ -0,0 +1,127 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+"""
+import json
+
+# Checkpoints which carry a timestamp and difficulty target are "anchors". A `BlockDatabase` can be started from
+# any anchor since it has everything needed to validate the next block. Anchors should sit on a difficulty retarget
+# boundary (height % 2016 == 0) so that the first retarget after the anchor can be computed. Checkpoints with just a
+# height and hash are only used to verify the headers we download.
+#
+# These tables end in 2015. A new database starts from the last anchor, so with just these tables every header it
+# downloads gets full difficulty validation. Load more recent checkpoints you trust (`Checkpoints.load`) to skip it.
+
+MAINNET_CHECKPOINTS = [
+    {
+        "height": 0,
+        "hash": "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f",
+        "timestamp": 1231006505,
+        "difficulty_target": 486604799
+    },
+    {"height": 11111, "hash": "0000000069e244f73d78e8fd29ba2fd2ed618bd6fa2ee92559f542fdb26e7c1d"},
+    {"height": 33333, "hash": "000000002dd5588a74784eaa7ab0507a18ad16a236e7b1ce69f00d7ddfb5d0a6"},
+    {"height": 74000, "hash": "0000000000573993a3c9e41ce34471c079dcf5f52a0e824a81e7f953b8661a20"},
+    {"height": 105000, "hash": "00000000000291ce28027faea320c8d2b054b2e0fe44a773f3eefb151d6bdc97"},
+    {"height": 134444, "hash": "00000000000005b12ffd4cd315cd34ffd4a594f430ac814c91184a0d42d2b0fe"},
+    {"height": 168000, "hash": "000000000000099e61ea72015e79632f216fe6cb33d7899acb35b75c8303b763"},
+    {"height": 193000, "hash": "000000000000059f452a5f7340de6682a977387c17010ff6e6c3bd83ca8b1317"},
+    {"height": 210000, "hash": "000000000000048b95347e83192f69cf0366076336c639f9b7228e9ba171342e"},
+    {"height": 216116, "hash": "00000000000001b4f4b433e81ee46494af945cf96014816a4e2370f11b23df4e"},
+    {"height": 225430, "hash": "00000000000001c108384350f74090433e7fcf79a606b8e797f065b130575932"},
+    {"height": 250000, "hash": "000000000000003887df1f29024b06fc2200b55f8af8f35453d7be294df2d214"},
+    {"height": 279000, "hash": "0000000000000001ae8c72a0b0c301f67e3afca10e819efa9041e458e9bd7e40"},
+    {"height": 295000, "hash": "00000000000000004d9b4ef50f0f9d686fd69db2e03af35a100370c64632a983"},
+    {
+        "height": 376992,
+        "hash": "0000000000000000021a4323000720f49619762e302aa921f214cd8a4adbfdb4",
+        "timestamp": 1443700390,
+        "difficulty_target": 403838066
+    }
+]
+
+TESTNET_CHECKPOINTS = [
+    {
+        "height": 0,
+        "hash": "000000000933ea01ad0ee984209779baaec3ced90fa3f408719526f8d77f4943",
+        "timestamp": 1296688602,
+        "difficulty_target": 486604799
+    },
+    {"height": 546, "hash": "000000002a936ca763904c3c35fce2f3556c559c0214345d31b1bcebf76acb70"},
+    {
+        "height": 606816,
+        "hash": "00000000000004e40b0b4ae327ecb4532d986542a3d609a3378e7fe576d2f010",
+        "timestamp": 1448160074,
+        "difficulty_target": 436542988
+    }
+]
+
+
+class Checkpoints(object):
+    """
+    A table of known good blocks keyed by height. Headers at a checkpointed height must match the checkpoint
+    hash, and everything at or below the last checkpoint can be accepted on linkage and proof of work alone since
+    the segment is pinned by the checkpoints on either side of it.
+    """
+
+    def __init__(self, entries=()):
+        self._entries = {}
+        self._last_height = -1
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry):
+        if "height" not in entry or "hash" not in entry:
+            raise ValueError("Checkpoint must contain a height and hash")
+        if ("timestamp" in entry) != ("difficulty_target" in entry):
+            raise ValueError("Checkpoint at height %s is missing a timestamp or difficulty target" % entry["height"])
+        existing = self._entries.get(entry["height"])
+        if existing is not None and existing["hash"] != entry["hash"]:
+            raise ValueError("Conflicting checkpoints at height %s" % entry["height"])
+        if existing is None or "timestamp" in entry:
+            self._entries[entry["height"]] = dict(entry)
+        self._last_height = max(self._last_height, entry["height"])
+
+    def load(self, filepath):
+        """
+        Merge the checkpoints from a json file into this table.
+        """
+        with open(filepath, "r") as f:
+            for entry in json.load(f):
+                self.add(entry)
+
+    def get(self, height):
+        return self._entries.get(height)
+
+    def verify(self, height, block_id):
+        """
+        Return False if a checkpoint exists at this height and its hash doesn't match `block_id`.
+        """
+        entry = self._entries.get(height)
+        return entry is None or entry["hash"] == block_id
+
+    def get_last_height(self):
+        return self._last_height
+
+    def get_anchor(self, height=None):
+        """
+        Return the highest anchor at or below `height`. If `height` is None the highest anchor is returned.
+        """
+        anchors = [h for h in self._entries if "timestamp" in self._entries[h] and (height is None or h <= height)]
+        if len(anchors) == 0:
+            raise ValueError("No anchor checkpoint at or below height %s" % height)
+        return self._entries[max(anchors)]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        for height in sorted(self._entries):
+            yield self._entries[height]
+
+
+def get_checkpoints(testnet=False):
+    """
+    Return the built in checkpoint table for the network.
+    """
+    return Checkpoints(TESTNET_CHECKPOINTS if testnet else MAINNET_CHECKPOINTS)
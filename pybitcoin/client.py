@@ -5,55 +5,116 @@ Copyright (c) 2015 Chris Pacia
 import bitcoin
 import random
 from io import BytesIO
-from random import shuffle
-from protocol import PeerFactory
+from protocol import PeerFactory, State, get_timer_wheel
 from twisted.internet import reactor, defer, task
-from discovery import dns_discovery
+from discovery import AddressManager
 from binascii import unhexlify
 from extensions import BloomFilter
 from bitcoin.core import CTransaction
 from bitcoin.net import CInv
 from bitcoin.messages import msg_inv
+from bitcoin.wallet import CBitcoinAddress
 from bitcoin import base58
 from blockchain import BlockDatabase
+from confirmations import ConfirmationTracker
+from rescan import Rescan
+from utxo import UTXOIndex
+from inventory import BoundedStore, TxRecord
+from metrics import get_registry
+from progress import ThrottledDownloadListener
+from compactfilters import FilterMatcher
 from log import *
 from twisted.python import log, logfile
 from zope.interface.verify import verifyObject
 from zope.interface.exceptions import DoesNotImplement
 from listeners import DownloadListener, PeerEventListener
 
+# A peer whose round trip time is above both of these (seconds, multiple of the median) gets replaced.
+SLOW_PEER_RTT = 2.0
+SLOW_PEER_FACTOR = 4
+PEER_CHECK_INTERVAL = 60
+# How many connection attempts to race for each open slot.
+CONNECTION_RACE_FACTOR = 2
+
 
 class BitcoinClient(object):
 
-    def __init__(self, addrs, params="mainnet", blockchain=None, user_agent="/pyBitcoin:0.1/", max_connections=10, subscriptions=[], listeners=[]):
-        self.addrs = addrs
+    def __init__(self, addrs, params="mainnet", blockchain=None, user_agent="/pyBitcoin:0.1/", max_connections=10, subscriptions=[], listeners=[],
+                 confirmation_depth=6, address_manager=None, standby_peers=2, connect_timeout=5, max_inventory=10000,
+                 inventory_ttl=3600, max_tracked_txs=10000, tracked_tx_ttl=86400, capture_dir=None, progress_interval=0.25,
+                 progress_stride=None, filter_mode="bloom", sync_chain=True):
         self.params = params
         self.blockchain = blockchain
         self.user_agent = user_agent
         self.max_connections = max_connections
+        self.standby_peers = standby_peers
+        self.connect_timeout = connect_timeout
         self.testnet = True if params == "testnet" else False
+        self.address_manager = address_manager if address_manager is not None else AddressManager(testnet=self.testnet)
+        self.address_manager.add(addrs)
         self.peers = []
-        self.inventory = {}
+        self.pending_peers = []
+        self.standby = []
+        # If set, each peer connection is recorded to a file in this directory for `capture.replay`.
+        self.capture_dir = capture_dir
+        # Both tables are bounded. Broadcast txs and block hashes waiting on a tx are dropped after `inventory_ttl`
+        # seconds and tracked txs after `tracked_tx_ttl` seconds, oldest first once the caps are reached. The
+        # `evicted` counters on each store show how often that happens.
+        self.inventory = BoundedStore(max_inventory, inventory_ttl)
         self.pending_txs = {}
-        self.subscriptions = {}
+        self.subscriptions = BoundedStore(max_tracked_txs, tracked_tx_ttl)
+        self.tracker = None
+        self.rescans = []
         self.bloom_filter = BloomFilter(10, 0.001, random.getrandbits(32), BloomFilter.UPDATE_NONE)
+        self._filter_reload = None
+        self.utxos = UTXOIndex(self.blockchain, self.subscriptions, self.bloom_filter, self._schedule_filter_reload)
+        # With `filter_mode` "compact" our txs are found by checking each new block's compact filter (BIP157/158)
+        # against our scripts ourselves rather than loading a bloom filter on the peers. Only blocks mined after
+        # we start are checked and unconfirmed txs aren't seen, since the peers relay nothing without a filter.
+        if filter_mode not in ("bloom", "compact"):
+            raise ValueError("Unknown filter mode %s" % filter_mode)
+        self.compact_filters = None
+        if filter_mode == "compact":
+            if self.blockchain is None:
+                raise ValueError("Compact filters require a blockchain")
+            self.compact_filters = FilterMatcher(self.blockchain.get_height() + 1)
+        if self.blockchain is not None:
+            # Subscription callbacks fire on every confirmation until a tx is `confirmation_depth` blocks deep, at
+            # which point it is retired from the subscriptions.
+            self.tracker = ConfirmationTracker(self.blockchain, self.subscriptions, confirmation_depth)
+            self.blockchain.add_listener(self.tracker)
+            self.blockchain.add_listener(self.utxos)
+        # Download progress events are coalesced to one every `progress_interval` seconds, or every
+        # `progress_stride` blocks if that is set. Set both to None to get an event for every block.
+        self.progress_interval = progress_interval
+        self.progress_stride = progress_stride
         self.download_listener = None
         self.peer_event_listener = None
+        self.log = Logger(system=self)
+        self.stopped = False
+        get_registry().add_collector(self._collect_metrics)
         for s in subscriptions:
             self.subscribe_address(s[0], s[1])
         for l in listeners:
             self.add_event_listener(l)
         self._connect_to_peers()
-        if self.blockchain: self._start_chain_download()
+        # With `sync_chain` False someone else keeps the blockchain up to date, like the owner of a
+        # `sharding.SharedChain`, and we only follow new blocks for our subscriptions.
+        if self.blockchain and sync_chain: self._start_chain_download()
+        self.peer_monitor = task.LoopingCall(self._replace_slow_peers)
+        self.peer_monitor.start(PEER_CHECK_INTERVAL, now=False)
         bitcoin.SelectParams(params)
 
     def add_event_listener(self, listener):
         try:
             verifyObject(DownloadListener, listener)
-            self.download_listener = listener
-            for peer in self.peers:
+            download_listener = listener
+            if self.progress_interval is not None or self.progress_stride is not None:
+                download_listener = ThrottledDownloadListener(listener, self.progress_interval, self.progress_stride)
+            self.download_listener = download_listener
+            for peer in self.peers + self.standby + self.pending_peers:
                 if peer.protocol is not None:
-                    peer.protocol.download_listener = listener
+                    peer.protocol.download_listener = download_listener
         except DoesNotImplement:
             pass
         try:
@@ -64,97 +125,339 @@ class BitcoinClient(object):
 
     def _connect_to_peers(self):
         """
-        Will attempt to connect to enough peers to get us up to `max_connections`. This should be called
-        again after we disconnect from a peer to maintain a stable number of peers.
-        """
-        if len(self.peers) < self.max_connections:
-            shuffle(self.addrs)
-            for i in range(self.max_connections - len(self.peers)):
-                if len(self.addrs) > 0:
-                    addr = self.addrs.pop(0)
-                    peer = PeerFactory(self.params, self.user_agent, self.inventory, self.subscriptions,
-                                       self.bloom_filter, self._on_peer_disconnected, self.blockchain, self.download_listener)
-                    reactor.connectTCP(addr[0], addr[1], peer)
-                    self.peers.append(peer)
-                    if self.peer_event_listener is not None:
-                        self.peer_event_listener.on_peer_connected(addr, len(self.peers))
-                else:
-                    # We ran out of addresses and need to hit up the seeds again.
-                    self.addrs = dns_discovery(self.testnet)
-                    self._connect_to_peers()
+        Will attempt enough connections to get us up to `max_connections` active peers plus `standby_peers` spares.
+        We race several attempts for each open slot with a short connect timeout and keep whichever peers finish
+        the version/verack handshake first (see `_on_peer_ready`). This should be called again after we
+        disconnect from a peer to maintain a stable number of peers.
+        """
+        if self.stopped:
+            return
+        wanted = self.max_connections + self.standby_peers - len(self.peers) - len(self.standby)
+        attempts = wanted * CONNECTION_RACE_FACTOR - len(self.pending_peers)
+        if attempts > 0:
+            connected = [peer.addr for peer in self.peers + self.standby + self.pending_peers]
+            for addr in self.address_manager.get_candidates(attempts, exclude=connected):
+                peer = PeerFactory(self.params, self.user_agent, self.inventory, self.subscriptions,
+                                   self.bloom_filter, self._on_peer_disconnected, self.blockchain, self.download_listener,
+                                   self.tracker, self.address_manager, addr, self._on_peer_ready, self.utxos, self.capture_dir,
+                                   self.compact_filters)
+                self.address_manager.mark_attempt(addr)
+                reactor.connectTCP(addr[0], addr[1], peer, timeout=self.connect_timeout)
+                self.pending_peers.append(peer)
+            if len(self.peers) + len(self.pending_peers) < self.max_connections:
+                # We ran out of addresses and need to hit up the seeds again. The lookups run off the reactor
+                # thread so the peers we do have keep working in the meantime.
+                self.address_manager.discover().addCallback(self._on_discovery_complete)
+
+    def _on_peer_ready(self, peer):
+        """
+        Called when a pending peer completes the handshake. It fills an open slot if there is one, otherwise it
+        waits in the standby pool, and if that is full too we don't need it.
+        """
+        if peer not in self.pending_peers:
+            return
+        self.pending_peers.remove(peer)
+        if self.stopped:
+            peer.protocol.lose_connection()
+        elif len(self.peers) < self.max_connections:
+            self._activate_peer(peer)
+        elif len(self.standby) < self.standby_peers:
+            self.standby.append(peer)
+        else:
+            peer.protocol.lose_connection()
+
+    def _activate_peer(self, peer):
+        self.peers.append(peer)
+        if self.peer_event_listener is not None:
+            self.peer_event_listener.on_peer_connected(peer.addr, len(self.peers))
+        self._assign_rescans()
+
+    def _on_discovery_complete(self, new_addresses):
+        if new_addresses > 0:
+            self._connect_to_peers()
+        else:
+            task.deferLater(reactor, 30, self._connect_to_peers)
 
     def get_peer_count(self):
         return len(self.peers)
 
+    def stop(self):
+        """
+        Disconnect from our peers and stop connecting to new ones. The client stops recording metrics and is
+        removed from the blockchain's listeners, the blockchain itself is left open. A stopped client can't be
+        started again.
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        get_registry().remove_collector(self._collect_metrics)
+        if self.peer_monitor.running:
+            self.peer_monitor.stop()
+        if self._filter_reload is not None:
+            self._filter_reload.cancel()
+        if self.blockchain is not None:
+            self.blockchain.remove_listener(self.tracker)
+            self.blockchain.remove_listener(self.utxos)
+        # Pending peers are hung up on when they finish the handshake.
+        for peer in self.peers + self.standby:
+            peer.protocol.lose_connection()
+
+    def _collect_metrics(self, registry):
+        peers = registry.gauge("pybitcoin_peers", "Peer connections in each state", ("state",))
+        peers.set(len(self.peers), ("active",))
+        peers.set(len(self.standby), ("standby",))
+        peers.set(len(self.pending_peers), ("pending",))
+        registry.gauge("pybitcoin_bloom_filter_elements", "Elements inserted into the bloom filter").set(
+            self.bloom_filter.get_element_count())
+        registry.gauge("pybitcoin_bloom_filter_fill_ratio", "Fraction of the bloom filter's bits which are set").set(
+            self.bloom_filter.get_fill_ratio())
+        sizes = registry.gauge("pybitcoin_table_size", "Entries in the inventory and subscription tables", ("table",))
+        evictions = registry.gauge("pybitcoin_table_evictions", "Entries dropped from the inventory and subscription tables",
+                                   ("table", "reason"))
+        for name, table in (("inventory", self.inventory), ("subscriptions", self.subscriptions)):
+            sizes.set(len(table), (name,))
+            for reason, count in table.evicted.items():
+                evictions.set(count, (name, reason))
+        if self.blockchain is not None:
+            height = self.blockchain.get_height()
+            registry.gauge("pybitcoin_chain_height", "Height of our best header").set(height)
+            # How far we are behind the best height our peers told us about.
+            best = max([peer.protocol.version.nStartingHeight for peer in self.peers
+                        if peer.protocol is not None and peer.protocol.version is not None] or [height])
+            registry.gauge("pybitcoin_sync_lag_blocks", "Blocks our peers have which we don't").set(max(best - height, 0))
+
+    def _get_fastest_peers(self):
+        """
+        Return the peers which have completed the handshake, lowest round trip time first. Peers we haven't
+        measured yet go after the ones we have.
+        """
+        ready = [peer for peer in self.peers if peer.protocol is not None and peer.protocol.is_ready()]
+        return sorted(ready, key=lambda peer: (peer.protocol.get_rtt() is None, peer.protocol.get_rtt()))
+
     def _start_chain_download(self):
         """
-        Pick a single peer and download the headers/merkle blocks from it until we are at the tip of the chain.
-        If the peer isn't fully initialized yet, let's pause a second and try again.
+        Pick the fastest peer and download the headers/merkle blocks from it until we are at the tip of the chain.
+        If no peer is fully initialized yet, let's pause a second and try again.
         """
-        shuffle(self.peers)
-        if self.peers[0].protocol is None or self.peers[0].protocol.version is None:
+        if self.stopped:
+            return
+        peers = self._get_fastest_peers()
+        if len(peers) == 0:
             return task.deferLater(reactor, 1, self._start_chain_download)
-        self.peers[0].protocol.download_blocks(self.check_for_more_blocks)
+        peers[0].protocol.download_blocks(self.check_for_more_blocks)
 
     def check_for_more_blocks(self):
         """
         After we finish downloading blocks from our download peer let's check to see if any of our other peers
-        know about any additional blocks. If so, let's download from them as well.
+        know about any additional blocks. If so, let's download from the fastest of them as well.
         """
-        for peer in self.peers:
-            if peer.protocol is not None and peer.protocol.version is not None:
-                if peer.protocol.version.nStartingHeight > self.blockchain.get_height():
-                    peer.protocol.download_blocks(self.check_for_more_blocks)
-                    break
+        for peer in self._get_fastest_peers():
+            if peer.protocol.version.nStartingHeight > self.blockchain.get_height():
+                peer.protocol.download_blocks(self.check_for_more_blocks)
+                break
+
+    def _download_filters(self):
+        """
+        Get the filters checked up to the tip, by the peer already fetching them or else by the fastest one.
+        """
+        if self.compact_filters is None:
+            return
+        if self.compact_filters.peer is not None:
+            return self.compact_filters.peer.download_filters()
+        peers = [peer for peer in self._get_fastest_peers() if peer.protocol.state == State.CONNECTED]
+        if len(peers) > 0:
+            peers[0].protocol.download_filters()
+
+    def _replace_slow_peers(self):
+        """
+        Disconnect the slowest peer if it is much slower than the rest so `_connect_to_peers` can find a better one.
+        We never drop the peer we are downloading from.
+        """
+        peers = [peer for peer in self._get_fastest_peers() if peer.protocol.get_rtt() is not None]
+        if len(peers) < 2:
+            return
+        median = peers[len(peers) / 2].protocol.get_rtt()
+        slowest = peers[-1]
+        rtt = slowest.protocol.get_rtt()
+        if rtt > SLOW_PEER_RTT and rtt > SLOW_PEER_FACTOR * median and slowest.protocol.state != State.DOWNLOADING:
+            self.log.info("Replacing slow peer %s:%s (%.2fs round trip, median %.2fs)" % (slowest.addr[0], slowest.addr[1], rtt, median))
+            self.address_manager.mark_failed(slowest.addr)
+            slowest.protocol.lose_connection()
 
     def _on_peer_disconnected(self, peer):
-        if self.peer_event_listener is not None:
-            ip = (peer.protocol.transport.getPeer().host, peer.protocol.transport.getPeer().port)
-            self.peer_event_listener.on_peer_disconnected(ip, len(self.peers))
-        self.peers.remove(peer)
+        for rescan in self.rescans:
+            rescan.on_peer_lost(peer.protocol)
+        if peer in self.peers:
+            self.peers.remove(peer)
+            # Another peer carries on with the filters if this one was fetching them.
+            self._download_filters()
+            if self.peer_event_listener is not None:
+                self.peer_event_listener.on_peer_disconnected(peer.addr, len(self.peers))
+            # Promote the fastest standby peer so we are back to full strength immediately.
+            standby = sorted(self.standby, key=lambda p: (p.protocol.get_rtt() is None, p.protocol.get_rtt()))
+            if len(standby) > 0:
+                self.standby.remove(standby[0])
+                # It still has the filter from its handshake, which won't have our subscriptions since then.
+                standby[0].protocol.load_filter()
+                self._activate_peer(standby[0])
+            else:
+                self._assign_rescans()
+        elif peer in self.standby:
+            self.standby.remove(peer)
+        elif peer in self.pending_peers:
+            self.pending_peers.remove(peer)
+        else:
+            # A surplus peer we hung up on.
+            return
         self._connect_to_peers()
 
+    def rescan(self, from_height=None, from_timestamp=None):
+        """
+        Scan the blocks from `from_height` (or from the first block mined after `from_timestamp`) up to the tip for
+        txs paying our subscribed addresses. Any we find are passed to the subscription callbacks, so subscribe to
+        the addresses first. The blocks are fetched from all our peers at once using the headers we already have,
+        so only blocks still in the header database can be scanned. Returns a Deferred which fires with the number
+        of blocks scanned.
+        """
+        if self.blockchain is None:
+            raise ValueError("Rescanning requires a blockchain")
+        if from_height is None and from_timestamp is None:
+            raise ValueError("Rescanning requires a from_height or from_timestamp")
+        if from_height is None:
+            # Leave a couple of hours of slack since block timestamps can be that far out of order.
+            from_height = self.blockchain.get_height_at_time(from_timestamp - 7200)
+            if from_height is None:
+                return defer.succeed(0)
+        start = max(from_height, self.blockchain._get_starting_height())
+        if start > from_height:
+            self.log.warning("Blocks below %s have been culled, rescanning from there" % start)
+        if self.compact_filters is not None:
+            return self._rescan_filters(start)
+        return self._rescan(start, self.utxos.outputs_added)
+
+    def _rescan_filters(self, start):
+        # Check the filters again from `start`, including any after it we haven't got to yet.
+        start = min(start, self.compact_filters.scanned_height + 1)
+        tip = self.blockchain.get_height()
+        if start > tip:
+            return defer.succeed(0)
+        self.compact_filters.reset(start)
+        self._download_filters()
+        return self.compact_filters.when_scanned(tip).addCallback(lambda height: height - start + 1)
+
+    def _rescan(self, start, outputs, second_pass=False):
+        rescan = Rescan(self.blockchain, start, self.blockchain.get_height(), self.download_listener)
+        if rescan.is_complete():
+            return defer.succeed(0)
+        self.rescans.append(rescan)
+
+        def on_complete(scanned):
+            self.rescans.remove(rescan)
+            # The batches are downloaded out of order, so a spend of an output we found may have been in a batch
+            # which was filtered before the output went into the filter. Scan once more with the new outputs.
+            if not second_pass and self.utxos.outputs_added > outputs:
+                self._reload_filters()
+                return self._rescan(start, outputs, True)
+            return scanned
+
+        rescan.deferred.addCallback(on_complete)
+        self._assign_rescans()
+        return rescan.deferred
+
+    def _assign_rescans(self):
+        # Peers busy with the chain download are left alone.
+        peers = [peer.protocol for peer in self._get_fastest_peers() if peer.protocol.state == State.CONNECTED]
+        for rescan in self.rescans:
+            rescan.assign(peers)
+
+    def _schedule_filter_reload(self):
+        # New outputs tend to come in bunches (a block or a rescan) so wait a moment and reload the filter once.
+        if self._filter_reload is None or not self._filter_reload.active():
+            self._filter_reload = get_timer_wheel().schedule(1, self._reload_filters)
+
+    def _reload_filters(self):
+        if self._filter_reload is not None:
+            self._filter_reload.cancel()
+        for peer in self.peers:
+            if peer.protocol is not None:
+                peer.protocol.load_filter()
+
+    def get_balance(self, address, min_conf=0):
+        """
+        Return the value in satoshis of the unspent outputs paying a subscribed address with at least `min_conf`
+        confirmations. Outputs spent by an unconfirmed tx count as spent.
+        """
+        return self.utxos.get_balance(address, min_conf)
+
+    def list_unspent(self, address, min_conf=0):
+        """
+        Return the unspent outputs paying a subscribed address as a list of dicts with the outpoint, address,
+        value and confirmations.
+        """
+        return self.utxos.list_unspent(address, min_conf)
+
     def broadcast_tx(self, tx):
         """
-        Sends the tx to half our peers and waits for half of the remainder to
-        announce it via inv packets before calling back.
+        Sends the tx to the fastest half of our peers and waits for half of the
+        remainder to announce it via inv packets before calling back.
+        """
+        deferreds, aggregate = self.broadcast_txs([tx])
+        return deferreds[0]
+
+    def broadcast_txs(self, txs):
+        """
+        Broadcast a list of hex encoded txs together. The fastest half of our peers
+        get a single inv packet for the whole batch and the rest get a single filter
+        reload so we can listen for the announcements. Returns a tuple of a list with
+        one Deferred per tx (in the same order) which fire True once the tx has been
+        announced back to us or False on timeout, and a DeferredList over all of them.
         """
-        def on_peer_anncounce(txid):
-            self.subscriptions[txhash]["announced"] += 1
-            if self.subscriptions[txhash]["announced"] >= self.subscriptions[txhash]["ann_threshold"]:
-                if self.subscriptions[txid]["timeout"].active():
-                    self.subscriptions[txid]["timeout"].cancel()
-                    self.subscriptions[txid]["deferred"].callback(True)
+        # txid -> Deferred for the txs we are still waiting on. The records in `subscriptions` may be evicted
+        # before we get an answer so the deferreds are kept here.
+        pending = {}
 
-        d = defer.Deferred()
-        transaction = CTransaction.stream_deserialize(BytesIO(unhexlify(tx)))
-        txhash = transaction.GetHash()
-        self.inventory[txhash] = transaction
+        def on_peer_announce(txid):
+            record = self.subscriptions[txid]
+            record.announced += 1
+            if record.announced >= record.ann_threshold:
+                if txid in pending:
+                    pending.pop(txid).callback(True)
+                    if len(pending) == 0 and timeout.active():
+                        timeout.cancel()
 
-        cinv = CInv()
-        cinv.type = 1
-        cinv.hash = txhash
+        def on_timeout():
+            for txid in pending.keys():
+                pending.pop(txid).callback(False)
 
+        timeout = get_timer_wheel().schedule(10, on_timeout)
         inv_packet = msg_inv()
-        inv_packet.inv.append(cinv)
-
-        self.bloom_filter.insert(txhash)
-        self.subscriptions[txhash] = {
-            "announced": 0,
-            "ann_threshold": len(self.peers)/4,
-            "callback": on_peer_anncounce,
-            "confirmations": 0,
-            "in_blocks": [],
-            "deferred": d,
-            "timeout": reactor.callLater(10, d.callback, False)
-        }
-
-        for peer in self.peers[len(self.peers)/2:]:
+        deferreds = []
+        for tx in txs:
+            transaction = CTransaction.stream_deserialize(BytesIO(unhexlify(tx)))
+            txhash = transaction.GetHash()
+            if txhash in pending:
+                deferreds.append(pending[txhash])
+                continue
+            self.inventory[txhash] = transaction
+
+            cinv = CInv()
+            cinv.type = 1
+            cinv.hash = txhash
+            inv_packet.inv.append(cinv)
+
+            self.bloom_filter.insert(txhash)
+            self.subscriptions[txhash] = TxRecord(on_peer_announce, len(self.peers)/4, tx=transaction)
+            pending[txhash] = defer.Deferred()
+            deferreds.append(pending[txhash])
+
+        # Announce to the fastest half so the txs propagate quickly and listen for them on the rest.
+        peers = self._get_fastest_peers()
+        for peer in peers[len(peers)/2:]:
             peer.protocol.load_filter()
-        for peer in self.peers[:len(self.peers)/2]:
-            peer.protocol.send_message(inv_packet)
+        for peer in peers[:len(peers)/2]:
+            peer.protocol.send_inv(inv_packet.inv)
 
-        return d
+        return deferreds, defer.DeferredList(deferreds)
 
     def subscribe_address(self, address, callback):
         """
@@ -164,17 +467,23 @@ class BitcoinClient(object):
         """
 
         def on_peer_announce(txhash):
-            if self.subscriptions[txhash]["announced"] < self.subscriptions[txhash]["ann_threshold"] and self.subscriptions[txhash]["confirmations"] == 0:
-                self.subscriptions[txhash]["announced"] += 1
-                if self.subscriptions[txhash]["announced"] >= self.subscriptions[txhash]["ann_threshold"]:
-                    callback(self.subscriptions[txhash]["tx"], self.subscriptions[txhash]["in_blocks"], self.subscriptions[txhash]["confirmations"])
-                    self.subscriptions[txhash]["last_confirmation"] = self.subscriptions[txhash]["confirmations"]
-            elif self.subscriptions[txhash]["confirmations"] > self.subscriptions[txhash]["last_confirmation"]:
-                self.subscriptions[txhash]["last_confirmation"] = self.subscriptions[txhash]["confirmations"]
-                callback(self.subscriptions[txhash]["tx"], self.subscriptions[txhash]["in_blocks"], self.subscriptions[txhash]["confirmations"])
-
-        self.subscriptions[address] = (len(self.peers)/2, on_peer_announce)
+            record = self.subscriptions[txhash]
+            if record.confirmations != record.last_confirmation:
+                # Including a reorg taking it back to no confirmations, which the subscriber needs to hear about.
+                record.last_confirmation = record.confirmations
+                # Once the subscriber has heard about the tx there is no need to count announcements.
+                record.announced = max(record.announced, record.ann_threshold)
+                callback(record.tx, record.in_blocks, record.confirmations)
+            elif record.announced < record.ann_threshold:
+                record.announced += 1
+                if record.announced >= record.ann_threshold:
+                    callback(record.tx, record.in_blocks, record.confirmations)
+
+        # Address subscriptions are pinned so they are never evicted.
+        self.subscriptions.pin(address, (len(self.peers)/2, on_peer_announce))
         self.bloom_filter.insert(base58.decode(address)[1:21])
+        if self.compact_filters is not None:
+            self.compact_filters.add_script(CBitcoinAddress(address).to_scriptPubKey())
         for peer in self.peers:
             if peer.protocol is not None:
                 peer.protocol.load_filter()
@@ -186,9 +495,12 @@ class BitcoinClient(object):
         """
         if address in self.subscriptions:
             self.bloom_filter.remove(base58.decode(address)[1:21])
-            for peer in self.peers:
-                if peer.protocol is not None:
-                    peer.protocol.load_filter()
+            if self.compact_filters is not None:
+                self.compact_filters.remove_script(CBitcoinAddress(address).to_scriptPubKey())
+            for outpoint in self.utxos.unspent.get(address, ()):
+                self.bloom_filter.remove(outpoint)
+            self.utxos.remove_address(address)
+            self._reload_filters()
             del self.subscriptions[address]
 
 
@@ -198,5 +510,5 @@ if __name__ == "__main__":
     log.addObserver(FileLogObserver(logFile).emit)
     log.addObserver(FileLogObserver().emit)
     bd = BlockDatabase("blocks.db", testnet=True)
-    BitcoinClient(dns_discovery(True), params="testnet", blockchain=bd)
+    BitcoinClient([], params="testnet", blockchain=bd, address_manager=AddressManager("peers.json", testnet=True))
     reactor.run()
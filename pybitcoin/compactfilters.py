@@ -0,0 +1,316 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+
+Compact block filters (BIP157/158). Instead of handing our peers a bloom filter and letting them pick out our
+txs, we download a small Golomb-coded filter of the scripts in each block and check our own scripts against it.
+Only blocks which match get downloaded in full. The bandwidth doesn't depend on how many addresses we watch or
+how often they change, and the peers learn nothing about which ones they are.
+"""
+import struct
+from hashlib import sha256
+from io import BytesIO
+from twisted.internet import defer
+from bitcoin.core.serialize import VarIntSerializer
+
+BASIC_FILTER = 0
+BASIC_FILTER_P = 19
+BASIC_FILTER_M = 784931
+# The service bit of peers which serve compact filters.
+NODE_COMPACT_FILTERS = 1 << 6
+
+_MASK = 0xffffffffffffffff
+
+
+def _double_sha256(data):
+    return sha256(sha256(data).digest()).digest()
+
+
+def _rotl(x, b):
+    return ((x << b) | (x >> (64 - b))) & _MASK
+
+
+def siphash(k0, k1, data):
+    """
+    SipHash-2-4 of `data` with the 128 bit key given as two little endian 64 bit halves.
+    """
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+    length = len(data)
+    tail = length & 7
+    words = struct.unpack_from("<%dQ" % (length >> 3), data)
+    last = (length & 0xff) << 56
+    for i, byte in enumerate(bytearray(data[length - tail:])):
+        last |= byte << (8 * i)
+    for m in words + (last,):
+        v3 ^= m
+        for i in (0, 1):
+            v0 = (v0 + v1) & _MASK
+            v1 = _rotl(v1, 13) ^ v0
+            v0 = _rotl(v0, 32)
+            v2 = (v2 + v3) & _MASK
+            v3 = _rotl(v3, 16) ^ v2
+            v0 = (v0 + v3) & _MASK
+            v3 = _rotl(v3, 21) ^ v0
+            v2 = (v2 + v1) & _MASK
+            v1 = _rotl(v1, 17) ^ v2
+            v2 = _rotl(v2, 32)
+        v0 ^= m
+    v2 ^= 0xff
+    for i in (0, 1, 2, 3):
+        v0 = (v0 + v1) & _MASK
+        v1 = _rotl(v1, 13) ^ v0
+        v0 = _rotl(v0, 32)
+        v2 = (v2 + v3) & _MASK
+        v3 = _rotl(v3, 16) ^ v2
+        v0 = (v0 + v3) & _MASK
+        v3 = _rotl(v3, 21) ^ v0
+        v2 = (v2 + v1) & _MASK
+        v1 = _rotl(v1, 17) ^ v2
+        v2 = _rotl(v2, 32)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+class GCSFilter(object):
+    """
+    A Golomb-coded set of the scripts in a block. `key` is the 16 byte SipHash key, the first half of the block
+    hash. Items are hashed into the range [0, N * M) and the sorted differences between them are Golomb-Rice
+    coded with parameter P.
+    """
+
+    def __init__(self, key, n, data, p=BASIC_FILTER_P, m=BASIC_FILTER_M):
+        self.k0, self.k1 = struct.unpack("<QQ", key[:16])
+        self.n = n
+        self.data = data
+        self.p = p
+        self.m = m
+        self.f = n * m
+        self._values = None
+
+    @classmethod
+    def build(cls, key, items, p=BASIC_FILTER_P, m=BASIC_FILTER_M):
+        items = set(items)
+        gcs = cls(key, len(items), "", p, m)
+        values = sorted(gcs._hash(item) for item in items)
+        bits = []
+        last = 0
+        for value in values:
+            delta = value - last
+            last = value
+            bits.extend([1] * (delta >> p) + [0])
+            bits.extend((delta >> i) & 1 for i in range(p - 1, -1, -1))
+        bits.extend([0] * (-len(bits) % 8))
+        data = bytearray(len(bits) / 8)
+        for i, bit in enumerate(bits):
+            if bit:
+                data[i >> 3] |= 0x80 >> (i & 7)
+        gcs.data = str(data)
+        gcs._values = values
+        return gcs
+
+    @classmethod
+    def deserialize(cls, key, raw, p=BASIC_FILTER_P, m=BASIC_FILTER_M):
+        f = BytesIO(raw)
+        n = VarIntSerializer.stream_deserialize(f)
+        return cls(key, n, f.read(), p, m)
+
+    def serialize(self):
+        f = BytesIO()
+        VarIntSerializer.stream_serialize(self.n, f)
+        return f.getvalue() + self.data
+
+    def get_hash(self):
+        return _double_sha256(self.serialize())
+
+    def _hash(self, item):
+        return (siphash(self.k0, self.k1, item) * self.f) >> 64
+
+    def get_values(self):
+        """
+        Decode the filter into its sorted hashed values. They are kept, a filter is only decoded once.
+        """
+        if self._values is None:
+            # Turn the bit stream into a string of 0s and 1s so the unary quotients can be found with str.index,
+            # which is much faster than going bit by bit in Python.
+            bits = bin(int(self.data.encode("hex"), 16))[2:].zfill(len(self.data) * 8) if len(self.data) > 0 else ""
+            values = []
+            value = 0
+            position = 0
+            p = self.p
+            for i in xrange(self.n):
+                end = bits.index("0", position)
+                value += ((end - position) << p) | int(bits[end + 1:end + 1 + p], 2)
+                position = end + 1 + p
+                values.append(value)
+            self._values = values
+        return self._values
+
+    def match_any(self, items):
+        """
+        Return True if any of the items is (probably) in the filter. The items are hashed and sorted and then
+        walked alongside the filter's values, so the cost is one pass over the filter however many items there
+        are.
+        """
+        if self.n == 0 or len(items) == 0:
+            return False
+        queries = sorted(self._hash(item) for item in items)
+        values = self.get_values()
+        i = j = 0
+        while i < len(queries) and j < len(values):
+            if queries[i] == values[j]:
+                return True
+            elif queries[i] < values[j]:
+                i += 1
+            else:
+                j += 1
+        return False
+
+
+def get_filter_elements(block, spent_scripts=()):
+    """
+    Return the items of a basic filter: every output script in the block except OP_RETURNs, plus the scripts of
+    the outputs it spends, which the caller has to supply since they are not in the block.
+    """
+    elements = set(script for script in spent_scripts if len(script) > 0)
+    for tx in block.vtx:
+        for out in tx.vout:
+            script = str(out.scriptPubKey)
+            if len(script) > 0 and script[0] != "\x6a":
+                elements.add(script)
+    return elements
+
+
+def build_basic_filter(block_hash, elements):
+    return GCSFilter.build(block_hash[:16], elements)
+
+
+def get_filter_header(filter_hash, previous_header):
+    return _double_sha256(filter_hash + previous_header)
+
+
+class FilterMatcher(object):
+    """
+    The scripts we are watching and the filter headers we have checked, shared by every peer connection in
+    compact filter mode.
+
+    Filter headers commit to the filter of each block and to the previous filter header, like the block headers
+    themselves. We take the filter hashes from the cfheaders a peer sends, check that they extend the filter
+    header chain we already have and then only accept filters which hash to them.
+    """
+
+    def __init__(self, start_height=0):
+        self.scripts = set()
+        self.start_height = start_height
+        # block hash -> (height, filter hash, filter header)
+        self.filter_headers = {}
+        self.headers_by_height = {}
+        # The heights of the last block we have a filter header for and the last one whose filter we have checked.
+        self.header_height = start_height - 1
+        self.scanned_height = start_height - 1
+        self.matches = 0
+        # The connection fetching filters, if any, and the blocks which matched that we have asked it for.
+        self.peer = None
+        self.pending = set()
+        # (height, Deferred) for everyone waiting on the blocks up to a height being checked.
+        self.waiters = []
+
+    def add_script(self, script):
+        self.scripts.add(str(script))
+
+    def remove_script(self, script):
+        self.scripts.discard(str(script))
+
+    def get_filter_header(self, height):
+        """
+        Return our filter header at `height`, or None if we don't have it.
+        """
+        if height in self.headers_by_height:
+            return self.filter_headers[self.headers_by_height[height]][2]
+        return None
+
+    def add_filter_hashes(self, start_height, block_hashes, filter_hashes, previous_header):
+        """
+        Record the filter hashes of consecutive blocks starting at `start_height`. Returns False, recording
+        nothing, if they don't extend the filter header chain we already have.
+        """
+        ours = self.get_filter_header(start_height - 1)
+        if ours is not None and ours != previous_header:
+            return False
+        header = previous_header
+        for i, (block_hash, filter_hash) in enumerate(zip(block_hashes, filter_hashes)):
+            header = get_filter_header(filter_hash, header)
+            existing = self.filter_headers.get(block_hash)
+            if existing is not None and existing[2] != header:
+                return False
+            self.filter_headers[block_hash] = (start_height + i, filter_hash, header)
+            self.headers_by_height[start_height + i] = block_hash
+        self.header_height = max(self.header_height, start_height + len(filter_hashes) - 1)
+        return True
+
+    def reset(self, start_height):
+        """
+        Forget the filter headers and check the filters again from `start_height`, for a rescan.
+        """
+        self.filter_headers = {}
+        self.headers_by_height = {}
+        self.start_height = start_height
+        self.header_height = start_height - 1
+        self.scanned_height = start_height - 1
+
+    def when_scanned(self, height):
+        """
+        Return a Deferred which fires once the filters up to `height` have been checked and the blocks which
+        matched have been downloaded.
+        """
+        d = defer.Deferred()
+        self.waiters.append((height, d))
+        self._notify()
+        return d
+
+    def _notify(self):
+        if len(self.pending) > 0:
+            return
+        for waiter in [w for w in self.waiters if w[0] <= self.scanned_height]:
+            self.waiters.remove(waiter)
+            waiter[1].callback(self.scanned_height)
+
+    def block_downloaded(self, block_hash):
+        self.pending.discard(block_hash)
+        self._notify()
+
+    def requeue(self):
+        """
+        Check the filters again from the first block we were still waiting on, when the peer we asked for it
+        has gone.
+        """
+        heights = [self.filter_headers[block_hash][0] for block_hash in self.pending if block_hash in self.filter_headers]
+        if len(heights) > 0:
+            self.scanned_height = min(self.scanned_height, min(heights) - 1)
+        self.pending.clear()
+
+    def rewind(self, height):
+        """
+        Forget the filter headers above `height`, after a reorg replaced the blocks they were for.
+        """
+        for h in range(height + 1, self.header_height + 1):
+            self.filter_headers.pop(self.headers_by_height.pop(h, None), None)
+        self.header_height = min(self.header_height, height)
+        self.scanned_height = min(self.scanned_height, height)
+
+    def check_filter(self, block_hash, raw_filter):
+        """
+        Check a filter against its filter hash and our scripts. Returns None if we don't have a filter header
+        for the block or the filter doesn't match it, otherwise whether any of our scripts is in the filter.
+        """
+        entry = self.filter_headers.get(block_hash)
+        if entry is None or _double_sha256(raw_filter) != entry[1]:
+            return None
+        self.scanned_height = max(self.scanned_height, entry[0])
+        matched = GCSFilter.deserialize(block_hash[:16], raw_filter).match_any(self.scripts)
+        if matched:
+            self.matches += 1
+            self.pending.add(block_hash)
+        self._notify()
+        return matched
@@ -0,0 +1,98 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+"""
+from bitcoin.core import b2lx
+from listeners import BlockchainListener
+from metrics import timed_call
+from zope.interface import implementer
+
+
+@implementer(BlockchainListener)
+class ConfirmationTracker(object):
+    """
+    Keeps the confirmation counts of the transactions in `subscriptions` up to date as the chain changes. Each
+    tracked transaction is indexed by the blocks it was seen in, so a new tip only touches the transactions in the
+    top `depth` blocks and a reorg only touches the transactions in the blocks it connected or disconnected. A
+    transaction's callback is only called when its confirmation count actually changes. Once a transaction is
+    `depth` blocks deep it is retired from `subscriptions` (a `BoundedStore`) so we don't hold on to it forever.
+    """
+
+    def __init__(self, blockchain, subscriptions, depth=6):
+        self.blockchain = blockchain
+        self.subscriptions = subscriptions
+        self.depth = depth
+        self.blocks = {}
+        self.subscriptions.on_evict.append(self._on_evict)
+
+    def track(self, txid):
+        """
+        Index a new entry in `subscriptions` by the blocks in its `in_blocks` list and set its confirmations.
+        The callback isn't called, the caller is expected to announce the new entry itself, unless it is already
+        `depth` blocks deep (a rescan finds those). No new tip will ever touch it, so it is announced and retired
+        here and True is returned.
+        """
+        record = self.subscriptions[txid]
+        for block in record.in_blocks:
+            self.blocks.setdefault(b2lx(block), set()).add(txid)
+        record.confirmations = self._get_confirmations(txid)
+        if record.confirmations >= self.depth:
+            timed_call("subscription", record.callback, txid)
+            self.subscriptions.retire(txid)
+            return True
+        return False
+
+    def untrack(self, txid):
+        if txid in self.subscriptions:
+            self._unindex(txid, self.subscriptions[txid])
+
+    def _unindex(self, txid, record):
+        for block in record.in_blocks:
+            block_id = b2lx(block)
+            if block_id in self.blocks:
+                self.blocks[block_id].discard(txid)
+                if len(self.blocks[block_id]) == 0:
+                    del self.blocks[block_id]
+
+    def _on_evict(self, txid, record):
+        # Address subscriptions are pinned so anything evicted from the store is a tx record.
+        self._unindex(txid, record)
+
+    def add_block(self, txid, block):
+        """
+        Record that a tracked transaction was included in `block` (the raw block hash).
+        """
+        if block not in self.subscriptions[txid].in_blocks:
+            self.subscriptions[txid].in_blocks.append(block)
+            self.blocks.setdefault(b2lx(block), set()).add(txid)
+        self._update(txid)
+
+    def _get_confirmations(self, txid):
+        confirms = [self.blockchain.get_confirmations(block) for block in self.subscriptions[txid].in_blocks]
+        return max(confirms) if len(confirms) > 0 else 0
+
+    def _update(self, txid):
+        confirmations = self._get_confirmations(txid)
+        record = self.subscriptions[txid]
+        if confirmations != record.confirmations:
+            record.confirmations = confirmations
+            timed_call("subscription", record.callback, txid)
+        if confirmations >= self.depth:
+            self.subscriptions.retire(txid)
+
+    def _update_blocks(self, block_ids):
+        affected = set()
+        for block_id in block_ids:
+            if block_id in self.blocks:
+                affected.update(self.blocks[block_id])
+        for txid in affected:
+            if txid in self.subscriptions:
+                self._update(txid)
+
+    def on_tip_changed(self, block_id, height):
+        if len(self.blocks) > 0:
+            self._update_blocks([self.blockchain.get_block_id(h) for h in range(max(height - self.depth + 1, 0), height + 1)])
+
+    def on_reorg(self, disconnected, connected):
+        if len(self.blocks) > 0:
+            self._update_blocks([block_id for height, block_id in disconnected + connected])
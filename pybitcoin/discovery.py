@@ -2,7 +2,11 @@ __author__ = 'chris'
 """
 Copyright (c) 2015 Chris Pacia
 """
+import os
+import json
+import time
 import dns.resolver
+from twisted.internet import reactor, defer, threads
 from log import Logger
 
 TESTNET3_SEEDS = [
@@ -19,12 +23,187 @@ MAINNET_SEEDS = [
 ]
 
 
+def resolve_seed(seed):
+    return [str(addr) for addr in dns.resolver.query(seed)]
+
+
 def dns_discovery(testnet=False):
     log = Logger(system="Discovery")
     addrs = []
     for seed in TESTNET3_SEEDS if testnet else MAINNET_SEEDS:
-        answers = dns.resolver.query(seed)
-        for addr in answers:
-            addrs.append((str(addr), 18333 if testnet else 8333))
+        for addr in resolve_seed(seed):
+            addrs.append((addr, 18333 if testnet else 8333))
     log.info("DNS discovery returned %s peers" % len(addrs))
     return addrs
+
+
+class AddressManager(object):
+    """
+    Keeps track of the peer addresses we know about along with their connection history, and hands out the most
+    reliable ones first. Addresses come from the DNS seeds (resolved off the reactor thread), from `addr` messages
+    and from the user. If a `filepath` is given the table is saved there so a restart can reconnect without
+    touching DNS at all.
+
+    `resolver` is called with a seed hostname and should return a list of ip strings or a Deferred firing with one.
+    It defaults to resolving with dnspython in a thread.
+    """
+
+    def __init__(self, filepath=None, testnet=False, resolver=None, max_addresses=2500):
+        self.filepath = filepath
+        self.testnet = testnet
+        self.port = 18333 if testnet else 8333
+        self.resolver = resolver or (lambda seed: threads.deferToThread(resolve_seed, seed))
+        self.max_addresses = max_addresses
+        self.addresses = {}
+        self.discovering = None
+        self._save_call = None
+        self.log = Logger(system=self)
+        if filepath is not None and os.path.exists(filepath):
+            self.load()
+
+    def add(self, addrs, timestamp=None):
+        """
+        Add (ip, port) tuples to the table. Returns the number of addresses which were new to us.
+        """
+        now = time.time()
+        new = 0
+        for addr in addrs:
+            addr = (str(addr[0]), int(addr[1]))
+            seen = min(timestamp or now, now)
+            if addr not in self.addresses:
+                self.addresses[addr] = {
+                    "last_seen": seen,
+                    "last_attempt": 0,
+                    "last_success": 0,
+                    "attempts": 0,
+                    "successes": 0,
+                    "failures": 0
+                }
+                new += 1
+            else:
+                self.addresses[addr]["last_seen"] = max(self.addresses[addr]["last_seen"], seen)
+        if len(self.addresses) > self.max_addresses:
+            self._evict(now)
+        if new > 0:
+            self._schedule_save()
+        return new
+
+    def mark_attempt(self, addr):
+        if addr in self.addresses:
+            self.addresses[addr]["last_attempt"] = time.time()
+            self.addresses[addr]["attempts"] += 1
+
+    def mark_good(self, addr):
+        """
+        Called once we complete a handshake with the peer.
+        """
+        if addr not in self.addresses:
+            self.add([addr])
+        info = self.addresses[addr]
+        info["last_success"] = info["last_seen"] = time.time()
+        info["successes"] += 1
+        info["failures"] = 0
+        self._schedule_save()
+
+    def mark_failed(self, addr):
+        if addr in self.addresses:
+            self.addresses[addr]["failures"] += 1
+            self._schedule_save()
+
+    def _score(self, info, now):
+        # Laplace smoothed success rate which decays with the time since we last saw the peer alive.
+        reliability = (info["successes"] + 1.0) / (info["attempts"] + 2.0)
+        age = now - max(info["last_success"], info["last_seen"])
+        return reliability / (1.0 + max(age, 0) / 86400.0)
+
+    def _is_terrible(self, info, now):
+        return info["failures"] >= 10 and now - info["last_success"] > 7 * 24 * 60 * 60
+
+    def _evict(self, now):
+        ranked = sorted(self.addresses, key=lambda a: (not self._is_terrible(self.addresses[a], now),
+                                                        self._score(self.addresses[a], now)))
+        for addr in ranked[:len(self.addresses) - self.max_addresses]:
+            del self.addresses[addr]
+
+    def get_candidates(self, count, exclude=()):
+        """
+        Return up to `count` addresses ranked by recent reliability. Addresses which failed recently are held back
+        with an exponential backoff. If every address is backing off, the ones due back soonest are returned.
+        """
+        now = time.time()
+        candidates = []
+        backing_off = []
+        for addr, info in self.addresses.iteritems():
+            if addr in exclude or self._is_terrible(info, now):
+                continue
+            retry_at = info["last_attempt"] + 60 * 2 ** min(info["failures"], 10)
+            if info["failures"] > 0 and now < retry_at:
+                backing_off.append((retry_at, addr))
+                continue
+            candidates.append(addr)
+        if len(candidates) == 0:
+            # Most likely our own connection was down and everything failed at once. The backoff goes up to
+            # 17 hours, so rather than sit it out try again with the peers which would have been next.
+            return [addr for retry_at, addr in sorted(backing_off)[:count]]
+        candidates.sort(key=lambda a: self._score(self.addresses[a], now), reverse=True)
+        return candidates[:count]
+
+    def discover(self):
+        """
+        Resolve the DNS seeds without blocking the reactor. Returns a Deferred which fires with the number of new
+        addresses. Calls made while a discovery is already running share its result.
+        """
+        if self.discovering is not None:
+            d = defer.Deferred()
+
+            def share(result):
+                d.callback(result)
+                return result
+            self.discovering.addBoth(share)
+            return d
+
+        def on_resolved(results):
+            addrs = []
+            for success, answers in results:
+                if success:
+                    addrs.extend([(ip, self.port) for ip in answers])
+            self.log.info("DNS discovery returned %s peers" % len(addrs))
+            self.discovering = None
+            return self.add(addrs)
+
+        seeds = TESTNET3_SEEDS if self.testnet else MAINNET_SEEDS
+        self.discovering = defer.DeferredList([defer.maybeDeferred(self.resolver, seed) for seed in seeds],
+                                              consumeErrors=True).addCallback(on_resolved)
+        return self.discovering
+
+    def _schedule_save(self):
+        if self.filepath is not None and (self._save_call is None or not self._save_call.active()):
+            self._save_call = reactor.callLater(10, self.save)
+
+    def save(self):
+        if self.filepath is None:
+            return
+        if self._save_call is not None and self._save_call.active():
+            self._save_call.cancel()
+        entries = []
+        for addr, info in self.addresses.iteritems():
+            entry = dict(info)
+            entry["ip"], entry["port"] = addr
+            entries.append(entry)
+        with open(self.filepath + ".tmp", "w") as outfile:
+            json.dump(entries, outfile)
+        os.rename(self.filepath + ".tmp", self.filepath)
+
+    def load(self):
+        try:
+            with open(self.filepath, "r") as f:
+                entries = json.load(f)
+        except ValueError:
+            self.log.warning("Could not parse %s, starting with an empty address table" % self.filepath)
+            return
+        for entry in entries:
+            addr = (str(entry.pop("ip")), entry.pop("port"))
+            self.addresses[addr] = entry
+
+    def __len__(self):
+        return len(self.addresses)
@@ -6,8 +6,8 @@ import random
 import struct
 import bitcoin
 import math
-from bitcoin.core import CBlockHeader, b2x
-from bitcoin.messages import msg_version, MsgSerializable
+from bitcoin.core import CBlockHeader, b2x, b2lx
+from bitcoin.messages import msg_version, msg_headers, MsgSerializable
 from bitcoin.core.serialize import VarStringSerializer, VarIntSerializer, ser_read
 from bitcoin.bloom import CBloomFilter
 from hashlib import sha256
@@ -107,7 +107,9 @@ class msg_filterload(MsgSerializable):
 class BloomFilter(CBloomFilter):
     """
     An extension of the python-bitcoinlib CBloomFilter class to allow for
-    removal of inserted objects.
+    removal of inserted objects. The filter is rebuilt twice the size whenever
+    more elements go in than it was sized for, so the false positive rate
+    stays at `nFPRate` however many we add.
     """
 
     def __init__(self, nElements, nFPRate, nTweak, nFlags):
@@ -133,21 +135,48 @@ class BloomFilter(CBloomFilter):
             self.vData[nIndex >> 3] |= self.__bit_mask[7 & nIndex]
 
         self._elements.append(elem)
+        if len(self._elements) > self.nElements:
+            self._rebuild(2 * len(self._elements))
 
     def remove(self, elem):
         """
         Remove an element from the bloom filter. Works by clearing the filter and re-inserting
         the elements that weren't removed.
         """
+        self.remove_all([elem])
+
+    def remove_all(self, elems):
+        """
+        Remove several elements at once, rebuilding the filter only once.
+        """
+        removed = set(elem.serialize() if isinstance(elem, bitcoin.core.COutPoint) else elem for elem in elems)
+        elements = [element for element in self._elements if element not in removed]
+        if len(elements) < len(self._elements):
+            self._elements = elements
+            self._rebuild(self.nElements)
+
+    def _rebuild(self, nElements):
         LN2SQUARED = 0.4804530139182014246671025263266649717305529515945455
         LN2 = 0.6931471805599453094172321214581765680755001343602552
-        if elem in self._elements:
-            self._elements.remove(elem)
-            self.vData = bytearray(int(min(-1  / LN2SQUARED * self.nElements * math.log(self.nFPRate), self.MAX_BLOOM_FILTER_SIZE * 8) / 8))
-            self.nHashFuncs = int(min(len(self.vData) * 8 / self.nElements * LN2, self.MAX_HASH_FUNCS))
+        self.nElements = nElements
+        self.vData = bytearray(int(min(-1  / LN2SQUARED * self.nElements * math.log(self.nFPRate), self.MAX_BLOOM_FILTER_SIZE * 8) / 8))
+        # Past the maximum size the sum rounds down to no hash functions at all, which would match nothing.
+        self.nHashFuncs = max(int(min(len(self.vData) * 8 / self.nElements * LN2, self.MAX_HASH_FUNCS)), 1)
 
-            for element in self._elements:
-                self.insert(element)
+        # insert() appends to the element list so start it again rather than looping over it forever.
+        elements, self._elements = self._elements, []
+        for element in elements:
+            self.insert(element)
+
+    def get_element_count(self):
+        return len(self._elements)
+
+    def get_fill_ratio(self):
+        """
+        Return the fraction of the filter's bits which are set. The false positive rate climbs quickly as this
+        approaches 1.
+        """
+        return sum(bin(b).count("1") for b in self.vData) / float(len(self.vData) * 8)
 
 
 class CMerkleBlock(CBlockHeader):
@@ -290,3 +319,137 @@ class msg_merkleblock(MsgSerializable):
 
     def __repr__(self):
         return "msg_merkleblock(header=%s)" % (repr(self.block.get_header()))
+
+
+class msg_headers2(msg_headers):
+    """
+    The headers message as peers actually send it. Each header is followed by a tx count (always zero) which
+    the python-bitcoinlib class doesn't expect.
+    """
+
+    @classmethod
+    def msg_deser(cls, f, protover=PROTO_VERSION):
+        c = cls()
+        for i in range(VarIntSerializer.stream_deserialize(f)):
+            c.headers.append(CBlockHeader.stream_deserialize(f))
+            VarIntSerializer.stream_deserialize(f)
+        return c
+
+    def msg_ser(self, f):
+        VarIntSerializer.stream_serialize(len(self.headers), f)
+        for header in self.headers:
+            header.stream_serialize(f)
+            VarIntSerializer.stream_serialize(0, f)
+
+
+class msg_sendheaders(MsgSerializable):
+    """
+    Asks the peer to announce new blocks with a headers message rather than an inv (BIP130). Missing from
+    python-bitcoinlib.
+    """
+    command = b"sendheaders"
+
+    def __init__(self, protover=PROTO_VERSION):
+        super(msg_sendheaders, self).__init__(protover)
+
+    @classmethod
+    def msg_deser(cls, f, protover=PROTO_VERSION):
+        return cls()
+
+    def msg_ser(self, f):
+        pass
+
+    def __repr__(self):
+        return "msg_sendheaders()"
+
+
+class msg_getcfilters(MsgSerializable):
+    """
+    Asks for the compact filters of the blocks from `start_height` up to `stop_hash` (BIP157). Missing from
+    python-bitcoinlib, as are the rest of the compact filter messages.
+    """
+    command = b"getcfilters"
+
+    def __init__(self, protover=PROTO_VERSION, filter_type=0, start_height=0, stop_hash=b"\x00" * 32):
+        super(msg_getcfilters, self).__init__(protover)
+        self.filter_type = filter_type
+        self.start_height = start_height
+        self.stop_hash = stop_hash
+
+    @classmethod
+    def msg_deser(cls, f, protover=PROTO_VERSION):
+        filter_type, start_height = struct.unpack(b"<BI", ser_read(f, 5))
+        return cls(protover, filter_type, start_height, ser_read(f, 32))
+
+    def msg_ser(self, f):
+        f.write(struct.pack(b"<BI", self.filter_type, self.start_height))
+        f.write(self.stop_hash)
+
+    def __repr__(self):
+        return "%s(filter_type=%i start_height=%i stop_hash=%s)" % (self.__class__.__name__, self.filter_type,
+                                                                   self.start_height, b2lx(self.stop_hash))
+
+
+class msg_getcfheaders(msg_getcfilters):
+    """
+    Asks for the filter hashes of the blocks from `start_height` up to `stop_hash`, along with the filter header
+    of the block before them.
+    """
+    command = b"getcfheaders"
+
+
+class msg_cfilter(MsgSerializable):
+    command = b"cfilter"
+
+    def __init__(self, protover=PROTO_VERSION, filter_type=0, block_hash=b"\x00" * 32, filter=b""):
+        super(msg_cfilter, self).__init__(protover)
+        self.filter_type = filter_type
+        self.block_hash = block_hash
+        self.filter = filter
+
+    @classmethod
+    def msg_deser(cls, f, protover=PROTO_VERSION):
+        filter_type = struct.unpack(b"<B", ser_read(f, 1))[0]
+        block_hash = ser_read(f, 32)
+        return cls(protover, filter_type, block_hash, VarStringSerializer.stream_deserialize(f))
+
+    def msg_ser(self, f):
+        f.write(struct.pack(b"<B", self.filter_type))
+        f.write(self.block_hash)
+        VarStringSerializer.stream_serialize(self.filter, f)
+
+    def __repr__(self):
+        return "msg_cfilter(filter_type=%i block_hash=%s filter=%s)" % (self.filter_type, b2lx(self.block_hash),
+                                                                        b2x(self.filter))
+
+
+class msg_cfheaders(MsgSerializable):
+    command = b"cfheaders"
+
+    def __init__(self, protover=PROTO_VERSION, filter_type=0, stop_hash=b"\x00" * 32, previous_header=b"\x00" * 32,
+                 filter_hashes=None):
+        super(msg_cfheaders, self).__init__(protover)
+        self.filter_type = filter_type
+        self.stop_hash = stop_hash
+        self.previous_header = previous_header
+        self.filter_hashes = filter_hashes if filter_hashes is not None else []
+
+    @classmethod
+    def msg_deser(cls, f, protover=PROTO_VERSION):
+        filter_type = struct.unpack(b"<B", ser_read(f, 1))[0]
+        stop_hash = ser_read(f, 32)
+        previous_header = ser_read(f, 32)
+        filter_hashes = [ser_read(f, 32) for i in range(VarIntSerializer.stream_deserialize(f))]
+        return cls(protover, filter_type, stop_hash, previous_header, filter_hashes)
+
+    def msg_ser(self, f):
+        f.write(struct.pack(b"<B", self.filter_type))
+        f.write(self.stop_hash)
+        f.write(self.previous_header)
+        VarIntSerializer.stream_serialize(len(self.filter_hashes), f)
+        for filter_hash in self.filter_hashes:
+            f.write(filter_hash)
+
+    def __repr__(self):
+        return "msg_cfheaders(filter_type=%i stop_hash=%s filter_hashes=%i)" % (self.filter_type, b2lx(self.stop_hash),
+                                                                               len(self.filter_hashes))
@@ -0,0 +1,362 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+
+A scriptable in-process peer for benchmarks. It speaks just enough of the protocol to sync a client from a synthetic
+chain: the version/verack handshake, headers, filtered blocks with the matching txs, compact filters and full
+blocks, tx relay and pings.
+"""
+import os
+import random
+from hashlib import sha256
+from twisted.internet import reactor, defer
+from twisted.internet.protocol import Protocol, ServerFactory
+from bitcoin.core import CBlock, CMutableTransaction, CMutableTxIn, CMutableTxOut, COutPoint
+from bitcoin.core.script import CScript
+from bitcoin.messages import messagemap, MsgSerializable, msg_verack, msg_inv, msg_tx, msg_ping, msg_pong, msg_getdata, msg_block
+from bitcoin.net import CInv
+from extensions import msg_version2, msg_filterload, msg_merkleblock, msg_headers2, msg_sendheaders, CMerkleBlock, MsgHeader
+from extensions import msg_getcfilters, msg_getcfheaders, msg_cfilter, msg_cfheaders
+from compactfilters import BASIC_FILTER, NODE_COMPACT_FILTERS, build_basic_filter, get_filter_elements, get_filter_header
+
+messagemap["filterload"] = msg_filterload
+messagemap["headers"] = msg_headers2
+messagemap["sendheaders"] = msg_sendheaders
+messagemap["getcfilters"] = msg_getcfilters
+messagemap["getcfheaders"] = msg_getcfheaders
+
+
+def _hash(data):
+    return sha256(sha256(data).digest()).digest()
+
+
+def _tree_width(count, height):
+    return (count + (1 << height) - 1) >> height
+
+
+def build_partial_merkle_tree(txids, matches):
+    """
+    Return the merkle root of `txids` and the (hashes, flags) of the BIP37 partial merkle tree proving the txids
+    at the indexes in `matches`. The flags are padded to a whole number of bytes.
+    """
+    matches = set(matches)
+    hashes = []
+    flags = []
+
+    def calc_hash(height, pos):
+        if height == 0:
+            return txids[pos]
+        left = calc_hash(height - 1, pos * 2)
+        right = calc_hash(height - 1, pos * 2 + 1) if pos * 2 + 1 < _tree_width(len(txids), height - 1) else left
+        return _hash(left + right)
+
+    def traverse(height, pos):
+        parent_of_match = any(i in matches for i in range(pos << height, min((pos + 1) << height, len(txids))))
+        flags.append(1 if parent_of_match else 0)
+        if height == 0 or not parent_of_match:
+            hashes.append(calc_hash(height, pos))
+        else:
+            traverse(height - 1, pos * 2)
+            if pos * 2 + 1 < _tree_width(len(txids), height - 1):
+                traverse(height - 1, pos * 2 + 1)
+
+    height = 0
+    while _tree_width(len(txids), height) > 1:
+        height += 1
+    traverse(height, 0)
+    flags += [0] * (-len(flags) % 8)
+    return calc_hash(height, 0), hashes, flags
+
+
+def _tx_message(tx):
+    message = msg_tx()
+    message.tx = tx
+    return message
+
+
+def make_payment(script_pubkey, value=100000):
+    """
+    Return a tx with a random input paying `value` to `script_pubkey`.
+    """
+    return CMutableTransaction([CMutableTxIn(COutPoint(os.urandom(32), 0))], [CMutableTxOut(value, script_pubkey)])
+
+
+def _random_script():
+    return CScript("\x76\xa9\x14" + os.urandom(20) + "\x88\xac")
+
+
+class SyntheticChain(object):
+    """
+    A chain of blocks for a `FakePeer` to serve. Each block has `txs_per_block` txs and on average
+    `match_density` of them pay `script_pubkey`, so they match the client's filter and are sent along with the
+    filtered block. `generator` is a `benchmark.HeaderChainGenerator`.
+
+    With `full_blocks` every tx is real, paying a random script, so the peer can serve the full blocks. Their
+    compact filters and filter headers are worked out as the blocks are mined.
+    """
+
+    def __init__(self, generator, count, txs_per_block=1, match_density=0.0, script_pubkey=None, seed=0, full_blocks=False):
+        self.generator = generator
+        self.txs_per_block = txs_per_block
+        self.match_density = match_density
+        self.script_pubkey = script_pubkey
+        self.full_blocks = full_blocks
+        self.rand = random.Random(seed)
+        self.matched = {}
+        self.trees = {}
+        self.blocks = {}
+        self.filters = {}
+        # The filter header of each height, starting with the genesis block's.
+        self.filter_headers = []
+        self.headers = []
+        # The genesis block sits just before the first header.
+        self.heights = {generator.genesis.GetHash(): -1}
+        self.genesis = generator.genesis
+        if full_blocks:
+            self._add_filter(self.genesis.GetHash(), [])
+        self.extend(count)
+
+    def extend(self, count):
+        """
+        Mine `count` more blocks on top of the chain and return their headers.
+        """
+        roots = []
+        for i in range(count):
+            txids = []
+            txs = []
+            matched = []
+            for j in range(self.txs_per_block):
+                if self.script_pubkey is not None and self.rand.random() < self.match_density:
+                    tx = make_payment(self.script_pubkey)
+                    matched.append(tx)
+                elif self.full_blocks:
+                    tx = make_payment(_random_script())
+                else:
+                    txids.append(os.urandom(32))
+                    continue
+                txs.append(tx)
+                txids.append(tx.GetHash())
+            root, hashes, flags = build_partial_merkle_tree(txids, [txids.index(tx.GetHash()) for tx in matched])
+            roots.append((root, len(txids), hashes, flags, matched, txs))
+        parent = self.headers[-1] if len(self.headers) > 0 else None
+        headers = self.generator.extend(count, parent, merkle_roots=[r[0] for r in roots])
+        for header, (root, ntx, hashes, flags, matched, txs) in zip(headers, roots):
+            self.heights[header.GetHash()] = len(self.headers)
+            self.headers.append(header)
+            self.trees[header.GetHash()] = (ntx, hashes, flags)
+            self.matched[header.GetHash()] = matched
+            if self.full_blocks:
+                self.blocks[header.GetHash()] = txs
+                self._add_filter(header.GetHash(), txs)
+        return headers
+
+    def _add_filter(self, block_hash, txs):
+        # The inputs are made up, so only the outputs go in the filter.
+        self.filters[block_hash] = build_basic_filter(block_hash, get_filter_elements(CBlock(vtx=txs))).serialize()
+        previous = self.filter_headers[-1] if len(self.filter_headers) > 0 else "\x00" * 32
+        self.filter_headers.append(get_filter_header(_hash(self.filters[block_hash]), previous))
+
+    def get_match_count(self):
+        return sum(len(txs) for txs in self.matched.values())
+
+    def get_merkle_block(self, block_hash):
+        header = self.headers[self.heights[block_hash]]
+        ntx, hashes, flags = self.trees[block_hash]
+        return CMerkleBlock(header.nVersion, header.hashPrevBlock, header.hashMerkleRoot, header.nTime, header.nBits,
+                            header.nNonce, ntx, list(hashes), list(flags))
+
+    def get_block(self, block_hash):
+        header = self.headers[self.heights[block_hash]]
+        return CBlock(header.nVersion, header.hashPrevBlock, header.hashMerkleRoot, header.nTime, header.nBits,
+                      header.nNonce, self.blocks[block_hash])
+
+    def get_block_hash(self, height):
+        """
+        Return the hash of the block at `height`, counting the genesis block as height 0 like the client does.
+        """
+        return self.genesis.GetHash() if height == 0 else self.headers[height - 1].GetHash()
+
+    def get_after(self, locator, count):
+        """
+        Return up to `count` headers following the first block in the locator we know about.
+        """
+        start = 0
+        for block_hash in locator.vHave:
+            if block_hash in self.heights:
+                start = self.heights[block_hash] + 1
+                break
+        return self.headers[start:start + count]
+
+
+class FakePeer(Protocol):
+    """
+    Serves the factory's chain and mempool. Everything we are asked for is answered in order, so a ping sent
+    after a batch of messages is answered once the client has processed the batch.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.received = {}
+        self.prefers_headers = False
+
+    def connectionMade(self):
+        version = msg_version2(70012, "/FakePeer:0.1/", nStartingHeight=len(self.factory.chain.headers) if self.factory.chain else 0)
+        version.nServices = 1 | NODE_COMPACT_FILTERS if self.factory.chain is not None and self.factory.chain.full_blocks else 1
+        self.send(version)
+        self.factory.peers.append(self)
+
+    def connectionLost(self, reason):
+        if self in self.factory.peers:
+            self.factory.peers.remove(self)
+
+    def send(self, message):
+        self.transport.write(message.to_bytes())
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while len(self.buffer) >= 24:
+            header = MsgHeader.from_bytes(self.buffer)
+            if len(self.buffer) < header.msglen + 24:
+                return
+            raw, self.buffer = self.buffer[:header.msglen + 24], self.buffer[header.msglen + 24:]
+            m = MsgSerializable.from_bytes(raw)
+            self.received[header.command] = self.received.get(header.command, 0) + 1
+            handler = getattr(self, "on_" + header.command, None)
+            if m is not None and handler is not None:
+                handler(m)
+
+    def on_version(self, m):
+        self.send(msg_verack())
+
+    def on_ping(self, m):
+        self.send(msg_pong(nonce=m.nonce))
+
+    def on_pong(self, m):
+        callback = self.factory.pong_callbacks.pop(m.nonce, None)
+        if callback is not None:
+            callback()
+
+    def on_getheaders(self, m):
+        reply = msg_headers2()
+        reply.headers = self.factory.chain.get_after(m.locator, 2000)
+        self.send(reply)
+
+    def on_sendheaders(self, m):
+        self.prefers_headers = True
+
+    def on_getblocks(self, m):
+        reply = msg_inv()
+        for header in self.factory.chain.get_after(m.locator, 500):
+            reply.inv.append(self._inv(2, header.GetHash()))
+        self.send(reply)
+
+    def on_getcfheaders(self, m):
+        chain = self.factory.chain
+        stop = chain.heights[m.stop_hash] + 1
+        reply = msg_cfheaders(filter_type=BASIC_FILTER, stop_hash=m.stop_hash,
+                              previous_header=chain.filter_headers[m.start_height - 1])
+        reply.filter_hashes = [_hash(chain.filters[chain.get_block_hash(height)]) for height in range(m.start_height, stop + 1)]
+        self.send(reply)
+
+    def on_getcfilters(self, m):
+        chain = self.factory.chain
+        for height in range(m.start_height, chain.heights[m.stop_hash] + 2):
+            block_hash = chain.get_block_hash(height)
+            self.send(msg_cfilter(filter_type=BASIC_FILTER, block_hash=block_hash, filter=chain.filters[block_hash]))
+
+    def on_getdata(self, m):
+        for item in m.inv:
+            if item.type == 2 and self.factory.chain is not None:
+                reply = msg_block()
+                reply.block = self.factory.chain.get_block(item.hash)
+                self.send(reply)
+            elif item.type == 3 and self.factory.chain is not None:
+                reply = msg_merkleblock()
+                reply.block = self.factory.chain.get_merkle_block(item.hash)
+                self.send(reply)
+                for tx in self.factory.chain.matched[item.hash]:
+                    self.send(_tx_message(tx))
+            elif item.type == 1 and item.hash in self.factory.mempool:
+                self.send(_tx_message(self.factory.mempool[item.hash]))
+
+    def on_inv(self, m):
+        # Fetch any tx the client announces so it goes around the rest of the network.
+        request = msg_getdata()
+        request.inv = [item for item in m.inv if item.type == 1 and item.hash not in self.factory.mempool]
+        if len(request.inv) > 0:
+            self.send(request)
+
+    def on_tx(self, m):
+        self.factory.relay(m.tx, self)
+
+    def _inv(self, type, hash):
+        item = CInv()
+        item.type = type
+        item.hash = hash
+        return item
+
+    def announce(self, txs):
+        """
+        Announce the txs in a single inv packet.
+        """
+        packet = msg_inv()
+        packet.inv = [self._inv(1, tx.GetHash()) for tx in txs]
+        self.send(packet)
+
+    def announce_blocks(self, headers):
+        """
+        Announce new blocks the way the client asked for, with their headers after a sendheaders or an inv.
+        """
+        if self.prefers_headers:
+            packet = msg_headers2()
+            packet.headers = headers
+        else:
+            packet = msg_inv()
+            packet.inv = [self._inv(2, header.GetHash()) for header in headers]
+        self.send(packet)
+
+    def ping(self, callback):
+        nonce = random.getrandbits(64)
+        self.factory.pong_callbacks[nonce] = callback
+        self.send(msg_ping(nonce=nonce))
+
+
+class FakeNetwork(ServerFactory):
+    """
+    Listens on localhost and hands every connection a `FakePeer` sharing the same chain and mempool. A tx sent to
+    any of them is announced by all the others, like it propagated through the network.
+    """
+
+    protocol = FakePeer
+
+    def __init__(self, chain=None):
+        self.chain = chain
+        self.mempool = {}
+        self.peers = []
+        self.pong_callbacks = {}
+        self.ports = []
+
+    def listen(self, count=1):
+        """
+        Start `count` listeners and return their addresses.
+        """
+        addresses = []
+        for i in range(count):
+            port = reactor.listenTCP(0, self, interface="127.0.0.1")
+            self.ports.append(port)
+            addresses.append(("127.0.0.1", port.getHost().port))
+        return addresses
+
+    def stop_listening(self):
+        """
+        Close every listener. Returns a Deferred which fires once they have all stopped.
+        """
+        ports, self.ports = self.ports, []
+        return defer.gatherResults([defer.maybeDeferred(port.stopListening) for port in ports])
+
+    def relay(self, tx, source):
+        if tx.GetHash() not in self.mempool:
+            self.mempool[tx.GetHash()] = tx
+            for peer in self.peers:
+                if peer is not source:
+                    peer.announce([tx])
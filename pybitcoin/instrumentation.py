@@ -0,0 +1,232 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+
+Finds out what is holding up the reactor. Every peer, the blockchain and the subscriber callbacks share the one
+reactor thread, so a slow save or a heavy callback delays everybody's timeouts and can get healthy peers dropped
+for being unresponsive.
+
+`enable_instrumentation` turns on everything here:
+
+  * a `StallDetector` which measures how late the reactor runs and logs where it was stuck when it stalls,
+  * timing of each message handler and listener callback, recorded in the metrics registry,
+  * SIGUSR2 to start and stop a profile of the reactor thread, written to disk.
+
+`serve_metrics` serves the metrics registry for Prometheus to scrape.
+"""
+import os
+import sys
+import time
+import signal
+import thread
+import cProfile
+import threading
+import traceback
+from twisted.internet import reactor, task
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from metrics import get_registry, enable_call_timing, CONTENT_TYPE
+from log import Logger
+
+_registry = get_registry()
+REACTOR_LAG = _registry.histogram("pybitcoin_reactor_lag_seconds", "How late the reactor ran a call scheduled for now",
+                                  buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+REACTOR_STALLS = _registry.counter("pybitcoin_reactor_stalls_total", "Times the reactor was blocked for longer than the threshold")
+
+_log = Logger(system="instrumentation")
+
+
+def _format_stack(frame, limit=30):
+    return "".join(traceback.format_stack(frame, limit)).rstrip()
+
+
+class StallDetector(object):
+    """
+    Runs a heartbeat on the reactor every `interval` seconds and records how late each beat is. A watchdog thread
+    checks on the heartbeat and if the reactor hasn't got to it within `threshold` seconds it takes a sample of
+    the reactor thread's stack. The samples are logged once the reactor is free again, along with how long the
+    stall lasted, so the log shows what the reactor was stuck doing. Call `start` from the reactor thread.
+    """
+
+    def __init__(self, threshold=0.25, interval=0.05, max_samples=5):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_samples = max_samples
+        self.reactor_thread = None
+        self.last_beat = None
+        self.samples = []
+        self.stalls = 0
+        self.max_lag = 0
+        self._heartbeat = task.LoopingCall(self._beat)
+        self._stop = threading.Event()
+        self._watchdog = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.reactor_thread = thread.get_ident()
+        self.last_beat = time.time()
+        self._heartbeat.start(self.interval, now=False)
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="StallDetector")
+        self._watchdog.daemon = True
+        self._watchdog.start()
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def stop(self):
+        if self._heartbeat.running:
+            self._heartbeat.stop()
+        self._stop.set()
+
+    def _beat(self):
+        now = time.time()
+        lag = max(now - self.last_beat - self.interval, 0)
+        self.last_beat = now
+        REACTOR_LAG.observe(lag)
+        self.max_lag = max(self.max_lag, lag)
+        with self._lock:
+            samples, self.samples = self.samples, []
+        if len(samples) > 0:
+            self.stalls += 1
+            REACTOR_STALLS.inc()
+            _log.warning("Reactor blocked for %.3fs, where it was stuck:\n%s" %
+                         (lag + self.interval, "\n--- later ---\n".join(samples)))
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 2):
+            blocked = time.time() - self.last_beat - self.interval
+            if blocked > self.threshold:
+                frame = sys._current_frames().get(self.reactor_thread)
+                with self._lock:
+                    if frame is not None and len(self.samples) < self.max_samples:
+                        self.samples.append(_format_stack(frame))
+
+
+class SamplingProfiler(object):
+    """
+    Samples the reactor thread's stack every `interval` seconds from another thread and counts how often each
+    stack comes up. Unlike cProfile it barely slows the reactor down. `stop` writes the counts in the collapsed
+    format flame graph tools read, one `outer;inner;innermost count` line per stack.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name="SamplingProfiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if len(stack) > 0:
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self, filepath):
+        self._stop.set()
+        self._thread.join()
+        with open(filepath, "w") as f:
+            for stack, count in sorted(self.counts.items(), key=lambda c: -c[1]):
+                f.write("%s %d\n" % (stack, count))
+
+
+class ProfileController(object):
+    """
+    Starts and stops profiling the reactor thread while the client is running. `mode` is "cprofile", which
+    records every call and writes pstats files for `python -m pstats`, or "sampling", which writes flame graph
+    stacks. Each profile goes to a new timestamped file in `directory`. Call `start` and `stop` from the reactor
+    thread, or use `toggle`, which can be called from anywhere including a signal handler.
+    """
+
+    def __init__(self, directory, mode="cprofile"):
+        if mode not in ("cprofile", "sampling"):
+            raise ValueError("Unknown profile mode %s" % mode)
+        self.directory = directory
+        self.mode = mode
+        self.profiler = None
+        self.filepath = None
+
+    def is_running(self):
+        return self.profiler is not None
+
+    def start(self):
+        if self.profiler is not None:
+            return
+        extension = "prof" if self.mode == "cprofile" else "stacks"
+        self.filepath = os.path.join(self.directory, "reactor_%d.%s" % (time.time(), extension))
+        if self.mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = SamplingProfiler(thread.get_ident())
+            self.profiler.start()
+        _log.info("Profiling the reactor to %s" % self.filepath)
+
+    def stop(self):
+        """
+        Stop profiling and write the profile out. Returns the path of the file.
+        """
+        if self.profiler is None:
+            return None
+        if self.mode == "cprofile":
+            self.profiler.disable()
+            self.profiler.dump_stats(self.filepath)
+        else:
+            self.profiler.stop(self.filepath)
+        self.profiler = None
+        _log.info("Wrote reactor profile to %s" % self.filepath)
+        return self.filepath
+
+    def toggle(self):
+        reactor.callFromThread(self.stop if self.is_running() else self.start)
+
+
+def enable_instrumentation(threshold=0.25, profile_dir=None, profile_mode="cprofile"):
+    """
+    Start a `StallDetector`, time every message handler and listener callback, and if `profile_dir` is given let
+    SIGUSR2 start and stop profiling the reactor. Call from the reactor thread. Returns the (StallDetector,
+    ProfileController or None).
+    """
+    detector = StallDetector(threshold)
+    detector.start()
+    enable_call_timing(threshold)
+    controller = None
+    if profile_dir is not None:
+        controller = ProfileController(profile_dir, profile_mode)
+        signal.signal(signal.SIGUSR2, lambda signum, frame: controller.toggle())
+    return detector, controller
+
+
+class MetricsResource(Resource):
+    """
+    A twisted.web resource which renders a registry for Prometheus to scrape.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry=None):
+        Resource.__init__(self)
+        self.registry = registry if registry is not None else get_registry()
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", CONTENT_TYPE)
+        return self.registry.render()
+
+
+def serve_metrics(port, interface="127.0.0.1", registry=None):
+    """
+    Serve the registry at /metrics on the reactor. Returns the listening port.
+    """
+    root = Resource()
+    root.putChild("metrics", MetricsResource(registry))
+    return reactor.listenTCP(port, Site(root), interface=interface)
@@ -0,0 +1,155 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+"""
+import time
+from collections import OrderedDict
+
+
+class RollingInventorySet(object):
+    """
+    A set of inventory hashes with bounded memory. Entries go into the current generation and when it fills up
+    (`max_size` / 2 entries) it becomes the previous generation and the old previous generation is dropped, so we
+    always remember at least the last `max_size` / 2 entries and never more than `max_size`.
+    """
+
+    def __init__(self, max_size=10000):
+        self.generation_size = max(max_size / 2, 1)
+        self._current = set()
+        self._previous = set()
+
+    def add(self, item):
+        """
+        Add an item, returning False if it was already in the set.
+        """
+        if item in self._current:
+            return False
+        known = item in self._previous
+        if len(self._current) >= self.generation_size:
+            self._previous = self._current
+            self._current = set()
+        self._current.add(item)
+        return not known
+
+    def __contains__(self, item):
+        return item in self._current or item in self._previous
+
+    def __len__(self):
+        return len(self._current) + len(self._previous - self._current)
+
+
+class TxRecord(object):
+    """
+    What we know about a transaction we are tracking for a subscription or a broadcast.
+    """
+
+    __slots__ = ['tx', 'callback', 'announced', 'ann_threshold', 'confirmations', 'last_confirmation', 'in_blocks']
+
+    def __init__(self, callback, ann_threshold, tx=None, in_blocks=None):
+        self.tx = tx
+        self.callback = callback
+        self.announced = 0
+        self.ann_threshold = ann_threshold
+        self.confirmations = 0
+        self.last_confirmation = 0
+        self.in_blocks = in_blocks if in_blocks is not None else []
+
+
+class BoundedStore(object):
+    """
+    A dictionary which holds at most `max_size` entries and drops entries older than `ttl` seconds, oldest first.
+    Entries added with `pin` are never evicted and don't count towards the limit. Entries which are done with can
+    be `retire`d, which drops them but remembers the key in `archive` so we don't go and fetch them again.
+
+    Each eviction is counted in `evicted` by reason, and the callables in `on_evict` are called with the key and
+    value of every entry which is evicted or retired.
+    """
+
+    def __init__(self, max_size=None, ttl=None, archive_size=10000):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.archive = RollingInventorySet(archive_size)
+        self.evicted = {"size": 0, "ttl": 0, "retired": 0}
+        self.on_evict = []
+        self._items = OrderedDict()
+        self._times = {}
+        self._pinned = {}
+
+    def pin(self, key, value):
+        self._pinned[key] = value
+
+    def _evict(self, key, reason):
+        value = self._items.pop(key)
+        del self._times[key]
+        self.evicted[reason] += 1
+        for callback in self.on_evict:
+            callback(key, value)
+
+    def expire(self, now=None):
+        """
+        Drop everything older than `ttl`. Entries are kept in insertion order so this only looks at the ones it
+        drops.
+        """
+        if self.ttl is None:
+            return
+        cutoff = (now or time.time()) - self.ttl
+        while len(self._items) > 0:
+            key = next(iter(self._items))
+            if self._times[key] > cutoff:
+                break
+            self._evict(key, "ttl")
+
+    def retire(self, key):
+        if key in self._items:
+            self.archive.add(key)
+            self._evict(key, "retired")
+
+    def is_archived(self, key):
+        return key in self.archive
+
+    def __setitem__(self, key, value):
+        if key in self._pinned:
+            self._pinned[key] = value
+            return
+        if key not in self._items:
+            self._times[key] = time.time()
+        self._items[key] = value
+        self.expire()
+        while self.max_size is not None and len(self._items) > self.max_size:
+            self._evict(next(iter(self._items)), "size")
+
+    def __getitem__(self, key):
+        if key in self._pinned:
+            return self._pinned[key]
+        return self._items[key]
+
+    def __delitem__(self, key):
+        if key in self._pinned:
+            del self._pinned[key]
+        else:
+            del self._items[key]
+            del self._times[key]
+
+    def __contains__(self, key):
+        return key in self._items or key in self._pinned
+
+    def __len__(self):
+        return len(self._items) + len(self._pinned)
+
+    def __iter__(self):
+        for key in self._pinned.keys():
+            yield key
+        for key in self._items.keys():
+            yield key
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if len(default) > 0:
+            return default[0]
+        raise KeyError(key)
@@ -40,7 +40,43 @@ class DownloadListener(Interface):
 
     def download_complete():
         """
-        Called when the download is complete.
+        Called when the download ends, either at the peer's height or because the peer timed out or went away.
+        """
+
+
+class CountingDownloadListener(DownloadListener):
+    """
+    A `DownloadListener` which takes the raw download counts for each block and works out the progress itself, so
+    nothing is computed for blocks it decides not to pass on.
+    """
+
+    def on_download_progress(peer, block, blocks_downloaded, blocks_to_download):
+        """
+        Called after validating each block instead of `progress` and `on_block_downloaded`.
+
+        Args:
+            peer: the ip/port `tuple` of the download peer's address.
+            block: the block (or header) which was just downloaded.
+            blocks_downloaded: total number of blocks downloaded so far.
+            blocks_to_download: the approximate number of blocks in the whole download.
+        """
+
+
+class BatchDownloadListener(DownloadListener):
+    """
+    A `DownloadListener` which would rather have the downloaded blocks in batches. When progress events are
+    throttled, listeners providing this get every block through `on_blocks_downloaded` instead of only the last
+    block of each batch through `on_block_downloaded`.
+    """
+
+    def on_blocks_downloaded(peer, blocks, blocks_left):
+        """
+        Called with the blocks downloaded since the last event.
+
+        Args:
+            peer: the ip/port `tuple` of the download peer's address.
+            blocks: a `list` of the blocks (or headers), oldest first.
+            blocks_left: the approximate number of blocks left to download.
         """
 
 
@@ -65,4 +101,27 @@ class PeerEventListener(Interface):
         Args:
             peer: the ip/port `tuple` of the peer's address.
             peer_count: number of connected peers.
-        """
\ No newline at end of file
+        """
+
+class BlockchainListener(Interface):
+    """
+    Listen for changes to the best chain in a `BlockDatabase`.
+    """
+
+    def on_tip_changed(block_id, height):
+        """
+        Called whenever a new block becomes the tip of the best chain.
+
+        Args:
+            block_id: the hex encoded hash of the new tip.
+            height: the height of the new tip.
+        """
+
+    def on_reorg(disconnected, connected):
+        """
+        Called when the best chain switches to a different branch, before `on_tip_changed`.
+
+        Args:
+            disconnected: a `list` of (height, block_id) `tuple`s removed from the main chain, lowest first.
+            connected: a `list` of (height, block_id) `tuple`s added to the main chain, lowest first.
+        """
@@ -3,6 +3,7 @@ Copyright (c) 2014 Brian Muller
 """
 
 import sys
+import time
 from twisted.python import log
 
 DEBUG = 5
@@ -12,6 +13,30 @@ ERROR = 2
 CRITICAL = 1
 
 levels = {"debug": 5, "warning": 4, "info": 3, "error": 2, "critical": 1}
+names = dict((v, k.upper()) for k, v in levels.items())
+
+
+# The most verbose level any `FileLogObserver` wants. `Logger` drops anything above it before formatting, so
+# disabled levels cost a comparison. Until an observer is created everything goes through.
+_level = DEBUG
+_observer_levels = []
+
+
+def set_level(level):
+    """
+    Change the level `Logger` filters at. Use this if you log through your own observers rather than
+    `FileLogObserver`, e.g. `set_level("debug")`.
+    """
+    global _level
+    _level = levels[level] if level in levels else level
+
+
+def get_level():
+    return _level
+
+
+def is_enabled(level):
+    return level <= _level
 
 
 class FileLogObserver(log.FileLogObserver):
@@ -19,6 +44,8 @@ class FileLogObserver(log.FileLogObserver):
         log.FileLogObserver.__init__(self, f or sys.stdout)
         self.level = levels[level]
         self.default = default
+        _observer_levels.append(self.level)
+        set_level(max(_observer_levels))
 
     def emit(self, eventDict):
         ll = eventDict.get('loglevel', self.default)
@@ -27,34 +54,70 @@ class FileLogObserver(log.FileLogObserver):
 
 
 class Logger(object):
+    """
+    Logs with `system` set to the name of whatever is logging. Formatting is lazy, pass the arguments separately
+    (`log.debug("Peer %s sent %s", peer, command)`) and nothing is formatted unless the level is enabled. Guard
+    debug messages whose arguments are expensive to compute with `is_enabled`.
+    """
+
     def __init__(self, **kwargs):
+        if 'system' in kwargs and not isinstance(kwargs['system'], str):
+            kwargs['system'] = kwargs['system'].__class__.__name__
         self.kwargs = kwargs
+        self._limits = {}
 
-    def msg(self, message, **kw):
+    def is_enabled(self, level):
+        return level <= _level
+
+    def msg(self, message, *args, **kw):
+        if args:
+            message = message % args
         kw.update(self.kwargs)
-        if 'system' in kw and not isinstance(kw['system'], str):
-            kw['system'] = kw['system'].__class__.__name__
         log.msg(message, **kw)
 
-    def info(self, message, **kw):
-        kw['loglevel'] = INFO
-        self.msg("[INFO] %s" % message, **kw)
-
-    def debug(self, message, **kw):
-        kw['loglevel'] = DEBUG
-        self.msg("[DEBUG] %s" % message, **kw)
-
-    def warning(self, message, **kw):
-        kw['loglevel'] = WARNING
-        self.msg("[WARNING] %s" % message, **kw)
-
-    def error(self, message, **kw):
-        kw['loglevel'] = ERROR
-        self.msg("[ERROR] %s" % message, **kw)
-
-    def critical(self, message, **kw):
-        kw['loglevel'] = CRITICAL
-        self.msg("[CRITICAL] %s" % message, **kw)
+    def _log(self, level, prefix, message, args, kw):
+        if level <= _level:
+            kw['loglevel'] = level
+            self.msg(prefix + (message % args if args else message), **kw)
+
+    def info(self, message, *args, **kw):
+        self._log(INFO, "[INFO] ", message, args, kw)
+
+    def debug(self, message, *args, **kw):
+        self._log(DEBUG, "[DEBUG] ", message, args, kw)
+
+    def warning(self, message, *args, **kw):
+        self._log(WARNING, "[WARNING] ", message, args, kw)
+
+    def error(self, message, *args, **kw):
+        self._log(ERROR, "[ERROR] ", message, args, kw)
+
+    def critical(self, message, *args, **kw):
+        self._log(CRITICAL, "[CRITICAL] ", message, args, kw)
+
+    def limited(self, key, level, message, *args, **kw):
+        """
+        Log at `level` but let through at most `burst` messages with the same `key` every `interval` seconds
+        (both taken from `kw`, 10 and 1.0 by default). The first message after a quiet spell says how many were
+        dropped. Use it for messages which can come in floods, like one per inv item.
+        """
+        burst = kw.pop('burst', 10)
+        interval = kw.pop('interval', 1.0)
+        if level > _level:
+            return
+        now = time.time()
+        window = self._limits.get(key)
+        if window is None or now - window[0] >= interval:
+            suppressed = window[2] if window is not None else 0
+            window = self._limits[key] = [now, 0, 0]
+            if suppressed > 0:
+                message = "%s (%s similar messages suppressed)" % (message % args if args else message, suppressed)
+                args = ()
+        window[1] += 1
+        if window[1] > burst:
+            window[2] += 1
+            return
+        self._log(level, "[%s] " % names[level], message, args, kw)
 
 
 try:
@@ -0,0 +1,221 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+
+Counters, gauges and histograms describing the client, which can be served in the Prometheus text format.
+
+Everything records into the registry returned by `get_registry`. `instrumentation.serve_metrics` serves it on the
+reactor. Nothing here depends on the reactor so the transport-agnostic protocol core can record into it too.
+"""
+import time
+import bisect
+from log import Logger
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values):
+    if len(names) == 0:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+class Metric(object):
+    """
+    A named family of samples, one per combination of label values. Label values are passed as a tuple in the
+    same order as `labelnames`.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def remove(self, **labels):
+        """
+        Drop every series whose labels match these, e.g. `remove(peer="1.2.3.4:8333")` once a peer has gone.
+        """
+        indexes = [(self.labelnames.index(name), str(value)) for name, value in labels.items()]
+        for key in self.values.keys():
+            if all(str(key[i]) == value for i, value in indexes):
+                del self.values[key]
+
+    def clear(self):
+        self.values = {}
+
+    def get(self, labels=()):
+        return self.values.get(tuple(labels), 0)
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, labels, value
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for name, labels, value in self.samples():
+            names = self.labelnames + ("le",) if len(labels) > len(self.labelnames) else self.labelnames
+            lines.append("%s%s %s" % (name, _format_labels(names, labels), _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels=(), amount=1):
+        labels = tuple(labels)
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, labels=()):
+        self.values[tuple(labels)] = value
+
+    def inc(self, labels=(), amount=1):
+        labels = tuple(labels)
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    """
+    Counts observations into cumulative buckets and keeps their sum and count.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, labels=()):
+        labels = tuple(labels)
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def get(self, labels=()):
+        """
+        Return the (sum, count) of the observations.
+        """
+        counts, total, count = self.values.get(tuple(labels), (None, 0.0, 0))
+        return total, count
+
+    def samples(self):
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self.name + "_bucket", labels + ("+Inf" if bound == float("inf") else repr(bound),), cumulative
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+class MetricsRegistry(object):
+    """
+    Holds the metrics by name. Values which are cheaper to read when asked for than to keep up to date, like
+    table sizes, are set by collectors: functions called with the registry just before it is rendered.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+
+    def _get_or_create(self, cls, name, help, labelnames, **kwargs):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, help, labelnames, **kwargs)
+        metric = self.metrics[name]
+        if not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+            raise ValueError("Metric %s is already registered as a different type" % name)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def collect(self):
+        for collector in list(self.collectors):
+            collector(self)
+
+    def render(self):
+        """
+        Run the collectors and return every metric in the Prometheus text format.
+        """
+        self.collect()
+        return "\n".join(self.metrics[name].render() for name in sorted(self.metrics)) + "\n"
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    """
+    Return the registry the protocol, blockchain and client record into.
+    """
+    return _registry
+
+
+CALLBACK_SECONDS = _registry.histogram("pybitcoin_callback_seconds", "Time spent in message handlers and listener callbacks",
+                                       ("callback",), buckets=(.0001, .001, .005, .01, .05, .1, .5, 1, 5))
+_timing = {"enabled": False, "threshold": 0.1}
+_log = Logger(system="metrics")
+
+
+def timed_call(name, func, *args, **kwargs):
+    """
+    Call `func`, recording the time it took under `name` if call timing is enabled and logging a warning if it
+    took longer than the stall threshold.
+    """
+    if not _timing["enabled"]:
+        return func(*args, **kwargs)
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        CALLBACK_SECONDS.observe(elapsed, (name,))
+        if elapsed > _timing["threshold"]:
+            _log.warning("%s took %.3fs" % (name, elapsed))
+
+
+def enable_call_timing(threshold=0.1):
+    _timing["enabled"] = True
+    _timing["threshold"] = threshold
+
+
+def disable_call_timing():
+    _timing["enabled"] = False
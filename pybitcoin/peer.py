@@ -0,0 +1,790 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+"""
+import enum
+import time
+import random
+import traceback
+from collections import deque
+
+from bitcoin.messages import *
+from bitcoin.core import b2lx, lx
+from bitcoin.net import CInv
+from bitcoin.wallet import CBitcoinAddress
+from extensions import msg_version2, msg_filterload, msg_merkleblock, msg_headers2, msg_sendheaders, MsgHeader
+from extensions import msg_getcfilters, msg_getcfheaders, msg_cfilter, msg_cfheaders
+from compactfilters import NODE_COMPACT_FILTERS
+from listeners import CountingDownloadListener
+from inventory import RollingInventorySet, TxRecord
+from log import Logger, DEBUG
+from metrics import get_registry, timed_call
+from timers import TimerWheel
+
+State = enum.Enum('State', ('CONNECTING', 'DOWNLOADING', 'CONNECTED', 'SHUTDOWN'))
+PROTOCOL_VERSION = 70002
+# Peers from this version on can announce new blocks with headers rather than inv (BIP130).
+SENDHEADERS_VERSION = 70012
+# How many announced headers which don't connect to our chain we put up with before giving up on the peer.
+MAX_UNCONNECTING_HEADERS = 10
+PING_INTERVAL = 30
+RTT_SMOOTHING = 0.2
+KNOWN_INVENTORY_SIZE = 10000
+RESCAN_TIMEOUT = 60
+# The most filter headers and filters peers send for one request (BIP157).
+MAX_CFHEADERS = 2000
+MAX_CFILTERS = 1000
+
+messagemap["merkleblock"] = msg_merkleblock
+messagemap["headers"] = msg_headers2
+messagemap["sendheaders"] = msg_sendheaders
+messagemap["cfilter"] = msg_cfilter
+messagemap["cfheaders"] = msg_cfheaders
+
+_registry = get_registry()
+BYTES_RECEIVED = _registry.counter("pybitcoin_peer_bytes_received_total", "Bytes received from each peer", ("peer",))
+BYTES_SENT = _registry.counter("pybitcoin_peer_bytes_sent_total", "Bytes sent to each peer", ("peer",))
+MESSAGES_RECEIVED = _registry.counter("pybitcoin_peer_messages_received_total", "Messages received from each peer",
+                                      ("peer", "command"))
+MESSAGES_SENT = _registry.counter("pybitcoin_peer_messages_sent_total", "Messages sent to each peer", ("peer", "command"))
+PEER_RTT = _registry.gauge("pybitcoin_peer_rtt_seconds", "Smoothed round trip time to each peer", ("peer",))
+HANDSHAKE_SECONDS = _registry.histogram("pybitcoin_peer_handshake_seconds", "Time from connecting to completing the handshake")
+TIMEOUTS = _registry.counter("pybitcoin_peer_timeouts_total", "Requests peers failed to answer in time", ("request",))
+HEADERS_PROCESSED = _registry.counter("pybitcoin_headers_processed_total", "Headers received and processed")
+MERKLEBLOCKS_PROCESSED = _registry.counter("pybitcoin_merkleblocks_processed_total", "Filtered blocks received and processed")
+CFILTERS_PROCESSED = _registry.counter("pybitcoin_cfilters_processed_total", "Compact filters received and checked")
+CFILTER_MATCHES = _registry.counter("pybitcoin_cfilter_matches_total", "Compact filters which matched our scripts")
+PEER_METRICS = (BYTES_RECEIVED, BYTES_SENT, MESSAGES_RECEIVED, MESSAGES_SENT, PEER_RTT)
+
+
+class PeerConnection(object):
+    """
+    The wire protocol for a single peer without any networking. Feed it the bytes received from the peer with
+    `receive_data` and it handles the framing, the handshake and the messages, updating the blockchain and
+    subscriptions as it goes. Whatever it wants to send to the peer goes to `write` and a request to hang up goes
+    to `lose_connection`. By default these just queue up the bytes in `outgoing` and set `closing`, which is all
+    you need to drive it in a test or benchmark. The Twisted and asyncio adapters override them to talk to a real
+    transport.
+
+    Timeouts and the ping loop run on `timers`. If none is given a wheel which only moves when you call its
+    `advance` method is used.
+
+    Set `recorder` to a `capture.CaptureWriter` to save every message sent and received for replaying later.
+
+    Set `compact_filters` to a `compactfilters.FilterMatcher` shared by all the connections to find our txs with
+    compact block filters (BIP157/158) instead of a bloom filter. No filter is loaded, only peers serving filters
+    are accepted and the blocks whose filters match are downloaded in full.
+    """
+
+    def __init__(self, user_agent, inventory, subscriptions, bloom_filter, blockchain, download_listener, tracker, address_manager, utxos=None,
+                 timers=None):
+        self.user_agent = user_agent
+        self.inventory = inventory
+        self.subscriptions = subscriptions
+        self.bloom_filter = bloom_filter
+        self.blockchain = blockchain
+        self.tracker = tracker
+        self.address_manager = address_manager
+        self.utxos = utxos
+        self.download_count = 0
+        self.download_tracker = [0, 0]
+        self.download_listener = download_listener
+        self.timers = timers if timers is not None else TimerWheel()
+        self.timeouts = {}
+        self.callbacks = {}
+        self.known_inventory = RollingInventorySet(KNOWN_INVENTORY_SIZE)
+        self.state = State.CONNECTING
+        self.version = None
+        self.buffer = ""
+        self.outgoing = []
+        self.closing = False
+        self.ping_nonce = None
+        self.ping_sent = None
+        # ping nonce -> callback for each batch of blocks we are rescanning, there can be more than one rescan.
+        self.rescan_batches = {}
+        self.filter_queue = deque()
+        self.checking_filters = False
+        self.pinger = None
+        self.awaiting_headers = False
+        self.unconnecting_headers = 0
+        self.rtt = None
+        self.bytes_received = 0
+        self.recorder = None
+        self.compact_filters = None
+        # The height and hash of the last block in the batch of filters or filter headers we asked for.
+        self.filter_stop = None
+        self.filter_stop_hash = None
+        # The peer's address and its "host:port" for logs and metrics, looked up once when we connect.
+        self.peer_address = None
+        self.label = None
+        self.connected_at = None
+        self.log = Logger(system=self)
+
+    def write(self, data):
+        self.outgoing.append(data)
+
+    def lose_connection(self):
+        self.closing = True
+
+    def get_peer_address(self):
+        """
+        Return the ip/port `tuple` of the peer.
+        """
+        return ("0.0.0.0", 0)
+
+    def on_ready(self):
+        """
+        Called once the handshake is complete.
+        """
+
+    def data_to_send(self):
+        """
+        Return and clear everything queued up by the default `write`.
+        """
+        data = "".join(self.outgoing)
+        self.outgoing = []
+        return data
+
+    def _send(self, message):
+        # Late sends (a timer or a callback after we hung up) would bring back the series `connection_closed` removed.
+        if self.state == State.SHUTDOWN:
+            return
+        data = message.to_bytes()
+        if self.recorder is not None:
+            self.recorder.record_outgoing(data)
+        BYTES_SENT.inc((self.label,), len(data))
+        MESSAGES_SENT.inc((self.label, message.command))
+        self.write(data)
+
+    def start(self):
+        """
+        Send the version message and start the handshake
+        """
+        self.peer_address = self.get_peer_address()
+        self.label = "%s:%s" % self.peer_address
+        self.connected_at = time.time()
+        self.timeouts["verack"] = self.timers.schedule(5, self.response_timeout, "verack")
+        self.timeouts["version"] = self.timers.schedule(5, self.response_timeout, "version")
+        self._send(msg_version2(PROTOCOL_VERSION, self.user_agent, nStartingHeight=self.blockchain.get_height() if self.blockchain else -1))
+
+    def receive_data(self, data):
+        """
+        Handle bytes received from the peer. Partial messages are buffered until the rest arrives.
+        """
+        self.bytes_received += len(data)
+        BYTES_RECEIVED.inc((self.label,), len(data))
+        self.buffer += data
+        while len(self.buffer) >= 24 and not self.closing:
+            try:
+                header = MsgHeader.from_bytes(self.buffer)
+            except Exception:
+                traceback.print_exc()
+                self.lose_connection()
+                return
+            if len(self.buffer) < header.msglen + 24:
+                return
+            raw, self.buffer = self.buffer[:header.msglen + 24], self.buffer[header.msglen + 24:]
+            if self.recorder is not None:
+                self.recorder.record_incoming(raw)
+            # Commands we don't know are lumped together so a peer can't make up new series.
+            MESSAGES_RECEIVED.inc((self.label, header.command if header.command in messagemap else "other"))
+            try:
+                # Messages we don't know deserialize to None.
+                m = MsgSerializable.from_bytes(raw)
+                if m is not None:
+                    timed_call("handle_" + m.command, self.handle_message, m)
+            except Exception:
+                traceback.print_exc()
+
+    def handle_message(self, m):
+        if m.command == "verack":
+            self.timeouts["verack"].cancel()
+            del self.timeouts["verack"]
+            if "version" not in self.timeouts:
+                self.on_handshake_complete()
+
+        elif m.command == "version":
+            self.version = m
+            if self.compact_filters is not None:
+                # We need peers which serve the filters, whatever else they do.
+                refused = (m.nServices & (1 | NODE_COMPACT_FILTERS)) != 1 | NODE_COMPACT_FILTERS
+            else:
+                refused = m.nServices != 1
+            if m.nVersion < 70001 or refused:
+                self.lose_connection()
+            self.timeouts["version"].cancel()
+            del self.timeouts["version"]
+            self._send(msg_verack())
+            if self.blockchain is not None:
+                self.to_download = self.version.nStartingHeight - self.blockchain.get_height()
+            if "verack" not in self.timeouts:
+                self.on_handshake_complete()
+
+        elif m.command == "getdata":
+            for item in m.inv:
+                # The peer asked for it so send it even if we announced it ourselves. Entries which are lists of
+                # block hashes are placeholders for txs we haven't got yet.
+                tx = self.inventory.get(item.hash) if item.type == 1 else None
+                if tx is not None and not isinstance(tx, list):
+                    self.known_inventory.add(item.hash)
+                    transaction = msg_tx()
+                    transaction.tx = tx
+                    self._send(transaction)
+
+        elif m.command == "inv":
+            fetch_headers = False
+            for item in m.inv:
+                # Remember what this peer has told us about. A repeat announcement from the same peer shouldn't
+                # count towards the announcement threshold or trigger another getdata.
+                new = self.known_inventory.add(item.hash)
+
+                # This is either an announcement of tx we broadcast ourselves or a tx we have already downloaded.
+                # In either case we only need to callback here.
+                if item.type == 1 and item.hash in self.subscriptions:
+                    if new:
+                        timed_call("subscription", self.subscriptions[item.hash].callback, item.hash)
+
+                # This is the first time we are seeing this txid. Let's download it and check to see if it sends
+                # coins to any addresses in our subscriptions. Txs we have already retired are buried deep
+                # enough that there is nothing left to do with them.
+                elif item.type == 1 and item.hash not in self.inventory:
+                    if not new or self.subscriptions.is_archived(item.hash) or self.inventory.is_archived(item.hash):
+                        continue
+                    self.timeouts[item.hash] = self.timers.schedule(5, self.response_timeout, item.hash)
+
+                    cinv = CInv()
+                    cinv.type = 1
+                    cinv.hash = item.hash
+
+                    getdata_packet = msg_getdata()
+                    getdata_packet.inv.append(cinv)
+
+                    self._send(getdata_packet)
+
+                # The peer announced a new block. Unlike txs, we should download it, even if we've previously
+                # downloaded it from another peer, to make sure it doesn't contain any txs we didn't know about.
+                # Without any subscriptions there is nothing to look for in it, so we just want the header. With
+                # compact filters we want the header first too, to check the block's filter before fetching it.
+                elif item.type == 2 or item.type == 3:
+                    if not new and self.state != State.DOWNLOADING:
+                        continue
+                    if self.compact_filters is not None or (self.state != State.DOWNLOADING and len(self.subscriptions) == 0):
+                        fetch_headers = self.blockchain is not None and self.state != State.DOWNLOADING
+                        continue
+                    if self.state == State.DOWNLOADING:
+                        self.download_tracker[0] += 1
+                    cinv = CInv()
+                    cinv.type = 3
+                    cinv.hash = item.hash
+
+                    getdata_packet = msg_getdata()
+                    getdata_packet.inv.append(cinv)
+
+                    self._send(getdata_packet)
+
+                if self.state != State.DOWNLOADING and self.log.is_enabled(DEBUG):
+                    self.log.limited("inv", DEBUG, "Peer %s announced new %s %s", self.label, CInv.typemap[item.type], b2lx(item.hash))
+            if fetch_headers:
+                self._send_getheaders()
+
+        elif m.command == "tx":
+            self.known_inventory.add(m.tx.GetHash())
+            if m.tx.GetHash() in self.timeouts:
+                self.timeouts.pop(m.tx.GetHash()).cancel()
+            # It's possible the first time we are hearing about this tx is following block inclusion, in which
+            # case the merkle block left the block hashes in the inventory for us. They are only needed until
+            # the tx itself arrives.
+            in_blocks = self.inventory.get(m.tx.GetHash())
+            if isinstance(in_blocks, list):
+                self.inventory.retire(m.tx.GetHash())
+            else:
+                in_blocks = []
+            self._process_tx(m.tx, in_blocks)
+
+        elif m.command == "block":
+            # A block whose compact filter matched. Look through all of its txs like the ones a merkleblock matched.
+            block_hash = m.block.GetHash()
+            self.known_inventory.add(block_hash)
+            for tx in m.block.vtx:
+                txid = tx.GetHash()
+                if txid in self.subscriptions:
+                    if self.utxos is not None:
+                        self.utxos.add_block(txid, block_hash)
+                    if self.tracker is not None:
+                        self.tracker.add_block(txid, block_hash)
+                elif not self.subscriptions.is_archived(txid):
+                    self._process_tx(tx, [block_hash])
+            matcher = self.compact_filters
+            if matcher is not None:
+                matcher.block_downloaded(block_hash)
+                if matcher.peer is self and self.filter_stop_hash is None:
+                    self.download_filters()
+
+        elif m.command == "merkleblock":
+            MERKLEBLOCKS_PROCESSED.inc()
+            self.known_inventory.add(m.block.GetHash())
+            if self.blockchain is not None:
+                # Blocks we are rescanning are already in the database so there is nothing to save.
+                if self.blockchain.get_block_height(b2lx(m.block.GetHash())) is None:
+                    self.blockchain.process_block(m.block)
+                    if self.state != State.DOWNLOADING:
+                        self.blockchain.save()
+                # check for block inclusion of subscribed txs. Confirmation changes caused by the block itself
+                # are pushed to the subscriptions by the tracker when the blockchain reports the new tip.
+                for match in m.block.get_matched_txs():
+                    if self.utxos is not None:
+                        self.utxos.add_block(match, m.block.GetHash())
+                    if match in self.subscriptions:
+                        self.tracker.add_block(match, m.block.GetHash())
+                    elif not self.subscriptions.is_archived(match):
+                        # stick the hash here in case this is the first we are hearing about this tx.
+                        # when the tx comes over the wire after this block, we will append this hash.
+                        in_blocks = self.inventory.get(match)
+                        if in_blocks is None:
+                            self.inventory[match] = [m.block.GetHash()]
+                        elif isinstance(in_blocks, list):
+                            in_blocks.append(m.block.GetHash())
+
+                # If we are in the middle of an initial chain download, let's check to see if we have
+                # either reached the end of the download or if we need to loop back around and make
+                # another get_blocks call.
+                if self.state == State.DOWNLOADING:
+                    self._report_download(m.block)
+                    self.download_tracker[1] += 1
+                    # We've downloaded every block in the inv packet and still have more to go.
+                    if (self.download_tracker[0] == self.download_tracker[1] and
+                       self.blockchain.get_height() < self.version.nStartingHeight):
+                        if self.timeouts["download"].active():
+                            self.timeouts["download"].cancel()
+                        self.download_blocks(self.callbacks["download"])
+                    # We've downloaded everything so let's callback to the client.
+                    elif self.blockchain.get_height() >= self.version.nStartingHeight:
+                        self.blockchain.save()
+                        self._finish_download()
+                        self.callbacks["download"]()
+                        if self.timeouts["download"].active():
+                            self.timeouts["download"].cancel()
+
+        elif m.command == "headers" and not self.awaiting_headers:
+            self.on_headers_announced(m.headers)
+
+        elif m.command == "headers":
+            self.awaiting_headers = False
+            if self.timeouts["download"].active():
+                self.timeouts["download"].cancel()
+            for header in m.headers:
+                # If this node sent a block with no parent then disconnect from it and callback
+                # on client.check_for_more_blocks.
+                if self.blockchain.process_block(header) is None:
+                    self.blockchain.save()
+                    self._finish_download()
+                    self.callbacks["download"]()
+                    self.lose_connection()
+                    return
+                HEADERS_PROCESSED.inc()
+                self._report_download(header)
+            # The headers message only comes in batches of 500 blocks. If we still have more blocks to download
+            # loop back around and call get_headers again.
+            if self.blockchain.get_height() < self.version.nStartingHeight:
+                self.download_blocks(self.callbacks["download"])
+            else:
+                self.blockchain.save()
+                self._finish_download()
+                self.callbacks["download"]()
+                self.download_filters()
+
+        elif m.command == "cfheaders" and self.compact_filters is not None and self.compact_filters.peer is self:
+            matcher = self.compact_filters
+            if m.stop_hash != self.filter_stop_hash:
+                # The answer to an earlier request, from before a rescan.
+                return
+            self._cancel_timeout("filters")
+            self.filter_stop_hash = None
+            start = matcher.header_height + 1
+            block_ids = [self.blockchain.get_block_id(height) for height in range(start, start + len(m.filter_hashes))]
+            if len(block_ids) == 0 or block_ids[-1] is None or lx(block_ids[-1]) != m.stop_hash:
+                # A reorg replaced the blocks while we were waiting, ask again.
+                self.download_filters()
+            elif matcher.add_filter_hashes(start, [lx(block_id) for block_id in block_ids], m.filter_hashes, m.previous_header):
+                self.download_filters()
+            else:
+                self.log.warning("Peer %s sent filter headers which don't match the ones we have, disconnecting...", self.label)
+                matcher.peer = None
+                self.lose_connection()
+
+        elif m.command == "cfilter" and self.compact_filters is not None and self.compact_filters.peer is self:
+            # Checking a filter can take a while, so they are queued up and checked one at a time with `cooperate`.
+            # The peer is still there, the timeout starts again.
+            self._cancel_timeout("filters")
+            self.timeouts["filters"] = self.timers.schedule(30, self.response_timeout, "filters")
+            self.filter_queue.append(m)
+            if not self.checking_filters:
+                self.checking_filters = True
+                self.cooperate(self._check_filters())
+
+        elif m.command == "addr":
+            if self.address_manager is not None:
+                for addr in m.addrs:
+                    if addr.nServices & 1:
+                        self.address_manager.add([(addr.ip, addr.port)], addr.nTime)
+
+        elif m.command == "ping":
+            self._send(msg_pong(nonce=m.nonce))
+
+        elif m.command == "pong":
+            if m.nonce == self.ping_nonce:
+                self._add_rtt_sample(time.time() - self.ping_sent)
+                self.ping_nonce = None
+            elif m.nonce in self.rescan_batches:
+                callback = self.rescan_batches.pop(m.nonce)
+                # The timeout now covers the next batch, if there is one.
+                self.timeouts.pop("rescan").cancel()
+                if len(self.rescan_batches) > 0:
+                    self.timeouts["rescan"] = self.timers.schedule(RESCAN_TIMEOUT, self.response_timeout, "rescan")
+                callback(self)
+
+        else:
+            self.log.debug("Received message %s from %s", m.command, self.label)
+
+    def on_handshake_complete(self):
+        self.log.info("Connected to peer %s", self.label)
+        HANDSHAKE_SECONDS.observe(time.time() - self.connected_at)
+        self.load_filter()
+        self.state = State.CONNECTED
+        if self.address_manager is not None:
+            self.address_manager.mark_good(self.peer_address)
+            self._send(msg_getaddr())
+        if self.version.nVersion >= SENDHEADERS_VERSION:
+            self._send(msg_sendheaders())
+        self.send_ping()
+        self.on_ready()
+
+    def on_headers_announced(self, headers):
+        """
+        Connect the headers of newly mined blocks the peer announced (after we sent it sendheaders) straight into
+        the blockchain. If we have subscriptions we fetch the filtered blocks as well to look for our txs.
+        """
+        if self.blockchain is None or len(headers) == 0:
+            return
+        new = []
+        for header in headers:
+            block_hash = header.GetHash()
+            self.known_inventory.add(block_hash)
+            if self.blockchain.get_block_height(b2lx(block_hash)) is not None:
+                continue
+            if self.blockchain.process_block(header) is None:
+                # We are missing the blocks in between, ask for everything after our tip. A peer which keeps
+                # sending us headers we can't connect is either broken or up to no good.
+                self.unconnecting_headers += 1
+                if self.unconnecting_headers > MAX_UNCONNECTING_HEADERS:
+                    self.log.warning("Peer %s keeps announcing headers which don't connect, disconnecting...", self.label)
+                    self.lose_connection()
+                else:
+                    self._send_getheaders()
+                break
+            HEADERS_PROCESSED.inc()
+            new.append(block_hash)
+        if len(new) == 0:
+            return
+        self.unconnecting_headers = 0
+        self.blockchain.save()
+        if self.compact_filters is not None:
+            self.download_filters()
+        elif len(self.subscriptions) > 0:
+            getdata_packet = msg_getdata()
+            for block_hash in new:
+                cinv = CInv()
+                cinv.type = 3
+                cinv.hash = block_hash
+                getdata_packet.inv.append(cinv)
+            self._send(getdata_packet)
+        # Announcements only come in small batches, a full one means there are more headers to fetch.
+        if len(headers) >= 2000:
+            self._send_getheaders()
+
+    def _send_getheaders(self):
+        get = msg_getheaders()
+        get.locator = self.blockchain.get_locator()
+        self._send(get)
+
+    def _process_tx(self, tx, in_blocks):
+        """
+        Check whether `tx` pays or spends from any of our subscribed addresses, and if so start tracking it and
+        tell the subscriber.
+        """
+        addresses = []
+        for out in tx.vout:
+            try:
+                addr = str(CBitcoinAddress.from_scriptPubKey(out.scriptPubKey))
+            except Exception:
+                addr = None
+            addresses.append(addr)
+        # A tx spending one of our outputs matters to the address the output paid.
+        if self.utxos is not None:
+            addresses.extend(self.utxos.add_tx(tx, in_blocks))
+
+        for addr in addresses:
+            if addr in self.subscriptions:
+                if tx.GetHash() not in self.subscriptions:
+                    self.subscriptions[tx.GetHash()] = TxRecord(self.subscriptions[addr][1], self.subscriptions[addr][0],
+                                                                tx=tx, in_blocks=in_blocks)
+                    # The tracker announces the txs a rescan finds already buried itself.
+                    if self.tracker is None or not self.tracker.track(tx.GetHash()):
+                        timed_call("subscription", self.subscriptions[addr][1], tx.GetHash())
+
+    def _check_filters(self):
+        """
+        Check the queued filters in order, one per step.
+        """
+        try:
+            while len(self.filter_queue) > 0 and self.state != State.SHUTDOWN:
+                try:
+                    self._on_cfilter(self.filter_queue.popleft())
+                except Exception:
+                    traceback.print_exc()
+                yield None
+        finally:
+            self.checking_filters = False
+
+    def _on_cfilter(self, m):
+        # We may have handed the filters over to another peer while this one was queued.
+        if self.compact_filters is None or self.compact_filters.peer is not self:
+            return
+        matcher = self.compact_filters
+        # Filters are checked strictly in order. Anything else is left over from before a rescan, and once the
+        # last of those is in we can ask for the right ones.
+        if m.block_hash != matcher.headers_by_height.get(matcher.scanned_height + 1):
+            if m.block_hash == self.filter_stop_hash:
+                self.filter_stop_hash = None
+                self.download_filters()
+            return
+        self._cancel_timeout("filters")
+        CFILTERS_PROCESSED.inc()
+        matched = matcher.check_filter(m.block_hash, m.filter)
+        if matched is None:
+            self.log.warning("Peer %s sent a filter which doesn't match its filter header, disconnecting...", self.label)
+            matcher.peer = None
+            self.lose_connection()
+            return
+        if matched:
+            CFILTER_MATCHES.inc()
+            cinv = CInv()
+            cinv.type = 2
+            cinv.hash = m.block_hash
+            getdata_packet = msg_getdata()
+            getdata_packet.inv.append(cinv)
+            self._send(getdata_packet)
+        if matcher.scanned_height >= self.filter_stop:
+            self.filter_stop_hash = None
+            self.download_filters()
+        else:
+            self.timeouts["filters"] = self.timers.schedule(30, self.response_timeout, "filters")
+
+    def download_filters(self):
+        """
+        In compact filter mode, fetch the filter headers and then the filters for the blocks we haven't checked
+        yet, a batch at a time, and download every block whose filter matches our scripts. Only one peer fetches
+        filters at a time so they are checked in order; while another one is at it this does nothing.
+        """
+        matcher = self.compact_filters
+        if matcher is None or self.blockchain is None or self.state == State.SHUTDOWN:
+            return
+        # Carry on once the batch we asked for is in.
+        if (matcher.peer is not None and matcher.peer is not self) or self.filter_stop_hash is not None:
+            return
+        # After a reorg the filters of the blocks which were replaced are no use.
+        height = matcher.header_height
+        while height >= matcher.start_height and b2lx(matcher.headers_by_height[height]) != self.blockchain.get_block_id(height):
+            height -= 1
+        matcher.rewind(height)
+
+        tip = self.blockchain.get_height()
+        if matcher.header_height < tip:
+            start = matcher.header_height + 1
+            self.filter_stop = min(start + MAX_CFHEADERS - 1, tip)
+            request = msg_getcfheaders()
+        elif matcher.scanned_height < matcher.header_height:
+            start = matcher.scanned_height + 1
+            self.filter_stop = min(start + MAX_CFILTERS - 1, matcher.header_height)
+            request = msg_getcfilters()
+        elif len(matcher.pending) > 0:
+            # Everything is checked, we are waiting on the blocks which matched.
+            self._cancel_timeout("filters")
+            self.timeouts["filters"] = self.timers.schedule(30, self.response_timeout, "filters")
+            return
+        else:
+            self._cancel_timeout("filters")
+            matcher.peer = None
+            return
+        matcher.peer = self
+        self.filter_stop_hash = lx(self.blockchain.get_block_id(self.filter_stop))
+        request.start_height = start
+        request.stop_hash = self.filter_stop_hash
+        self._cancel_timeout("filters")
+        self.timeouts["filters"] = self.timers.schedule(30, self.response_timeout, "filters")
+        self._send(request)
+
+    def cooperate(self, iterator):
+        """
+        Run a long job given as an iterator, a step at a time. This runs it straight through, the adapters spread the
+        steps over their event loop so the job doesn't hold up everything else.
+        """
+        for step in iterator:
+            pass
+
+    def _cancel_timeout(self, id):
+        timeout = self.timeouts.pop(id, None)
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+
+    def send_ping(self):
+        """
+        Ping the peer so we can keep a moving average of its round trip time. If the last ping is still unanswered
+        the time we have waited so far counts as a sample so unresponsive peers sink to the bottom.
+        """
+        now = time.time()
+        if self.ping_nonce is not None:
+            self._add_rtt_sample(now - self.ping_sent)
+        self.ping_nonce = random.getrandbits(64)
+        self.ping_sent = now
+        self._send(msg_ping(nonce=self.ping_nonce))
+        self.pinger = self.timers.schedule(PING_INTERVAL, self.send_ping)
+
+    def _add_rtt_sample(self, sample):
+        self.rtt = sample if self.rtt is None else (1 - RTT_SMOOTHING) * self.rtt + RTT_SMOOTHING * sample
+        PEER_RTT.set(self.rtt, (self.label,))
+
+    def is_ready(self):
+        return self.state in (State.CONNECTED, State.DOWNLOADING)
+
+    def get_rtt(self):
+        """
+        Return the smoothed round trip time in seconds, including the wait on any outstanding ping, or None if we
+        haven't measured it yet.
+        """
+        if self.ping_nonce is not None and self.rtt is not None:
+            return max(self.rtt, time.time() - self.ping_sent)
+        return self.rtt
+
+    def response_timeout(self, id):
+        TIMEOUTS.inc((id if id in ("version", "verack", "download", "rescan", "filters") else "tx",))
+        if id in ("version", "verack") and self.address_manager is not None:
+            self.address_manager.mark_failed(self.peer_address)
+        self._finish_download()
+        if id == "download":
+            self.callbacks["download"]()
+        del self.timeouts[id]
+        for t in self.timeouts.values():
+            if t.active():
+                t.cancel()
+        if self.state != State.SHUTDOWN:
+            self.log.warning("Peer %s unresponsive, disconnecting...", self.label)
+        self.lose_connection()
+        self.state = State.SHUTDOWN
+
+    def download_blocks(self, callback):
+        if self.state == State.CONNECTING:
+            return self.timers.schedule(1, self.download_blocks, callback)
+        if self.blockchain is not None:
+            # We come back here for each batch, only the first one starts a download.
+            if self.state != State.DOWNLOADING:
+                self.download_count = 0
+                self.to_download = max(self.version.nStartingHeight - self.blockchain.get_height(), 0)
+                if self.download_listener is not None:
+                    self.download_listener.download_started(self.peer_address, self.to_download)
+            self.log.info("Downloading blocks from %s", self.label)
+            self.state = State.DOWNLOADING
+            self.callbacks["download"] = callback
+            self.timeouts["download"] = self.timers.schedule(30, self.response_timeout, "download")
+            # With compact filters we only need the headers, the filters tell us which blocks to fetch.
+            if len(self.subscriptions) > 0 and self.compact_filters is None:
+                get = msg_getblocks()
+                self.download_tracker = [0, 0]
+            else:
+                get = msg_getheaders()
+                self.awaiting_headers = True
+            get.locator = self.blockchain.get_locator()
+            self._send(get)
+
+    def _report_download(self, block):
+        """
+        Count a block of the chain download and tell the download listener. A `CountingDownloadListener` (like the
+        client's throttle) gets the counts as they are and only works out the percentage when it passes an event on.
+        """
+        self.download_count += 1
+        # The chain grew while we were downloading it.
+        self.to_download = max(self.to_download, self.download_count)
+        listener = self.download_listener
+        if listener is not None:
+            if CountingDownloadListener.providedBy(listener):
+                listener.on_download_progress(self.peer_address, block, self.download_count, self.to_download)
+            else:
+                listener.progress(int((self.download_count / float(self.to_download))*100), self.download_count)
+                listener.on_block_downloaded(self.peer_address, block, self.to_download - self.download_count + 1)
+
+    def _finish_download(self):
+        """
+        Leave the DOWNLOADING state and tell the download listener. The download is over when we reach the peer's
+        height, or when the peer times out or goes away part way through, however many blocks were counted.
+        """
+        if self.state != State.DOWNLOADING:
+            return
+        self.state = State.CONNECTED
+        if self.download_listener is not None:
+            self.download_listener.download_complete()
+        self.log.info("Chain download from %s finished after %s blocks", self.label, self.download_count)
+
+    def rescan_blocks(self, block_hashes, callback):
+        """
+        Request the filtered blocks in `block_hashes` and call `callback` with this protocol once the peer has sent
+        all of them along with the matching txs. Peers answer our messages in order so we follow the getdata with a
+        ping and treat the pong as the end of the batch. Batches for several rescans can be outstanding at once.
+        """
+        getdata_packet = msg_getdata()
+        for block_hash in block_hashes:
+            cinv = CInv()
+            cinv.type = 3
+            cinv.hash = block_hash
+            getdata_packet.inv.append(cinv)
+        nonce = random.getrandbits(64)
+        self.rescan_batches[nonce] = callback
+        if "rescan" not in self.timeouts:
+            self.timeouts["rescan"] = self.timers.schedule(RESCAN_TIMEOUT, self.response_timeout, "rescan")
+        self._send(getdata_packet)
+        self._send(msg_ping(nonce=nonce))
+
+    def send_message(self, message_obj):
+        if self.state == State.CONNECTING:
+            return self.timers.schedule(1, self.send_message, message_obj)
+        self._send(message_obj)
+
+    def send_inv(self, items):
+        """
+        Announce inventory to the peer, leaving out anything it already knows about. Returns the number of items
+        actually sent.
+        """
+        inv_packet = msg_inv()
+        inv_packet.inv = [item for item in items if self.known_inventory.add(item.hash)]
+        if len(inv_packet.inv) > 0:
+            self.send_message(inv_packet)
+        return len(inv_packet.inv)
+
+    def load_filter(self):
+        # With compact filters the matching is done here, the peer doesn't get a filter.
+        if self.compact_filters is None:
+            self._send(msg_filterload(filter=self.bloom_filter))
+
+    def connection_closed(self):
+        self._finish_download()
+        self.state = State.SHUTDOWN
+        self.filter_queue.clear()
+        if self.compact_filters is not None and self.compact_filters.peer is self:
+            self.compact_filters.requeue()
+            self.compact_filters.peer = None
+        if self.pinger is not None:
+            self.pinger.cancel()
+        if self.recorder is not None:
+            self.recorder.close()
+        for metric in PEER_METRICS:
+            metric.remove(peer=self.label)
+        self.log.info("Connection to %s closed", self.label)
@@ -0,0 +1,103 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+"""
+import time
+from twisted.internet import reactor
+from zope.interface import implementer
+from listeners import CountingDownloadListener, BatchDownloadListener
+
+DEFAULT_INTERVAL = 0.25
+
+
+@implementer(CountingDownloadListener)
+class ThrottledDownloadListener(object):
+    """
+    Sits in front of a `DownloadListener` and coalesces the per-block `progress` and `on_block_downloaded` events
+    the protocol produces during a sync. They are passed on with the latest values at most once every `interval`
+    seconds, or once every `stride` blocks if that is given instead. If the listener provides
+    `BatchDownloadListener` it gets all the blocks since the last event through `on_blocks_downloaded`, otherwise
+    it gets the last one. The percentage is only worked out for the events which are passed on.
+
+    Nothing is lost at the end. Anything held back is passed on before `download_complete` (or the next
+    `download_started`). With an `interval`, if the events stop part way through a batch the rest goes out
+    `interval` seconds later. A `stride` is a strict limit and only the end of the download flushes early.
+    """
+
+    def __init__(self, listener, interval=DEFAULT_INTERVAL, stride=None, clock=reactor):
+        self.listener = listener
+        self.interval = interval if interval is not None else DEFAULT_INTERVAL
+        self.stride = stride
+        self.clock = clock
+        self.batched = BatchDownloadListener.providedBy(listener)
+        self._progress = None
+        self._counts = None
+        self._blocks = []
+        self._last_block = None
+        self._pending = 0
+        self._last_flush = time.time()
+        self._flush_call = None
+
+    def download_started(self, peer, blocks_left):
+        self.flush()
+        self.listener.download_started(peer, blocks_left)
+
+    def on_block_downloaded(self, peer, block, blocks_left):
+        if self.batched:
+            self._blocks.append(block)
+        self._last_block = (peer, block, blocks_left)
+        self._pending += 1
+        self._maybe_flush()
+
+    def progress(self, percent, blocks_downloaded):
+        self._progress = (percent, blocks_downloaded)
+        self._counts = None
+        self._maybe_flush()
+
+    def on_download_progress(self, peer, block, blocks_downloaded, blocks_to_download):
+        if self.batched:
+            self._blocks.append(block)
+        self._last_block = (peer, block, blocks_to_download - blocks_downloaded + 1)
+        self._counts = (blocks_downloaded, blocks_to_download)
+        self._progress = None
+        self._pending += 1
+        self._maybe_flush()
+
+    def download_complete(self):
+        self.flush()
+        self.listener.download_complete()
+
+    def _maybe_flush(self):
+        if self.stride is not None:
+            if self._pending >= self.stride:
+                self.flush()
+        elif time.time() - self._last_flush >= self.interval:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.interval, self.flush)
+
+    def flush(self):
+        """
+        Pass on whatever has been held back.
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        self._last_flush = time.time()
+        if self._counts is not None:
+            blocks_downloaded, blocks_to_download = self._counts
+            self._progress = (int((blocks_downloaded / float(blocks_to_download)) * 100), blocks_downloaded)
+            self._counts = None
+        if self._last_block is not None:
+            peer, block, blocks_left = self._last_block
+            if self.batched:
+                blocks, self._blocks = self._blocks, []
+                self.listener.on_blocks_downloaded(peer, blocks, blocks_left)
+            else:
+                self.listener.on_block_downloaded(peer, block, blocks_left)
+            self._last_block = None
+            self._pending = 0
+        if self._progress is not None:
+            progress, self._progress = self._progress, None
+            self.listener.progress(*progress)
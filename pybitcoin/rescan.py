@@ -0,0 +1,68 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+"""
+from collections import deque
+from bitcoin.core import lx
+from twisted.internet import defer
+from log import Logger
+
+
+class Rescan(object):
+    """
+    Downloads the filtered blocks between two heights of the stored header chain so that txs paying our
+    subscriptions which were mined before we subscribed get picked up. The matches go through the normal
+    merkleblock/tx handling so they reach the subscription callbacks like any other tx.
+
+    The range is split into batches of `batch_size` blocks which are handed out to whichever peers are free, so
+    the download runs across all of them at once. A batch held by a peer which disconnects goes back in the queue.
+    `deferred` fires with the number of blocks scanned when everything has been downloaded.
+    """
+
+    def __init__(self, blockchain, start_height, end_height, download_listener=None, batch_size=500):
+        self.blockchain = blockchain
+        self.download_listener = download_listener
+        self.batches = deque((h, min(h + batch_size - 1, end_height)) for h in range(start_height, end_height + 1, batch_size))
+        self.total = max(end_height - start_height + 1, 0)
+        self.scanned = 0
+        self.in_flight = {}
+        self.deferred = defer.Deferred()
+        self.log = Logger(system=self)
+
+    def assign(self, protocols):
+        """
+        Give a batch to each of these peers which isn't already working on one.
+        """
+        for protocol in protocols:
+            if len(self.batches) == 0:
+                break
+            if protocol in self.in_flight:
+                continue
+            start, end = self.batches.popleft()
+            if self.download_listener is not None and self.scanned == 0 and len(self.in_flight) == 0:
+                self.download_listener.download_started(protocol.get_peer_address(), self.total)
+            # A reorg since we started may have moved the main chain, we just scan whatever is there now.
+            block_ids = [self.blockchain.get_block_id(h) for h in range(start, end + 1)]
+            hashes = [lx(block_id) for block_id in block_ids if block_id is not None]
+            self.in_flight[protocol] = (start, end)
+            protocol.rescan_blocks(hashes, self._on_batch_complete)
+
+    def on_peer_lost(self, protocol):
+        if protocol in self.in_flight:
+            self.batches.appendleft(self.in_flight.pop(protocol))
+
+    def is_complete(self):
+        return len(self.batches) == 0 and len(self.in_flight) == 0
+
+    def _on_batch_complete(self, protocol):
+        start, end = self.in_flight.pop(protocol)
+        self.scanned += end - start + 1
+        if self.download_listener is not None:
+            self.download_listener.progress(int((self.scanned / float(self.total)) * 100), self.scanned)
+        if self.is_complete():
+            self.log.info("Rescan of %s blocks complete" % self.total)
+            if self.download_listener is not None:
+                self.download_listener.download_complete()
+            self.deferred.callback(self.total)
+        else:
+            self.assign([protocol])
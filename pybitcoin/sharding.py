@@ -0,0 +1,537 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+
+Spreads a large set of subscriptions over several processes. One process owns the header sync and publishes the
+best chain to a memory mapped file. Each worker process watches a shard of the addresses with its own peers and
+bloom filter and reads its confirmations from the shared chain. The `ShardCoordinator` runs in the owning process,
+starts the workers, decides which shard each address goes to and passes the subscription callbacks back.
+
+    coordinator = ShardCoordinator(addrs, BlockDatabase("blocks.db"), "chain.map", shards=4, params="testnet")
+    coordinator.subscribe_address("n2eMqTT929pb1RDNuqEnxdaLau1rxy3efi", on_tx_received)
+
+The chain file starts with a header and is followed by a ring of `capacity` records, one per height:
+
+    <8s magic> <uint32 version> <uint32 capacity> <uint64 sequence> <int32 tip height> <int32 lowest height>
+    <32 byte block hash> <uint32 timestamp>
+
+The sequence number is odd while the file is being written. Readers take a copy of what they need and start
+again if the sequence number was odd or changed in the meantime, so they never see a half written chain.
+"""
+import os
+import sys
+import mmap
+import json
+import struct
+import argparse
+import traceback
+from hashlib import sha256
+from binascii import hexlify, unhexlify
+from twisted.internet import reactor, defer, task, stdio
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.basic import LineReceiver
+from zope.interface import implementer
+from zope.interface.verify import verifyObject
+from bitcoin.core import CBlockHeader, CTransaction, b2lx, lx
+from bitcoin.net import CBlockLocator
+from listeners import BlockchainListener
+from metrics import timed_call
+from log import Logger
+
+MAGIC = "PBCHAIN\x00"
+FORMAT_VERSION = 1
+# Enough for the 5000 headers a `BlockDatabase` keeps, with room to spare.
+DEFAULT_CAPACITY = 10000
+POLL_INTERVAL = 0.25
+# Headers our workers' peers announce before the owner has published them. They are only kept until it has.
+MAX_UNPUBLISHED = 2000
+# How many times a reader tries for a consistent copy before leaving it until the next poll.
+MAX_READ_ATTEMPTS = 1000
+
+_HEADER = struct.Struct("<8sIIQii")
+_RECORD = struct.Struct("<32sI")
+
+
+@implementer(BlockchainListener)
+class ChainPublisher(object):
+    """
+    Keeps the chain file in step with the main chain of a `BlockDatabase`. It writes the whole chain when it is
+    created and after that only the blocks which changed whenever the tip moves.
+    """
+
+    def __init__(self, blockchain, filepath, capacity=DEFAULT_CAPACITY):
+        self.blockchain = blockchain
+        self.filepath = filepath
+        self.capacity = capacity
+        size = _HEADER.size + capacity * _RECORD.size
+        self.fd = os.open(filepath, os.O_RDWR | os.O_CREAT, 0644)
+        # Carry on from the sequence number of an existing file so workers still reading it notice the change.
+        sequence = 0
+        if os.fstat(self.fd).st_size >= _HEADER.size:
+            magic, version, capacity, sequence, tip, start = _HEADER.unpack(os.read(self.fd, _HEADER.size))
+            if magic != MAGIC:
+                sequence = 0
+        os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.sequence = sequence + sequence % 2
+        self.tip = -1
+        self.start = 0
+        self.publish()
+        blockchain.add_listener(self)
+
+    def _get_record(self, height):
+        block_hash, timestamp = _RECORD.unpack_from(self.map, _HEADER.size + (height % self.capacity) * _RECORD.size)
+        return b2lx(block_hash)
+
+    def _write(self, records, tip):
+        self.sequence += 1
+        _HEADER.pack_into(self.map, 0, MAGIC, FORMAT_VERSION, self.capacity, self.sequence, self.tip, self.start)
+        for height, block_id in records:
+            _RECORD.pack_into(self.map, _HEADER.size + (height % self.capacity) * _RECORD.size, lx(block_id),
+                              self.blockchain.get_timestamp(block_id))
+        self.tip = tip
+        self.start = max(self.blockchain._get_starting_height(), tip - self.capacity + 1)
+        self.sequence += 1
+        _HEADER.pack_into(self.map, 0, MAGIC, FORMAT_VERSION, self.capacity, self.sequence, self.tip, self.start)
+
+    def publish(self):
+        """
+        Write out the whole main chain, or as much of it as fits.
+        """
+        tip = self.blockchain.get_height()
+        start = max(self.blockchain._get_starting_height(), tip - self.capacity + 1)
+        self._write([(height, self.blockchain.get_block_id(height)) for height in range(start, tip + 1)], tip)
+
+    def on_tip_changed(self, block_id, height):
+        # Walk back from the new tip to the first block we have already written. Usually that is its parent.
+        records = []
+        lowest = max(self.blockchain._get_starting_height(), height - self.capacity + 1)
+        h = height
+        while h >= lowest:
+            block_at_height = self.blockchain.get_block_id(h)
+            if h <= self.tip and h >= self.start and self._get_record(h) == block_at_height:
+                break
+            records.append((h, block_at_height))
+            h -= 1
+        self._write(reversed(records), height)
+
+    def on_reorg(self, disconnected, connected):
+        # The new blocks are written when the tip changes right after this.
+        pass
+
+    def close(self):
+        self.blockchain.remove_listener(self)
+        self.map.close()
+        os.close(self.fd)
+
+
+class SharedChain(object):
+    """
+    A read only view of the chain published by a `ChainPublisher` in another process, which can stand in for a
+    `BlockDatabase` in a client which doesn't sync headers itself (`BitcoinClient(sync_chain=False)`). The file
+    is checked for changes every `poll_interval` seconds and the same `BlockchainListener` events a
+    `BlockDatabase` would fire are passed on to the listeners.
+
+    `process_block` doesn't store anything, headers are the owner's business. It connects headers our peers
+    announce ahead of the owner to the chain so the client goes on to fetch their filtered blocks, and those
+    blocks get their confirmations once the owner has published them.
+    """
+
+    def __init__(self, filepath, poll_interval=POLL_INTERVAL):
+        self.filepath = filepath
+        self.file = open(filepath, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.capacity, sequence, tip, start = _HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("%s is not a version %s chain file" % (filepath, FORMAT_VERSION))
+        self.listeners = []
+        self.sequence = None
+        self.tip = -1
+        self.start = 0
+        # height -> (block id, timestamp) and block id -> height for the main chain.
+        self.chain = {}
+        self.heights = {}
+        self.unpublished = {}
+        self.log = Logger(system=self)
+        self.refresh()
+        self.poller = task.LoopingCall(self.refresh)
+        self.poller.start(poll_interval, now=False)
+
+    def _read(self, low):
+        """
+        Return the (sequence, tip, start, records) of a consistent copy of the file with the records from `low`
+        (or the lowest height there is) to the tip, or None if the file is being written for too long.
+        """
+        for attempt in range(MAX_READ_ATTEMPTS):
+            magic, version, capacity, sequence, tip, start = _HEADER.unpack_from(self.map, 0)
+            if sequence % 2 == 1:
+                continue
+            records = {}
+            for height in range(max(low, start), tip + 1):
+                block_hash, timestamp = _RECORD.unpack_from(self.map, _HEADER.size + (height % self.capacity) * _RECORD.size)
+                records[height] = (b2lx(block_hash), timestamp)
+            if _HEADER.unpack_from(self.map, 0)[3] == sequence:
+                return sequence, tip, start, records
+        return None
+
+    def refresh(self):
+        """
+        Pick up the changes to the shared chain and tell the listeners about them.
+        """
+        if _HEADER.unpack_from(self.map, 0)[3] == self.sequence:
+            return
+        # Read back far enough to find where the new chain leaves the one we have. Most of the time it just
+        # extends it, if not we look further back.
+        depth = 10
+        while True:
+            low = min(self.tip, _HEADER.unpack_from(self.map, 0)[4]) - depth
+            snapshot = self._read(low)
+            if snapshot is None:
+                return
+            sequence, tip, start, records = snapshot
+            fork = max(low, start)
+            if self.tip < 0 or low <= start or records.get(fork, (None,))[0] == self.chain.get(fork, (None,))[0]:
+                break
+            depth *= 2
+        while fork in records and records[fork][0] == self.chain.get(fork, (None,))[0]:
+            fork += 1
+        disconnected = [(height, self.chain[height][0]) for height in range(fork, self.tip + 1) if height in self.chain]
+        for height, block_id in disconnected:
+            del self.heights[block_id]
+            del self.chain[height]
+        connected = []
+        for height in range(fork, tip + 1):
+            self.chain[height] = records[height]
+            self.heights[records[height][0]] = height
+            self.unpublished.pop(records[height][0], None)
+            connected.append((height, records[height][0]))
+        for height in [h for h in self.chain if h < start]:
+            del self.heights[self.chain.pop(height)[0]]
+        old_tip = self.tip
+        self.sequence, self.tip, self.start = sequence, tip, start
+        for block_id, height in self.unpublished.items():
+            if height <= tip:
+                del self.unpublished[block_id]
+        if old_tip < 0:
+            return
+        if len(disconnected) > 0:
+            self._notify("on_reorg", disconnected, connected)
+        if tip != old_tip or len(disconnected) > 0:
+            self._notify("on_tip_changed", self.chain[tip][0], tip)
+
+    def _notify(self, event, *args):
+        for listener in self.listeners:
+            try:
+                timed_call("%s.%s" % (listener.__class__.__name__, event), getattr(listener, event), *args)
+            except Exception:
+                self.log.error("%s.%s failed:\n%s", listener.__class__.__name__, event, traceback.format_exc())
+
+    def add_listener(self, listener):
+        verifyObject(BlockchainListener, listener)
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def _get_starting_height(self):
+        return self.start
+
+    def get_height(self):
+        return self.tip
+
+    def get_tip(self):
+        return self.chain[self.tip][0]
+
+    def get_block_id(self, height):
+        record = self.chain.get(height)
+        return record[0] if record is not None else None
+
+    def get_block_height(self, block_id):
+        height = self.heights.get(block_id)
+        return height if height is not None else self.unpublished.get(block_id)
+
+    def get_timestamp(self, block_id):
+        return self.chain[self.heights[block_id]][1]
+
+    def get_height_at_time(self, timestamp):
+        """
+        Return the height of the first main chain block mined at or after `timestamp`, or None if the tip is older.
+        """
+        if self.chain[self.tip][1] < timestamp:
+            return None
+        low, high = self.start, self.tip
+        while low < high:
+            mid = (low + high) / 2
+            if self.chain[mid][1] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def get_confirmations(self, block_id):
+        height = self.heights.get(b2lx(block_id))
+        return self.tip - height + 1 if height is not None else 0
+
+    def get_locator(self):
+        locator = CBlockLocator()
+        height = self.tip
+        step = 1
+        while height > self.start:
+            locator.vHave.append(lx(self.chain[height][0]))
+            if len(locator.vHave) >= 10:
+                step *= 2
+            height -= step
+        locator.vHave.append(lx(self.chain[self.start][0]))
+        return locator
+
+    def process_block(self, block):
+        """
+        Return the height of the block's parent if it connects to the shared chain or a header we have already
+        seen, otherwise None. Nothing is validated or stored, the owner does that when it gets the header itself.
+        """
+        header = block if isinstance(block, CBlockHeader) else block.get_header()
+        height = self.get_block_height(b2lx(header.hashPrevBlock))
+        if height is not None and len(self.unpublished) < MAX_UNPUBLISHED:
+            self.unpublished[b2lx(header.GetHash())] = height + 1
+        return height
+
+    def save(self):
+        pass
+
+    def close(self):
+        if self.poller.running:
+            self.poller.stop()
+        self.map.close()
+        self.file.close()
+
+
+def _encode(message):
+    return json.dumps(message)
+
+
+class ShardWorker(LineReceiver):
+    """
+    The coordinator's end of a worker process, talking over the worker's stdin and stdout one JSON message per
+    line. It runs a `BitcoinClient` for the worker's shard of the addresses on the shared chain.
+    """
+
+    delimiter = "\n"
+
+    def __init__(self, client):
+        self.client = client
+
+    def lineReceived(self, line):
+        message = json.loads(line)
+        command = message["command"]
+        if command == "subscribe":
+            self.client.subscribe_address(str(message["address"]), self._make_callback(message["address"]))
+        elif command == "unsubscribe":
+            self.client.unsubscribe_address(str(message["address"]))
+        elif command == "rescan":
+            d = defer.maybeDeferred(self.client.rescan, message.get("from_height"), message.get("from_timestamp"))
+            d.addCallbacks(lambda blocks: self.sendLine(_encode({"event": "rescanned", "id": message["id"], "blocks": blocks})),
+                           lambda failure: self.sendLine(_encode({"event": "rescan_failed", "id": message["id"],
+                                                                  "error": failure.getErrorMessage()})))
+        elif command == "stop":
+            self.client.stop()
+            reactor.stop()
+
+    def _make_callback(self, address):
+        def on_tx(tx, in_blocks, confirmations):
+            self.sendLine(_encode({"event": "tx", "address": address, "tx": hexlify(tx.serialize()),
+                                   "in_blocks": [b2lx(block) for block in in_blocks], "confirmations": confirmations}))
+        return on_tx
+
+    def connectionLost(self, reason):
+        # The coordinator has gone.
+        if reactor.running:
+            reactor.stop()
+
+
+class _ShardProcess(ProcessProtocol):
+
+    def __init__(self, coordinator, shard):
+        self.coordinator = coordinator
+        self.shard = shard
+        self.buffer = ""
+        self.running = False
+
+    def connectionMade(self):
+        self.running = True
+
+    def send(self, message):
+        # Anything sent while the worker is down is made up for when it is restarted, subscriptions and rescans
+        # are both sent again then.
+        if self.running:
+            self.transport.write(_encode(message) + "\n")
+
+    def outReceived(self, data):
+        self.buffer += data
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self.coordinator._on_worker_message(self.shard, json.loads(line))
+
+    def processEnded(self, reason):
+        self.running = False
+        self.coordinator._on_worker_exited(self.shard, reason)
+
+
+class ShardCoordinator(object):
+    """
+    Runs the header sync for `blockchain` in this process, publishes the chain to `chain_file` and starts
+    `shards` worker processes, each with its own peers. Subscribe to addresses here and the coordinator passes
+    them on to the worker whose shard they fall in (see `get_shard`) and calls back with whatever the worker
+    finds, the same way `BitcoinClient.subscribe_address` does. A worker which dies is started again with its
+    subscriptions and any rescans it hadn't finished.
+    """
+
+    def __init__(self, addrs, blockchain, chain_file, shards=2, params="mainnet", max_connections=4, client_args=None):
+        from client import BitcoinClient
+        self.addrs = addrs
+        self.blockchain = blockchain
+        self.chain_file = chain_file
+        self.shards = shards
+        self.params = params
+        self.max_connections = max_connections
+        self.publisher = ChainPublisher(blockchain, chain_file)
+        self.client = BitcoinClient(addrs, params=params, blockchain=blockchain, **(client_args or {}))
+        # address -> shard for every address we have been asked to watch, and address -> callback.
+        self.assignments = {}
+        self.callbacks = {}
+        # rescan id -> (shard, message, Deferred) for the rescans the workers haven't answered yet.
+        self.rescans = {}
+        self.next_rescan = 0
+        self.stopping = False
+        self.log = Logger(system=self)
+        self.workers = [self._start_worker(shard) for shard in range(shards)]
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def _start_worker(self, shard):
+        worker = _ShardProcess(self, shard)
+        args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "sharding.py"),
+                "--chain", self.chain_file, "--params", self.params, "--max-connections", str(self.max_connections)]
+        for host, port in self.addrs:
+            args.extend(["--peer", "%s:%s" % (host, port)])
+        reactor.spawnProcess(worker, sys.executable, args, env=os.environ, childFDs={0: "w", 1: "r", 2: 2})
+        return worker
+
+    def get_shard(self, address):
+        """
+        Return the shard `address` is (or would be) watched by. New addresses are spread over the shards by their
+        hash, so each one always ends up in the same shard for the same number of shards.
+        """
+        if address in self.assignments:
+            return self.assignments[address]
+        return int(sha256(address).hexdigest(), 16) % self.shards
+
+    def subscribe_address(self, address, callback, shard=None):
+        """
+        Watch `address` in `shard`, or the one `get_shard` picks. `callback` is called with the tx, the hashes of
+        the blocks it was included in and the number of confirmations.
+        """
+        if address in self.assignments:
+            self.unsubscribe_address(address)
+        self.assignments[address] = shard if shard is not None else self.get_shard(address)
+        self.callbacks[address] = callback
+        self.workers[self.assignments[address]].send({"command": "subscribe", "address": address})
+
+    def unsubscribe_address(self, address):
+        if address in self.assignments:
+            self.workers[self.assignments.pop(address)].send({"command": "unsubscribe", "address": address})
+            del self.callbacks[address]
+
+    def get_shard_sizes(self):
+        sizes = [0] * self.shards
+        for shard in self.assignments.values():
+            sizes[shard] += 1
+        return sizes
+
+    def rescan(self, from_height=None, from_timestamp=None):
+        """
+        Rescan every shard (see `BitcoinClient.rescan`). Returns a Deferred which fires with the number of blocks
+        scanned by each shard, or fails with the first shard's error. A shard whose worker dies part way through
+        is rescanned again once the worker has been restarted.
+        """
+        if from_height is None and from_timestamp is None:
+            raise ValueError("Rescanning requires a from_height or from_timestamp")
+        deferreds = []
+        for shard, worker in enumerate(self.workers):
+            self.next_rescan += 1
+            message = {"command": "rescan", "id": self.next_rescan, "from_height": from_height,
+                       "from_timestamp": from_timestamp}
+            d = defer.Deferred()
+            self.rescans[self.next_rescan] = (shard, message, d)
+            deferreds.append(d)
+            worker.send(message)
+        return defer.gatherResults(deferreds, consumeErrors=True).addErrback(lambda failure: failure.value.subFailure)
+
+    def _on_worker_message(self, shard, message):
+        if message["event"] == "tx":
+            callback = self.callbacks.get(message["address"])
+            if callback is not None:
+                tx = CTransaction.deserialize(unhexlify(message["tx"]))
+                timed_call("subscription", callback, tx, [lx(block) for block in message["in_blocks"]], message["confirmations"])
+        elif message["event"] == "rescanned":
+            rescan = self.rescans.pop(message["id"], None)
+            if rescan is not None:
+                rescan[2].callback(message["blocks"])
+        elif message["event"] == "rescan_failed":
+            rescan = self.rescans.pop(message["id"], None)
+            if rescan is not None:
+                rescan[2].errback(Exception("Shard %s rescan failed: %s" % (shard, message["error"])))
+
+    def _on_worker_exited(self, shard, reason):
+        if self.stopping:
+            # Nobody is going to answer them now.
+            for rescan_id, (assigned, message, d) in self.rescans.items():
+                if assigned == shard:
+                    del self.rescans[rescan_id]
+                    d.errback(reason)
+            return
+        self.log.warning("Shard %s worker exited, restarting it", shard)
+
+        def restart():
+            if self.stopping:
+                self._on_worker_exited(shard, reason)
+                return
+            self.workers[shard] = self._start_worker(shard)
+            for address, assigned in self.assignments.items():
+                if assigned == shard:
+                    self.workers[shard].send({"command": "subscribe", "address": address})
+            for rescan_id in sorted(self.rescans):
+                assigned, message, d = self.rescans[rescan_id]
+                if assigned == shard:
+                    self.workers[shard].send(message)
+        reactor.callLater(1, restart)
+
+    def stop(self):
+        if not self.stopping:
+            self.stopping = True
+            for worker in self.workers:
+                worker.send({"command": "stop"})
+            self.publisher.close()
+
+
+def run_worker(chain_file, params, addrs, max_connections):
+    import bitcoin
+    from client import BitcoinClient
+    from log import FileLogObserver
+    from twisted.python import log
+    log.addObserver(FileLogObserver(sys.stderr).emit)
+    bitcoin.SelectParams(params)
+    client = BitcoinClient(addrs, params=params, blockchain=SharedChain(chain_file), max_connections=max_connections,
+                           sync_chain=False)
+    stdio.StandardIO(ShardWorker(client))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a shard worker (started by ShardCoordinator)")
+    parser.add_argument("--chain", required=True, help="the chain file published by the coordinator")
+    parser.add_argument("--params", default="mainnet")
+    parser.add_argument("--peer", action="append", default=[], metavar="HOST:PORT")
+    parser.add_argument("--max-connections", type=int, default=4)
+    args = parser.parse_args()
+    run_worker(args.chain, args.params, [(p.rsplit(":", 1)[0], int(p.rsplit(":", 1)[1])) for p in args.peer],
+               args.max_connections)
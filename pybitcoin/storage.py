@@ -0,0 +1,408 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+"""
+import os
+import zlib
+import struct
+import sqlite3 as lite
+from binascii import hexlify, unhexlify
+from zope.interface import Interface, implementer
+
+
+class StoredBlock(object):
+    """
+    A block header as stored by a `HeaderStorage` backend. `total_work` is the cumulative work of the chain up to
+    and including this block and `main_chain` is True if the block is part of the best chain.
+    """
+
+    __slots__ = ['block_id', 'height', 'hash_of_previous', 'timestamp', 'target', 'total_work', 'main_chain']
+
+    def __init__(self, block_id, height, hash_of_previous, timestamp, target, total_work, main_chain=False):
+        self.block_id = block_id
+        self.height = height
+        self.hash_of_previous = hash_of_previous
+        self.timestamp = timestamp
+        self.target = target
+        self.total_work = total_work
+        self.main_chain = main_chain
+
+
+class HeaderStorage(Interface):
+    """
+    The storage backend used by `BlockDatabase`. Block ids are hex strings as returned by `b2lx`. Implementations
+    only store and index blocks, all validation and fork choice happens in `BlockDatabase`.
+    """
+
+    def get(block_id):
+        """
+        Return the `StoredBlock` with this id or None.
+        """
+
+    def get_main_chain(height):
+        """
+        Return the main chain `StoredBlock` at this height or None.
+        """
+
+    def get_best():
+        """
+        Return the block with the most cumulative work or None if the storage is empty.
+        """
+
+    def get_starting_height():
+        """
+        Return the lowest height in storage.
+        """
+
+    def put(block):
+        """
+        Insert a new `StoredBlock`.
+        """
+
+    def set_main_chain(fork_height, block_ids):
+        """
+        Remove every block above `fork_height` from the main chain then add `block_ids` to it.
+        """
+
+    def delete_below(height):
+        """
+        Delete every block below `height`.
+        """
+
+    def flush():
+        """
+        Make everything written so far durable.
+        """
+
+    def close():
+        """
+        Flush and release any resources.
+        """
+
+
+@implementer(HeaderStorage)
+class MemoryStorage(object):
+    """
+    Keeps everything in dictionaries. Nothing is persisted, use this for tests and ephemeral workers.
+    """
+
+    def __init__(self):
+        self._blocks = {}
+        self._heights = {}
+        self._main_chain = {}
+        self._start = None
+
+    def get(self, block_id):
+        return self._blocks.get(block_id)
+
+    def get_main_chain(self, height):
+        block_id = self._main_chain.get(height)
+        return self._blocks[block_id] if block_id is not None else None
+
+    def get_best(self):
+        best = None
+        for block in self._blocks.itervalues():
+            if best is None or block.total_work > best.total_work:
+                best = block
+        return best
+
+    def get_starting_height(self):
+        if self._start not in self._heights:
+            self._start = min(self._heights) if self._heights else None
+        return self._start
+
+    def put(self, block):
+        if block.block_id in self._blocks:
+            raise ValueError("Block %s already stored" % block.block_id)
+        self._blocks[block.block_id] = block
+        self._heights.setdefault(block.height, set()).add(block.block_id)
+        if self._start is not None and block.height < self._start:
+            self._start = block.height
+        if block.main_chain:
+            self._main_chain[block.height] = block.block_id
+
+    def set_main_chain(self, fork_height, block_ids):
+        # The main chain is contiguous so we can stop at the first height without an entry.
+        height = fork_height + 1
+        while height in self._main_chain:
+            self._blocks[self._main_chain.pop(height)].main_chain = False
+            height += 1
+        for block_id in block_ids:
+            block = self._blocks[block_id]
+            block.main_chain = True
+            self._main_chain[block.height] = block_id
+
+    def delete_below(self, height):
+        start = self.get_starting_height()
+        if start is None:
+            return
+        if height - start > len(self._heights):
+            heights = [h for h in self._heights if h < height]
+        else:
+            heights = [h for h in range(start, height) if h in self._heights]
+        for h in heights:
+            for block_id in self._heights.pop(h):
+                del self._blocks[block_id]
+            self._main_chain.pop(h, None)
+        if heights:
+            self._start = None
+            while self._heights and self._start is None:
+                if height in self._heights:
+                    self._start = height
+                height += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return len(self._blocks)
+
+
+def _serialize_work(work):
+    # Fixed width big endian so that sqlite's memcmp ordering of blobs matches numeric ordering.
+    return lite.Binary(unhexlify("%064x" % work))
+
+
+def _deserialize_work(blob):
+    return long(hexlify(blob), 16)
+
+
+@implementer(HeaderStorage)
+class SQLiteStorage(object):
+    """
+    An on-disk sqlite database in WAL mode. Each insert is written to the database as it happens, `flush` commits
+    the open transaction. Files written by older versions (a text dump of an in-memory database) are imported on
+    first open and the dump is kept next to it with a `.bak` extension.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        legacy_dump = None
+        if os.path.exists(filepath):
+            with open(filepath, "rb") as f:
+                if f.read(16) != "SQLite format 3\x00":
+                    f.seek(0)
+                    legacy_dump = f.read()
+            if legacy_dump is not None:
+                os.rename(filepath, filepath + ".bak")
+        self.db = lite.connect(filepath)
+        self.db.text_factory = str
+        self.db.execute('''PRAGMA journal_mode=WAL''')
+        self.db.execute('''PRAGMA synchronous=NORMAL''')
+        if legacy_dump is not None:
+            self.db.executescript(legacy_dump)
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT name FROM sqlite_master WHERE type='table' AND name='blocks' ''')
+        if cursor.fetchone() is None:
+            self._create_tables()
+        else:
+            cursor.execute('''PRAGMA table_info(blocks)''')
+            if "mainChain" not in [column[1] for column in cursor.fetchall()]:
+                self._migrate_database()
+        self.db.commit()
+
+    def _create_tables(self):
+        cursor = self.db.cursor()
+        cursor.execute('''CREATE TABLE blocks(blockID TEXT PRIMARY KEY, height INTEGER, hashOfPrevious TEXT, timestamp INTEGER, target INTEGER, totalWork BLOB, mainChain INTEGER)''')
+        cursor.execute('''CREATE INDEX heightIndx ON blocks(height, mainChain);''')
+
+    def _migrate_database(self):
+        """
+        Databases saved by older versions stored the cumulative work as a float primary key. Recompute the work
+        of each block from its target and rebuild the main chain flags.
+        """
+        from blockchain import get_block_work
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT blockID, height, hashOfPrevious, timestamp, target FROM blocks ORDER BY height ASC''')
+        rows = cursor.fetchall()
+        cursor.execute('''DROP TABLE blocks''')
+        self._create_tables()
+        work = {}
+        parents = {}
+        for block_id, height, hash_of_previous, timestamp, target in rows:
+            work[block_id] = work[hash_of_previous] + get_block_work(target) if hash_of_previous in work else 0
+            parents[block_id] = hash_of_previous
+            cursor.execute('''INSERT INTO blocks(blockID, height, hashOfPrevious, timestamp, target, totalWork, mainChain) VALUES (?,?,?,?,?,?,?)''',
+                           (block_id, height, hash_of_previous, timestamp, target, _serialize_work(work[block_id]), 0))
+        tip = max(work, key=work.get) if work else None
+        while tip in parents:
+            cursor.execute('''UPDATE blocks SET mainChain=1 WHERE blockID=?''', (tip,))
+            tip = parents[tip]
+
+    def _to_block(self, row):
+        if row is None:
+            return None
+        return StoredBlock(row[0], row[1], row[2], row[3], row[4], _deserialize_work(row[5]), row[6] == 1)
+
+    def get(self, block_id):
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT blockID, height, hashOfPrevious, timestamp, target, totalWork, mainChain FROM blocks WHERE blockID=?''', (block_id,))
+        return self._to_block(cursor.fetchone())
+
+    def get_main_chain(self, height):
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT blockID, height, hashOfPrevious, timestamp, target, totalWork, mainChain FROM blocks WHERE height=? AND mainChain=1''', (height,))
+        return self._to_block(cursor.fetchone())
+
+    def get_best(self):
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT blockID, height, hashOfPrevious, timestamp, target, totalWork, mainChain FROM blocks ORDER BY totalWork DESC LIMIT 1''')
+        return self._to_block(cursor.fetchone())
+
+    def get_starting_height(self):
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT MIN(height) FROM blocks''')
+        return cursor.fetchone()[0]
+
+    def put(self, block):
+        cursor = self.db.cursor()
+        cursor.execute('''INSERT INTO blocks(blockID, height, hashOfPrevious, timestamp, target, totalWork, mainChain) VALUES (?,?,?,?,?,?,?)''',
+                       (block.block_id, block.height, block.hash_of_previous, block.timestamp, block.target,
+                        _serialize_work(block.total_work), 1 if block.main_chain else 0))
+
+    def set_main_chain(self, fork_height, block_ids):
+        cursor = self.db.cursor()
+        cursor.execute('''UPDATE blocks SET mainChain=0 WHERE height>? AND mainChain=1''', (fork_height,))
+        cursor.executemany('''UPDATE blocks SET mainChain=1 WHERE blockID=?''', [(block_id,) for block_id in block_ids])
+
+    def delete_below(self, height):
+        cursor = self.db.cursor()
+        cursor.execute('''DELETE FROM blocks WHERE height<?''', (height,))
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __len__(self):
+        cursor = self.db.cursor()
+        cursor.execute('''SELECT COUNT(*) FROM blocks''')
+        return cursor.fetchone()[0]
+
+
+@implementer(HeaderStorage)
+class FlatFileStorage(MemoryStorage):
+    """
+    An append-only binary log of fixed size records backed by an in-memory index. Inserts are just appends so
+    ingest is fast, but the whole file is replayed on open and the main chain is rebuilt from the best block.
+    Culled records stay in the file until more than half of it is dead, at which point `flush` rewrites it.
+
+    The file starts with `MAGIC` and each record is a kind byte, the record and a CRC32 of both. Replaying stops at
+    the first record which is incomplete or doesn't match its checksum, which is what a crash part way through a
+    write leaves behind, and the file is truncated there so new records follow on from the last good one.
+    """
+
+    MAGIC = "PBFLAT\x00\x01"
+    BLOCK_RECORD = "B"
+    DELETE_RECORD = "D"
+    _block = struct.Struct("<32s32siII32s")
+    _delete = struct.Struct("<i")
+    _checksum = struct.Struct("<I")
+
+    def __init__(self, filepath):
+        super(FlatFileStorage, self).__init__()
+        self.filepath = filepath
+        self._dead = 0
+        end = self._replay() if os.path.exists(filepath) else 0
+        if end < len(self.MAGIC):
+            with open(filepath, "wb") as f:
+                f.write(self.MAGIC)
+        elif end < os.path.getsize(filepath):
+            with open(filepath, "r+b") as f:
+                f.truncate(end)
+        self._file = open(filepath, "ab")
+
+    def _replay(self):
+        """
+        Load the records from the file and return the offset just past the last good one.
+        """
+        with open(self.filepath, "rb") as f:
+            data = f.read()
+        if len(data) < len(self.MAGIC) and self.MAGIC.startswith(data):
+            # We crashed before the first write made it to disk.
+            return 0
+        if not data.startswith(self.MAGIC):
+            raise ValueError("%s is not a flat file header store" % self.filepath)
+        pos = len(self.MAGIC)
+        records = 0
+        while pos < len(data):
+            kind = data[pos]
+            if kind == self.BLOCK_RECORD:
+                size = self._block.size
+            elif kind == self.DELETE_RECORD:
+                size = self._delete.size
+            else:
+                break
+            end = pos + 1 + size + self._checksum.size
+            if end > len(data):
+                break
+            checksum = self._checksum.unpack(data[end - self._checksum.size:end])[0]
+            if checksum != zlib.crc32(data[pos:end - self._checksum.size]) & 0xffffffff:
+                break
+            if kind == self.BLOCK_RECORD:
+                block = self._unpack_block(data[pos + 1:pos + 1 + size])
+                records += 1
+                if block.block_id not in self._blocks:
+                    MemoryStorage.put(self, block)
+            else:
+                MemoryStorage.delete_below(self, self._delete.unpack(data[pos + 1:pos + 1 + size])[0])
+            pos = end
+        self._dead = records - len(self._blocks)
+        best = self.get_best()
+        branch = []
+        while best is not None:
+            branch.append(best.block_id)
+            best = self._blocks.get(best.hash_of_previous)
+        MemoryStorage.set_main_chain(self, -1, branch)
+        return pos
+
+    def _record(self, kind, data):
+        return kind + data + self._checksum.pack(zlib.crc32(kind + data) & 0xffffffff)
+
+    def _pack_block(self, block):
+        return self._record(self.BLOCK_RECORD, self._block.pack(unhexlify(block.block_id), unhexlify(block.hash_of_previous or "00" * 32),
+                                                    block.height, block.timestamp, block.target,
+                                                    unhexlify("%064x" % block.total_work)))
+
+    def _unpack_block(self, data):
+        block_id, hash_of_previous, height, timestamp, target, total_work = self._block.unpack(data)
+        hash_of_previous = hexlify(hash_of_previous) if hash_of_previous != "\x00" * 32 else ""
+        return StoredBlock(hexlify(block_id), height, hash_of_previous, timestamp, target, long(hexlify(total_work), 16))
+
+    def put(self, block):
+        MemoryStorage.put(self, block)
+        self._file.write(self._pack_block(block))
+
+    def delete_below(self, height):
+        before = len(self._blocks)
+        MemoryStorage.delete_below(self, height)
+        self._dead += before - len(self._blocks)
+        self._file.write(self._record(self.DELETE_RECORD, self._delete.pack(height)))
+
+    def flush(self):
+        if self._dead > len(self._blocks):
+            self._compact()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _compact(self):
+        self._file.close()
+        tmp = self.filepath + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.MAGIC)
+            for block in sorted(self._blocks.itervalues(), key=lambda b: b.height):
+                f.write(self._pack_block(block))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.filepath)
+        self._dead = 0
+        self._file = open(self.filepath, "ab")
+
+    def close(self):
+        self.flush()
+        self._file.close()
@@ -0,0 +1,105 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+"""
+import traceback
+from log import Logger
+
+
+class Timer(object):
+    """
+    A handle to a scheduled call. It has the same `active` and `cancel` methods as a Twisted `DelayedCall`, except
+    cancelling a timer which already fired or was cancelled does nothing.
+    """
+
+    __slots__ = ['wheel', 'slot', 'rounds', 'func', 'args', 'kw', 'pending']
+
+    def __init__(self, wheel, slot, rounds, func, args, kw):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.pending = True
+
+    def active(self):
+        return self.pending
+
+    def cancel(self):
+        if self.pending:
+            self.wheel._remove(self)
+
+
+class TimerWheel(object):
+    """
+    A hashed timer wheel for timeouts which don't need to be precise. Timers are dropped into one of `size` slots
+    by their expiry time and the wheel moves on one slot every `granularity` seconds, so scheduling and cancelling
+    a timer is O(1) no matter how many timers are outstanding. A timer never fires early and fires at most one
+    `granularity` late.
+
+    This class doesn't keep time itself, call `advance` once per `granularity` to move it. Subclasses drive it from
+    an event loop by overriding `_start` and `_stop`, which are called when the first timer is scheduled and when
+    the last one goes.
+    """
+
+    def __init__(self, granularity=1.0, size=256):
+        self.granularity = granularity
+        self.slots = [set() for i in range(size)]
+        self.cursor = 0
+        self.count = 0
+        self.log = Logger(system=self)
+
+    def schedule(self, delay, func, *args, **kw):
+        """
+        Call `func(*args, **kw)` after `delay` seconds and return a `Timer` which can be used to cancel it.
+        """
+        # We may be part way through the current tick so add one to make sure we never fire early.
+        ticks = int(-(-delay // self.granularity)) + 1
+        slot = (self.cursor + ticks) % len(self.slots)
+        timer = Timer(self, slot, (ticks - 1) // len(self.slots), func, args, kw)
+        self.slots[slot].add(timer)
+        self.count += 1
+        if self.count == 1:
+            self._start()
+        return timer
+
+    def _start(self):
+        pass
+
+    def _stop(self):
+        pass
+
+    def _remove(self, timer):
+        self.slots[timer.slot].discard(timer)
+        timer.pending = False
+        self.count -= 1
+        if self.count == 0:
+            self._stop()
+
+    def advance(self, ticks=1):
+        """
+        Move the wheel on `ticks` slots, firing whatever expires on the way.
+        """
+        for i in range(ticks):
+            if self.count == 0:
+                break
+            self._tick()
+
+    def _tick(self):
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        for timer in list(self.slots[self.cursor]):
+            # A callback may have cancelled a timer we haven't got to yet.
+            if not timer.pending:
+                continue
+            if timer.rounds > 0:
+                timer.rounds -= 1
+                continue
+            self._remove(timer)
+            try:
+                timer.func(*timer.args, **timer.kw)
+            except Exception:
+                self.log.error("Timer callback %s failed:\n%s" % (timer.func, traceback.format_exc()))
+
+    def __len__(self):
+        return self.count
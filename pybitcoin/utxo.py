@@ -0,0 +1,250 @@
+__author__ = 'chris'
+"""
+Copyright (c) 2015 Chris Pacia
+"""
+from bitcoin.core import b2lx, COutPoint
+from bitcoin.wallet import CBitcoinAddress
+from listeners import BlockchainListener
+from zope.interface import implementer
+
+# Txs buried this deep whose outputs are all spent by txs buried as deep are dropped from the index. Reorgs that deep
+# aren't expected, and it is well within the headers a `BlockDatabase` keeps.
+PRUNE_DEPTH = 1000
+# How often (in blocks) we look for txs to drop.
+PRUNE_INTERVAL = 144
+
+
+class IndexedOutput(object):
+    __slots__ = ['address', 'value', 'txid', 'spent_by']
+
+    def __init__(self, address, value, txid):
+        self.address = address
+        self.value = value
+        self.txid = txid
+        self.spent_by = None
+
+
+class IndexedTx(object):
+    __slots__ = ['blocks', 'height', 'outputs', 'spends', 'reorged']
+
+    def __init__(self):
+        self.blocks = set()
+        self.height = None
+        self.outputs = []
+        self.spends = []
+        # Set while the tx has been reorged out of the chain and its spends don't count.
+        self.reorged = False
+
+
+@implementer(BlockchainListener)
+class UTXOIndex(object):
+    """
+    The unspent outputs paying the addresses in `subscriptions`, kept up to date as matching txs arrive. Each new
+    output is inserted into the bloom filter so our peers also send us the txs spending it, and `on_filter_changed`
+    is called so the filter can be reloaded. An output comes out of the filter again once the tx spending it has
+    been mined, and goes back in if a reorg takes that tx out of the chain. The height each tx was mined at is tracked and rolled back when its
+    block is disconnected, so balances and confirmations follow reorgs. A tx stays in the index after a reorg, it
+    just counts as unconfirmed until it is mined again. The outputs it spent count as unspent in the meantime.
+
+    Once a tx is `PRUNE_DEPTH` blocks deep and all of its outputs have been spent by txs at least as deep it is
+    dropped, so the index grows with the unspent outputs rather than with every tx we have seen.
+    """
+
+    def __init__(self, blockchain, subscriptions, bloom_filter, on_filter_changed=None):
+        self.blockchain = blockchain
+        self.subscriptions = subscriptions
+        self.bloom_filter = bloom_filter
+        self.on_filter_changed = on_filter_changed
+        self.txs = {}
+        self.outputs = {}
+        self.unspent = {}
+        # outpoint -> txid of every input of the txs we have indexed. During a rescan a spend can arrive before
+        # the output it spends, this lets us mark the output spent when it does turn up.
+        self.spends = {}
+        self.blocks = {}
+        # The number of outputs ever indexed, which unlike `len(outputs)` doesn't go down when we prune.
+        self.outputs_added = 0
+        self.pruned_height = None
+
+    def add_tx(self, tx, in_blocks=()):
+        """
+        Index the outputs of `tx` paying our subscriptions and the tracked outputs it spends, ignoring it if it
+        does neither. Returns the addresses whose outputs it spends.
+        """
+        txid = tx.GetHash()
+        if txid not in self.txs:
+            ours = []
+            for i, out in enumerate(tx.vout):
+                try:
+                    address = str(CBitcoinAddress.from_scriptPubKey(out.scriptPubKey))
+                except Exception:
+                    continue
+                if address in self.subscriptions:
+                    ours.append((COutPoint(txid, i), address, out.nValue))
+            spends = [COutPoint(txin.prevout.hash, txin.prevout.n) for txin in tx.vin]
+            if len(ours) == 0 and not any(outpoint in self.outputs for outpoint in spends):
+                return []
+
+            self.txs[txid] = IndexedTx()
+            for outpoint, address, value in ours:
+                self.outputs_added += 1
+                self.outputs[outpoint] = IndexedOutput(address, value, txid)
+                self.txs[txid].outputs.append(outpoint)
+                if outpoint in self.spends:
+                    self.outputs[outpoint].spent_by = self.spends[outpoint]
+                else:
+                    self.unspent.setdefault(address, set()).add(outpoint)
+                if not self._is_spent_in_chain(outpoint):
+                    self.bloom_filter.insert(outpoint)
+            self.txs[txid].spends = spends
+            self._apply_spends(txid)
+            if len(ours) > 0:
+                self._filter_changed()
+        for block in in_blocks:
+            self.add_block(txid, block)
+        return list(set(self.outputs[o].address for o in self.txs[txid].spends if o in self.outputs))
+
+    def add_block(self, txid, block):
+        """
+        Record that an indexed tx was included in `block` (the raw block hash).
+        """
+        if txid in self.txs:
+            block_id = b2lx(block)
+            self.txs[txid].blocks.add(block_id)
+            self.blocks.setdefault(block_id, set()).add(txid)
+            self._update_height(txid)
+
+    def _is_spent_in_chain(self, outpoint):
+        spent_by = self.outputs[outpoint].spent_by
+        return spent_by in self.txs and self.txs[spent_by].height is not None
+
+    def _filter_changed(self):
+        if self.on_filter_changed is not None:
+            self.on_filter_changed()
+
+    def remove_address(self, address):
+        for outpoint in self.unspent.pop(address, ()):
+            del self.outputs[outpoint]
+
+    def _apply_spends(self, txid):
+        for outpoint in self.txs[txid].spends:
+            self.spends[outpoint] = txid
+            if outpoint in self.outputs:
+                output = self.outputs[outpoint]
+                output.spent_by = txid
+                if output.address in self.unspent:
+                    self.unspent[output.address].discard(outpoint)
+
+    def _release_spends(self, txid):
+        released = False
+        for outpoint in self.txs[txid].spends:
+            if self.spends.get(outpoint) == txid:
+                del self.spends[outpoint]
+            if outpoint in self.outputs and self.outputs[outpoint].spent_by == txid:
+                output = self.outputs[outpoint]
+                output.spent_by = None
+                if output.address in self.subscriptions:
+                    self.unspent.setdefault(output.address, set()).add(outpoint)
+                    # Whatever spends it now, the same tx mined again or a double spend, we need to see it.
+                    self.bloom_filter.insert(outpoint)
+                    released = True
+        if released:
+            self._filter_changed()
+
+    def _update_height(self, txid):
+        tx = self.txs[txid]
+        tx.height = None
+        if self.blockchain is None:
+            return
+        for block_id in tx.blocks:
+            height = self.blockchain.get_block_height(block_id)
+            if height is not None and self.blockchain.get_block_id(height) == block_id:
+                tx.height = height
+        # Mined again after a reorg.
+        if tx.height is not None and tx.reorged:
+            tx.reorged = False
+            self._apply_spends(txid)
+        # Nothing else can spend the outputs it spends now, so our peers don't need to look for them.
+        if tx.height is not None:
+            spent = [outpoint for outpoint in tx.spends if outpoint in self.outputs and self.outputs[outpoint].spent_by == txid]
+            count = self.bloom_filter.get_element_count()
+            self.bloom_filter.remove_all(spent)
+            if self.bloom_filter.get_element_count() < count:
+                self._filter_changed()
+
+    def _is_buried(self, txid, tip):
+        # A txid we no longer have was pruned, so it was buried.
+        if txid not in self.txs:
+            return True
+        height = self.txs[txid].height
+        return height is not None and tip - height + 1 >= PRUNE_DEPTH
+
+    def prune(self, tip):
+        """
+        Drop the txs buried `PRUNE_DEPTH` blocks below `tip` whose outputs have all been spent by buried txs.
+        """
+        for txid in [txid for txid in self.txs if self._is_buried(txid, tip)]:
+            tx = self.txs[txid]
+            if not all(self.outputs[o].spent_by is not None and self._is_buried(self.outputs[o].spent_by, tip)
+                       for o in tx.outputs if o in self.outputs):
+                continue
+            for outpoint in tx.outputs:
+                self.outputs.pop(outpoint, None)
+                # Kept while the spend is indexed, in case a rescan brings this tx back.
+                if self.spends.get(outpoint) not in self.txs:
+                    self.spends.pop(outpoint, None)
+            # The spends of outputs we still have are kept with them.
+            for outpoint in tx.spends:
+                if self.spends.get(outpoint) == txid and outpoint not in self.outputs:
+                    del self.spends[outpoint]
+            for block_id in tx.blocks:
+                self.blocks[block_id].discard(txid)
+                if len(self.blocks[block_id]) == 0:
+                    del self.blocks[block_id]
+            del self.txs[txid]
+
+    def get_confirmations(self, txid):
+        height = self.txs[txid].height
+        return 0 if height is None else self.blockchain.get_height() - height + 1
+
+    def list_unspent(self, address, min_conf=0):
+        """
+        Return the unspent outputs paying `address` with at least `min_conf` confirmations as a list of dicts.
+        """
+        unspent = []
+        for outpoint in self.unspent.get(address, ()):
+            output = self.outputs[outpoint]
+            confirmations = self.get_confirmations(output.txid)
+            if confirmations >= min_conf:
+                unspent.append({
+                    "outpoint": outpoint,
+                    "address": address,
+                    "value": output.value,
+                    "confirmations": confirmations
+                })
+        return unspent
+
+    def get_balance(self, address, min_conf=0):
+        return sum(self.outputs[o].value for o in self.unspent.get(address, ())
+                   if self.get_confirmations(self.outputs[o].txid) >= min_conf)
+
+    def __contains__(self, txid):
+        return txid in self.txs
+
+    def on_tip_changed(self, block_id, height):
+        if self.pruned_height is None or height >= self.pruned_height + PRUNE_INTERVAL:
+            self.prune(height)
+            self.pruned_height = height
+
+    def on_reorg(self, disconnected, connected):
+        affected = set()
+        for height, block_id in disconnected + connected:
+            affected.update(self.blocks.get(block_id, ()))
+        for txid in affected:
+            self._update_height(txid)
+        # Txs which are no longer in the chain don't spend anything until they are mined again.
+        for height, block_id in disconnected:
+            for txid in self.blocks.get(block_id, ()):
+                if self.txs[txid].height is None and not self.txs[txid].reorged:
+                    self.txs[txid].reorged = True
+                    self._release_spends(txid)
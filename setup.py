@@ -11,5 +11,6 @@ setup(
     url="http://github.com/cpacia/pybitcoin",
     packages=find_packages(),
     requires=["bitcoin", "dnspython"],
-    install_requires=["dnspython>=1.12.0", "python-bitcoinlib>=0.5.0", "Twisted>=14.0.2"]
+    install_requires=["dnspython>=1.12.0", "python-bitcoinlib>=0.5.0", "Twisted>=14.0.2"],
+    extras_require={"asyncio": ["trollius"]}
 )